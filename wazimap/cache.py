@@ -0,0 +1,471 @@
+import gzip
+import hashlib
+import threading
+import time
+from collections import namedtuple, OrderedDict, Counter
+from cStringIO import StringIO
+from datetime import datetime
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.http import HttpResponse
+from django.utils.cache import patch_response_headers, patch_vary_headers
+from django.views.decorators.http import condition
+
+# Brotli is an optional dependency. If it's installed, responses are
+# also stored brotli-compressed for clients that support it.
+try:
+    import brotli
+    HAS_BROTLI = True
+except ImportError:
+    HAS_BROTLI = False
+
+# encodings we store responses in, in order of preference
+ENCODINGS = ['br', 'gzip'] if HAS_BROTLI else ['gzip']
+
+
+# headers that are recalculated when serving a cached response
+SKIP_HEADERS = set(['content-length', 'content-encoding'])
+
+# The data version identifies the data that Wazimap is serving. It changes
+# whenever data is reloaded, and is used to build cache keys and ETags.
+DataVersion = namedtuple('DataVersion', ['version', 'timestamp'])
+
+DATA_VERSION_KEY = 'wazimap.data_version'
+# when cached responses were last invalidated without a new data version
+INVALIDATED_KEY = 'wazimap.invalidated'
+
+# the version used if the cache doesn't have one
+_default_data_version = None
+
+
+def new_data_version():
+    timestamp = time.time()
+    version = '%s.%x' % (settings.WAZIMAP.get('data_version') or '', int(timestamp * 1000000))
+    return DataVersion(version, timestamp)
+
+
+def get_data_version():
+    """ The current DataVersion. This never touches the database, so it's
+    cheap enough to call at the start of every request.
+    """
+    global _default_data_version
+
+    data_version = cache.get(DATA_VERSION_KEY)
+    if data_version is None:
+        if _default_data_version is None:
+            _default_data_version = new_data_version()
+        data_version = _default_data_version
+
+        # another process may have beaten us to it
+        if not cache.add(DATA_VERSION_KEY, data_version, None):
+            data_version = cache.get(DATA_VERSION_KEY) or data_version
+
+    return data_version
+
+
+def bump_data_version():
+    """ Change the data version, which invalidates all cached responses
+    and ETags. Call this after loading new data.
+    """
+    data_version = new_data_version()
+    cache.set(DATA_VERSION_KEY, data_version, None)
+    return data_version
+
+
+def mark_invalidated():
+    """ Record that some cached responses have been invalidated without changing
+    the data version, so that the ETags and Last-Modified times of data views
+    change too. Called by ``wazimap.dependencies.invalidate``.
+    """
+    timestamp = time.time()
+    cache.set(INVALIDATED_KEY, timestamp, None)
+    return timestamp
+
+
+def data_modified_at():
+    """ The time, as a timestamp, that the data last changed: when the data version
+    was bumped or some cached responses were invalidated, whichever was later.
+    """
+    return max(get_data_version().timestamp, cache.get(INVALIDATED_KEY) or 0)
+
+
+def gzip_compress(content):
+    buf = StringIO()
+    # a fixed mtime ensures identical content produces identical output
+    with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as f:
+        f.write(content)
+    return buf.getvalue()
+
+
+def gzip_decompress(content):
+    with gzip.GzipFile(fileobj=StringIO(content)) as f:
+        return f.read()
+
+
+def accepted_encodings(request):
+    """ The set of content encodings the client accepts, based on
+    the Accept-Encoding header.
+    """
+    encodings = set()
+
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = part.strip().split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+
+        qvalue = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    pass
+
+        if qvalue > 0:
+            encodings.add(encoding)
+
+    return encodings
+
+
+def preferred_encoding(request):
+    """ The encoding a compressed response will be served in for this request.
+    """
+    accepted = accepted_encodings(request)
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return 'identity'
+
+
+def response_cache_key(request, key_prefix='wazimap.response'):
+    url = hashlib.md5(request.build_absolute_uri()).hexdigest()
+    return '%s.%s.%s.%s' % (key_prefix, get_data_version().version, request.method, url)
+
+
+class CompressedResponse(object):
+    """ A cacheable response whose body is stored compressed.
+
+    The body is always stored gzipped and, if brotli is installed, also
+    brotli-compressed. The uncompressed body is rebuilt from the gzipped
+    version for the rare clients that don't support gzip.
+    """
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = [(k, v) for k, v in response.items() if k.lower() not in SKIP_HEADERS]
+        self.bodies = {'gzip': gzip_compress(response.content)}
+
+        if HAS_BROTLI:
+            self.bodies['br'] = brotli.compress(response.content)
+
+    def to_response(self, request):
+        """ Build an HttpResponse for this request, using the best encoding
+        that the client accepts.
+        """
+        encoding = preferred_encoding(request)
+
+        if encoding in self.bodies:
+            response = HttpResponse(self.bodies[encoding], status=self.status_code)
+            response['Content-Encoding'] = encoding
+        else:
+            response = HttpResponse(gzip_decompress(self.bodies['gzip']), status=self.status_code)
+
+        for header, value in self.headers:
+            response[header] = value
+
+        patch_vary_headers(response, ['Accept-Encoding'])
+        return response
+
+
+def cache_response(timeout):
+    """ View decorator that caches successful responses for +timeout+ seconds,
+    storing the response bodies compressed and serving them in the encoding
+    the client prefers.
+
+    The tables and geographies each response is built from are recorded,
+    so that it can be invalidated with ``wazimap.dependencies.invalidate``.
+
+    Streaming responses aren't cached, but are sent with the same
+    caching headers.
+
+    This is an alternative to Django's ``cache_page`` for large, highly
+    compressible responses such as JSON.
+    """
+    from wazimap.dependencies import recording, cache_get, cache_set
+
+    def decorator(view):
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+
+            key = response_cache_key(request)
+            cached = cache_get(key)
+
+            if cached is None:
+                with recording() as deps:
+                    response = view(request, *args, **kwargs)
+                    if response.status_code != 200:
+                        return response
+                    if response.streaming:
+                        # too large to cache here, but clients and the CDN can
+                        patch_response_headers(response, timeout)
+                        return response
+
+                    if hasattr(response, 'render') and callable(response.render):
+                        response.render()
+
+                cached = CompressedResponse(response)
+                cache_set(key, cached, deps, timeout)
+
+            response = cached.to_response(request)
+            patch_response_headers(response, timeout)
+            return response
+
+        return wrapped
+    return decorator
+
+
+def data_etag(request, *args, **kwargs):
+    """ A strong ETag for a request to a data view.
+
+    The response for a data view is determined by the geography id and
+    table ids in the URL path and query string, the geo version and the
+    data version, so we can build the ETag without building the response.
+    Invalidating cached responses changes the ETag too.
+    """
+    query = sorted((k, sorted(v)) for k, v in request.GET.lists())
+    parts = [request.path, repr(query), get_data_version().version, repr(data_modified_at()),
+             preferred_encoding(request)]
+    return hashlib.sha1(u'|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def data_last_modified(request, *args, **kwargs):
+    return datetime.utcfromtimestamp(data_modified_at())
+
+
+#: View decorator that answers conditional GET requests to data views
+#: with a 304 before the view does any work.
+condition_on_data_version = condition(etag_func=data_etag, last_modified_func=data_last_modified)
+
+
+class PublishedCounters(object):
+    """ A set of counters, such as cache hits and misses, that are counted
+    in each process and published to the shared cache every +publish_secs+
+    seconds, so that they can be totalled across processes with +published+.
+    """
+    # how often, in seconds, to publish counts to the shared cache
+    publish_secs = 60
+
+    def __init__(self, name, stats, cache_alias='default'):
+        self.name = name
+        self.stats = stats
+        self.cache_alias = cache_alias
+        self.counts = Counter()
+        self.unpublished = Counter()
+        self.published_at = time.time()
+        self.lock = threading.Lock()
+
+        published_counters[name] = self
+
+    def incr(self, stat, n=1):
+        with self.lock:
+            self.counts[stat] += n
+            self.unpublished[stat] += n
+
+        if time.time() - self.published_at >= self.publish_secs:
+            self.publish()
+
+    def shared_key(self, stat):
+        return 'wazimap.counters.%s.%s' % (self.name, stat)
+
+    def publish(self):
+        """ Add this process's counts since they were last published to the
+        totals in the shared cache.
+        """
+        with self.lock:
+            self.published_at = time.time()
+            unpublished, self.unpublished = self.unpublished, Counter()
+
+        shared = caches[self.cache_alias]
+        for stat, n in unpublished.iteritems():
+            key = self.shared_key(stat)
+            shared.add(key, 0, None)
+            try:
+                shared.incr(key, n)
+            except ValueError:
+                # evicted in the meantime
+                shared.set(key, n, None)
+
+    def published(self):
+        """ The totals of each counter across all processes that have published their counts.
+        """
+        shared = caches[self.cache_alias]
+        return Counter(dict((stat, shared.get(self.shared_key(stat), 0)) for stat in self.stats))
+
+
+def hit_rate(hits, misses):
+    total = hits + misses
+    return float(hits) / total if total else None
+
+
+#: published counters by name
+published_counters = {}
+
+
+# sentinel for cache misses, since None is a valid cached value
+_missing = object()
+
+
+class TwoTierCache(object):
+    """ A cache for small, frequently used objects, with a bounded per-process
+    LRU cache in front of a shared Django cache.
+
+    Values in the local tier are shared by all threads in a process and
+    are returned as-is, so callers must not change them.
+
+    Both tiers are tied to the data version. Shared keys include it, and
+    each process checks for a new data version at most every
+    +version_check_secs+ seconds and drops its local entries if it has changed.
+
+    Hits and misses are counted for each tier in the ``cache.<name>`` counters.
+    """
+    # how often, in seconds, to check for a new data version
+    version_check_secs = 1
+    tiers = ['local', 'shared']
+
+    def __init__(self, name, max_entries=None, timeout=None, cache_alias='default'):
+        self.name = name
+        if max_entries is None:
+            max_entries = settings.WAZIMAP.get('local_cache_entries', 1000)
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.cache_alias = cache_alias
+
+        self.lock = threading.Lock()
+        self.local = OrderedDict()
+        self.version = None
+        self.checked_at = 0
+        self.counters = PublishedCounters('cache.%s' % name, [
+            '%s.%s' % (tier, stat) for tier in self.tiers for stat in ['hits', 'misses']], cache_alias)
+
+    @property
+    def shared(self):
+        return caches[self.cache_alias]
+
+    def shared_key(self, key):
+        return 'wazimap.2tier.%s.%s.%s' % (self.name, self.version, hashlib.md5(key).hexdigest())
+
+    def get(self, key, default=None):
+        self.check_version()
+
+        with self.lock:
+            value = self.local.pop(key, _missing)
+            if value is not _missing:
+                # move it to the end, as the most recently used
+                self.local[key] = value
+        if value is not _missing:
+            self.counters.incr('local.hits')
+            return value
+        self.counters.incr('local.misses')
+
+        value = self.shared.get(self.shared_key(key), _missing)
+        if value is _missing:
+            self.counters.incr('shared.misses')
+            return default
+
+        self.counters.incr('shared.hits')
+        self.set_local(key, value)
+        return value
+
+    def set(self, key, value):
+        self.check_version()
+        self.shared.set(self.shared_key(key), value, self.timeout)
+        self.set_local(key, value)
+
+    def get_many(self, keys):
+        """ Get the values for +keys+ with at most one request to the shared
+        cache. Returns a dict of the keys that were found.
+        """
+        self.check_version()
+
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self.local.pop(key, _missing)
+                if value is not _missing:
+                    self.local[key] = value
+                    found[key] = value
+        self.counters.incr('local.hits', len(found))
+
+        missing = [k for k in keys if k not in found]
+        if missing:
+            self.counters.incr('local.misses', len(missing))
+            shared_keys = dict((self.shared_key(k), k) for k in missing)
+            values = self.shared.get_many(shared_keys.keys())
+            self.counters.incr('shared.hits', len(values))
+            self.counters.incr('shared.misses', len(missing) - len(values))
+
+            for shared_key, value in values.iteritems():
+                key = shared_keys[shared_key]
+                self.set_local(key, value)
+                found[key] = value
+
+        return found
+
+    def set_many(self, mapping):
+        self.check_version()
+        self.shared.set_many(dict((self.shared_key(k), v) for k, v in mapping.iteritems()), self.timeout)
+        for key, value in mapping.iteritems():
+            self.set_local(key, value)
+
+    def get_or_set(self, key, func):
+        """ Get the value for +key+, or call +func+ to build it and store it
+        in the cache if it isn't there.
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = func()
+            self.set(key, value)
+        return value
+
+    def set_local(self, key, value):
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.local.pop(key, None)
+            self.local[key] = value
+            while len(self.local) > self.max_entries:
+                self.local.popitem(last=False)
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+
+    def check_version(self):
+        now = time.time()
+        if now - self.checked_at < self.version_check_secs:
+            return
+
+        self.checked_at = now
+        version = get_data_version().version
+        if version != self.version:
+            self.clear_local()
+            self.version = version
+
+    def hit_rates(self):
+        """ The fraction of lookups that were hits for each tier in this process.
+        """
+        counts = self.counters.counts
+        return dict((tier, hit_rate(counts[tier + '.hits'], counts[tier + '.misses'])) for tier in self.tiers)
+
+
+#: two-tier cache for small objects, such as geography details
+object_cache = TwoTierCache('objects')
+
+#: cache for export-ready geometries, which are too large to keep in each process
+geometry_cache = TwoTierCache('geometry', max_entries=0)
@@ -0,0 +1,347 @@
+import atexit
+import errno
+import hashlib
+import io
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.files.move import file_move_safe
+from django.utils.encoding import force_bytes
+from django.utils.six.moves import cPickle as pickle
+
+
+log = logging.getLogger(__name__)
+
+
+class ShardedFileCache(FileBasedCache):
+    """ A file-based cache that scales to hundreds of thousands of entries.
+
+    Django's ``FileBasedCache`` keeps all its files in one directory and culls by
+    listing and sampling that directory on every write, which stalls requests
+    when the cache is large. This cache instead:
+
+    * shards files into two levels of sub-directories,
+    * tracks the size and last access time of each entry in a SQLite index
+      stored alongside the cache files,
+    * keeps the total size under a byte budget by evicting the least recently
+      used entries in a background thread, and
+    * writes files atomically, so it's safe to share between processes.
+
+    Use it like ``FileBasedCache``, with these additional ``OPTIONS``:
+
+    * ``MAX_SIZE``: the maximum total size of the cache in bytes (default: 1GB)
+    * ``CULL_RATIO``: when the cache is too big, evict entries until it's
+      this fraction of ``MAX_SIZE`` (default: 0.9)
+    """
+    index_name = 'index.sqlite3'
+
+    def __init__(self, dir, params):
+        super(ShardedFileCache, self).__init__(dir, params)
+        options = params.get('OPTIONS', {})
+        self._max_size = int(options.get('MAX_SIZE', 1024 * 1024 * 1024))
+        self._cull_ratio = float(options.get('CULL_RATIO', 0.9))
+        self._index_path = os.path.join(self._dir, self.index_name)
+
+        # Django creates a cache object per thread, but all the cache objects
+        # for a directory share an index and an evictor
+        with _evictors_lock:
+            if self._index_path not in _indexes:
+                _indexes[self._index_path] = CacheIndex(self._index_path)
+            self._index = _indexes[self._index_path]
+
+            if self._dir not in _evictors:
+                _evictors[self._dir] = Evictor(self)
+            self._evictor = _evictors[self._dir]
+
+    def get(self, key, default=None, version=None):
+        fname = self._key_to_file(key, version)
+        try:
+            with io.open(fname, 'rb') as f:
+                if not self._is_expired(f):
+                    value = pickle.loads(zlib.decompress(f.read()))
+                    self._evictor.touch(self._entry_name(fname))
+                    return value
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return default
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._createdir()  # Cache dir can be deleted at any time.
+        fname = self._key_to_file(key, version)
+        shard = os.path.dirname(fname)
+        if not os.path.exists(shard):
+            try:
+                os.makedirs(shard, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        fd, tmp_path = tempfile.mkstemp(dir=shard)
+        renamed = False
+        try:
+            with io.open(fd, 'wb') as f:
+                expiry = self.get_backend_timeout(timeout)
+                f.write(pickle.dumps(expiry, pickle.HIGHEST_PROTOCOL))
+                f.write(zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+                size = f.tell()
+            file_move_safe(tmp_path, fname, allow_overwrite=True)
+            renamed = True
+        finally:
+            if not renamed:
+                os.remove(tmp_path)
+
+        if self._index.set(self._entry_name(fname), size) > self._max_size:
+            self._evictor.wake()
+
+    def _delete(self, fname):
+        super(ShardedFileCache, self)._delete(fname)
+        if fname.endswith(self.cache_suffix):
+            with self._index.transaction() as db:
+                db.execute('DELETE FROM entries WHERE name = ?', (self._entry_name(fname),))
+
+    def _cull(self):
+        # eviction happens in the background, see +evict+
+        pass
+
+    def _key_to_file(self, key, version=None):
+        """
+        Convert a key into a cache file path, sharded into two levels of
+        directories based on the md5sum of the key.
+        """
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        name = hashlib.md5(force_bytes(key)).hexdigest()
+        return os.path.join(self._dir, name[0:2], name[2:4], name + self.cache_suffix)
+
+    def _entry_name(self, fname):
+        return os.path.basename(fname)[:-len(self.cache_suffix)]
+
+    def _entry_file(self, name):
+        return os.path.join(self._dir, name[0:2], name[2:4], name + self.cache_suffix)
+
+    def clear(self):
+        super(ShardedFileCache, self).clear()
+        with self._index.transaction() as db:
+            db.execute('DELETE FROM entries')
+
+    def _list_cache_files(self):
+        if not os.path.exists(self._dir):
+            return []
+
+        filelist = []
+        for root, dirs, files in os.walk(self._dir):
+            filelist.extend(os.path.join(root, f) for f in files if f.endswith(self.cache_suffix))
+        return filelist
+
+    @property
+    def size(self):
+        """ Total size of the cache in bytes, according to the index.
+        """
+        return self._index.size()
+
+    def evict(self):
+        """ Evict least recently used entries until the cache is within its size budget.
+
+        Each batch of entries is chosen and removed from the index in a single
+        write transaction, so that processes evicting at the same time take
+        turns and don't evict more than they need to.
+        """
+        if not os.path.exists(self._index_path):
+            # the cache directory has been removed
+            return
+
+        self._evictor.flush()
+
+        target = self._max_size * self._cull_ratio
+        evicted = 0
+
+        while True:
+            with self._index.transaction() as db:
+                size = db.execute('SELECT size FROM stats').fetchone()[0]
+                if size <= (target if evicted else self._max_size):
+                    break
+
+                names = []
+                for name, entry_size in db.execute('SELECT name, size FROM entries ORDER BY accessed LIMIT 100'):
+                    if size <= target:
+                        break
+                    names.append(name)
+                    size -= entry_size
+
+                if not names:
+                    break
+                db.executemany('DELETE FROM entries WHERE name = ?', [(name,) for name in names])
+
+            for name in names:
+                super(ShardedFileCache, self)._delete(self._entry_file(name))
+            evicted += len(names)
+
+        if evicted:
+            log.info("Evicted %d entries from cache %s" % (evicted, self._dir))
+
+
+# indexes, by path
+_indexes = {}
+
+
+class CacheIndex(object):
+    """ The SQLite index of the entries in a ShardedFileCache directory.
+
+    There's one index for each directory in a process, which is shared by
+    all its threads. It's created, and its tables set up, the first time
+    it's used in each process. Statements are run one thread at a time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.pid = None
+        self.db = None
+        self.lock = threading.Lock()
+
+    def connection(self):
+        """ The SQLite connection for this process, which must only be used
+        with +lock+ held.
+        """
+        pid = os.getpid()
+        # connections don't survive forking, or the cache directory being removed
+        if self.pid != pid or not os.path.exists(self.path):
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode = WAL')
+            db.execute('PRAGMA synchronous = NORMAL')
+            self.setup(db)
+            self.db = db
+            self.pid = pid
+        return self.db
+
+    @contextmanager
+    def transaction(self):
+        """ Run statements in a write transaction. It starts with ``BEGIN IMMEDIATE``,
+        so other processes wait to write until it's committed.
+        """
+        with self.lock:
+            db = self.connection()
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+
+    def size(self):
+        with self.lock:
+            return self.connection().execute('SELECT size FROM stats').fetchone()[0]
+
+    def set(self, name, size):
+        """ Record an entry in the index, returning the new total size of the cache.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            cursor = db.execute('UPDATE entries SET size = ?, accessed = ? WHERE name = ?', (size, now, name))
+            if cursor.rowcount == 0:
+                db.execute('INSERT INTO entries (name, size, accessed) VALUES (?, ?, ?)', (name, size, now))
+            return db.execute('SELECT size FROM stats').fetchone()[0]
+
+    def setup(self, db):
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                name TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                accessed REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+
+            CREATE TABLE IF NOT EXISTS stats (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                size INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO stats (id, size) VALUES (0, 0);
+
+            -- keep the total size up to date, so we never have to sum it
+            CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+            BEGIN UPDATE stats SET size = size + NEW.size; END;
+            CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+            BEGIN UPDATE stats SET size = size - OLD.size; END;
+            CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries
+            BEGIN UPDATE stats SET size = size - OLD.size + NEW.size; END;
+        """)
+
+
+# background evictors, by cache directory
+_evictors = {}
+_evictors_lock = threading.Lock()
+
+
+class Evictor(object):
+    """ Maintains the index for a ShardedFileCache in a background thread.
+
+    Access times for entries are buffered and written to the index in
+    batches, so that reads don't have to write to the index. When woken
+    up, or every +flush_interval+ seconds, the evictor writes those access
+    times and evicts entries if the cache is too big.
+    """
+    # how often, in seconds, access times are written to the index
+    flush_interval = 5
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.lock = threading.Lock()
+        self.touched = {}
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.thread = None
+        self.stopped = False
+
+    def touch(self, name):
+        with self.lock:
+            self.touched[name] = time.time()
+        self.start()
+
+    def wake(self):
+        self.start()
+        self.wakeup.set()
+
+    def flush(self):
+        with self.lock:
+            touched, self.touched = self.touched, {}
+
+        if touched:
+            with self.cache._index.transaction() as db:
+                db.executemany('UPDATE entries SET accessed = ? WHERE name = ?',
+                               [(t, name) for name, t in touched.iteritems()])
+
+    def start(self):
+        # threads don't survive forking, so each process needs its own
+        pid = os.getpid()
+        if self.pid != pid:
+            with self.lock:
+                if self.pid != pid:
+                    self.thread = threading.Thread(target=self.run, name='wazimap-cache-evictor')
+                    self.thread.daemon = True
+                    self.thread.start()
+                    self.pid = pid
+                    atexit.register(self.stop)
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        # let the thread finish before the interpreter shuts down
+        if self.thread and self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(self.flush_interval)
+
+    def run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.cache.evict()
+            except Exception as e:
+                log.error("Error evicting entries from cache %s: %s" % (self.cache._dir, e), exc_info=e)
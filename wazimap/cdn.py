@@ -0,0 +1,176 @@
+import logging
+
+import requests
+from django.conf import settings
+from django.utils.module_loading import import_string
+from django.utils.text import slugify
+
+
+log = logging.getLogger(__name__)
+
+
+def geo_key(geoid):
+    return 'geo-%s' % geoid
+
+
+def table_key(table_id):
+    return 'table-%s' % table_id.upper()
+
+
+def dataset_key(dataset):
+    return 'dataset-%s' % slugify(dataset)
+
+
+def level_key(geo_level):
+    return 'level-%s' % geo_level
+
+
+def geo_level(geo):
+    """ The level of a geo object or geo id string, such as ``province-WC``.
+    """
+    if isinstance(geo, basestring):
+        return geo.split('-', 1)[0]
+    return geo.geo_level
+
+
+def surrogate_keys(geos=None, tables=None, datasets=None, ancestors=True, levels=None):
+    """ Build the list of surrogate keys for a response that uses
+    data for +geos+ from +tables+.
+
+    Geographies also get keys for their ancestors, since profiles
+    include data for their comparative (ancestor) geographies.
+    Geographies may be geo objects or geo id strings.
+
+    Responses that use data for too many geographies to list them all
+    can instead depend on every geography at each of +levels+. These
+    keys are purged along with any geography at that level.
+    """
+    keys = []
+
+    for geo in geos or []:
+        if isinstance(geo, basestring):
+            keys.append(geo_key(geo))
+        else:
+            keys.append(geo_key(geo.geoid))
+            if ancestors:
+                keys.extend(geo_key(g.geoid) for g in geo.ancestors())
+
+    datasets = set(datasets or [])
+    for table in tables or []:
+        if isinstance(table, basestring):
+            keys.append(table_key(table))
+        else:
+            keys.append(table_key(table.id))
+            datasets.add(table.dataset_name)
+
+    keys.extend(dataset_key(d) for d in datasets if d)
+    keys.extend(level_key(level) for level in levels or [])
+
+    # remove duplicates, preserving order
+    seen = set()
+    return [k for k in keys if not (k in seen or seen.add(k))]
+
+
+def add_surrogate_keys(response, keys):
+    """ Add surrogate keys to a response so that the CDN can purge it when
+    the data it's based on changes, and tell the CDN how long to cache it for.
+    """
+    header = settings.WAZIMAP.get('surrogate_key_header', 'Surrogate-Key')
+    if not header or not keys:
+        return response
+
+    existing = response[header].split() if response.has_header(header) else []
+    response[header] = ' '.join(existing + [k for k in keys if k not in existing])
+
+    cdn_cache_secs = settings.WAZIMAP.get('cdn_cache_secs')
+    if cdn_cache_secs and not response.has_header('Surrogate-Control'):
+        response['Surrogate-Control'] = 'max-age=%d' % cdn_cache_secs
+
+    return response
+
+
+class PurgeBackend(object):
+    """ Base class for CDN purge backends. Subclasses must implement +purge_keys+.
+
+    The backend is configured with the ``cdn_purge_backend`` setting and is
+    given the ``cdn_purge_options`` setting dict as keyword arguments.
+    """
+    def __init__(self, **options):
+        self.options = options
+
+    def purge_keys(self, keys):
+        raise NotImplementedError()
+
+
+class NullPurgeBackend(PurgeBackend):
+    """ Doesn't purge anything. This is the default.
+    """
+    def purge_keys(self, keys):
+        pass
+
+
+class LoggingPurgeBackend(PurgeBackend):
+    """ Logs the keys that would be purged. Useful for local development.
+    """
+    def purge_keys(self, keys):
+        log.info("Purging surrogate keys: %s" % ' '.join(keys))
+
+
+class FastlyPurgeBackend(PurgeBackend):
+    """ Purges keys from a Fastly service. Requires the ``service_id`` and ``api_key``
+    options, and optionally ``soft`` to mark content as stale rather than removing it.
+    """
+    API_URL = 'https://api.fastly.com/service/%s/purge'
+    # Fastly limits the number of keys that can be purged in one request
+    BATCH_SIZE = 256
+
+    def purge_keys(self, keys):
+        url = self.API_URL % self.options['service_id']
+        headers = {
+            'Fastly-Key': self.options['api_key'],
+            'Accept': 'application/json',
+        }
+        if self.options.get('soft'):
+            headers['Fastly-Soft-Purge'] = '1'
+
+        for i in xrange(0, len(keys), self.BATCH_SIZE):
+            batch = keys[i:i + self.BATCH_SIZE]
+            headers['Surrogate-Key'] = ' '.join(batch)
+            resp = requests.post(url, headers=headers, timeout=30)
+            resp.raise_for_status()
+
+
+def get_purge_backend():
+    backend = settings.WAZIMAP.get('cdn_purge_backend') or 'wazimap.cdn.NullPurgeBackend'
+    options = settings.WAZIMAP.get('cdn_purge_options') or {}
+    return import_string(backend)(**options)
+
+
+def purge(geos=None, tables=None, datasets=None):
+    """ Purge CDN content that depends on any of the given geographies, tables or datasets.
+
+    Call this from data loading scripts after new data has been loaded. Only
+    the keys for exactly the items given are purged, which includes every
+    response that used data for a geography as an ancestor, and responses
+    that depend on every geography at the level of one of +geos+.
+
+    Surrogate keys don't combine tables and geographies, so when both are
+    given this purges every response that uses one of the tables, and every
+    response that uses data for one of the geographies, not only responses
+    that use one of the tables for one of the geographies. That's broader
+    than ``wazimap.dependencies.invalidate``, but never misses anything.
+
+    :param list geos: geo ids, such as ``province-WC``, or geo objects
+    :param list tables: table ids or table objects
+    :param list datasets: dataset names
+
+    :return: the list of purged keys
+    """
+    # only purge the datasets we're explicitly given
+    tables = [getattr(t, 'id', t) for t in tables or []]
+    levels = sorted(set(geo_level(g) for g in geos or []))
+    keys = surrogate_keys(geos, tables, datasets, ancestors=False, levels=levels)
+    if keys:
+        log.info("Purging %d surrogate keys from the CDN" % len(keys))
+        get_purge_backend().purge_keys(keys)
+    return keys
@@ -1,46 +1,73 @@
+import errno
+import hashlib
 import shutil
 import tempfile
 import os
 import logging
-import zipfile
 import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.http import FileResponse, HttpResponse
+from django.utils import timezone
+from django.utils.encoding import force_text
 
 from wazimap.geo import geo_data, HAS_GDAL, gdal_missing
+from wazimap.data import writers
+from wazimap.data.zipstream import iter_zip
 
 
 log = logging.getLogger(__name__)
 
 
 class DownloadManager(object):
+    """ Generates data downloads in various formats.
+
+    Formats with a ``writer`` are written by that method, with the pure-Python
+    writers in +wazimap.data.writers+, which don't need GDAL. The others are
+    written with OGR's ``driver``.
+    """
     BAD_LAYER_CHARS = re.compile('[ /#-]')
 
     DOWNLOAD_FORMATS = {
         'kml': {"driver": "KML", 'geometry': True, 'mime': 'application/vnd.google-earth.kml+xml'},
-        'geojson': {"driver": "GeoJSON", 'geometry': True, 'mime': 'application/json'},
-        'xlsx': {"driver": "XLSX", 'geometry': False, 'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
-        'csv': {"driver": "CSV", 'geometry': False, 'mime': 'text/csv'},
+        'geojson': {"driver": "GeoJSON", 'writer': 'write_geojson', 'geometry': True, 'mime': 'application/json'},
+        'xlsx': {"driver": "XLSX", 'writer': 'write_xlsx', 'geometry': False, 'mime': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+        'csv': {"driver": "CSV", 'writer': 'write_csv', 'geometry': False, 'mime': 'text/csv'},
         'shp': {"driver": "Esri Shapefile", 'geometry': True, 'mime': 'text/csv'},
     }
 
+    def __init__(self, simplify=None):
+        #: the name of the tolerance in the ``download_simplify_tolerances`` setting
+        #: to simplify geometries with, or None for full precision
+        self.simplify = simplify
+        #: the geometries for a download as WKB, by geoid
+        self.geometries = {}
+
     def generate_download_bundle(self, tables, geos, geo_ids, data, fmt):
-        if not HAS_GDAL:
-            gdal_missing(critical=True)
+        """ Generate a zipped download, returning a tuple of the content of the
+        zip file, its filename and its mime type.
 
-        from osgeo import ogr, osr
-        self.ogr = ogr
-        self.osr = osr
-        ogr.UseExceptions()
+        This holds the whole file in memory, use +stream_download_bundle+ instead
+        where possible.
+        """
+        bundle, fname, mime_type = self.stream_download_bundle(tables, geos, geo_ids, data, fmt)
+        return ''.join(bundle), fname, mime_type
 
+    def stream_download_bundle(self, tables, geos, geo_ids, data, fmt):
+        """ Generate a download, returning a tuple of a +DownloadBundle+ that zips
+        it as it's iterated over, the filename of the zip file and its mime type.
+        """
         format = self.DOWNLOAD_FORMATS[fmt]
 
+        if 'writer' not in format and not HAS_GDAL:
+            gdal_missing(critical=True)
+
         # where we're going to put the data temporarily
         temp_path = tempfile.mkdtemp()
         try:
-            file_ident = "%s_%s" % (
-                tables[0].id.upper(),
-                # The gdal KML driver doesn't like certain chars in its layer names.
-                # It will replace them for you, but then subsequent calls hang.
-                self.BAD_LAYER_CHARS.sub('_', geos[0].name))
+            file_ident = self.file_ident(tables, geos)
 
             # where the files go, what we'll eventually zip up
             inner_path = os.path.join(temp_path, file_ident)
@@ -48,83 +75,384 @@ class DownloadManager(object):
             os.mkdir(inner_path)
             out_filepath = os.path.join(inner_path, '%s.%s' % (file_ident, fmt))
 
-            out_driver = ogr.GetDriverByName(format['driver'])
-            out_srs = osr.SpatialReference()
-            out_srs.ImportFromEPSG(4326)
-            out_data = out_driver.CreateDataSource(out_filepath)
+            if format['geometry']:
+                self.geometries = geo_data.get_geometry_wkbs(geos, self.simplify)
 
-            # See http://gis.stackexchange.com/questions/53920/ogr-createlayer-returns-typeerror
-            # excel limits worksheet names to 31 chars
-            out_layer = out_data.CreateLayer(file_ident.encode('utf-8')[0:31], srs=out_srs, geom_type=ogr.wkbMultiPolygon)
-            out_layer.CreateField(ogr.FieldDefn('geo_level', ogr.OFTString))
-            out_layer.CreateField(ogr.FieldDefn('geo_code', ogr.OFTString))
-            out_layer.CreateField(ogr.FieldDefn('geoid', ogr.OFTString))
-            out_layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+            if 'writer' in format:
+                getattr(self, format['writer'])(out_filepath, file_ident, tables, geos, data)
+            else:
+                self.write_ogr(out_filepath, file_ident, tables, geos, data, fmt)
+
+            return DownloadBundle(temp_path, inner_path, file_ident), file_ident + '.zip', 'application/zip'
+
+        except:
+            shutil.rmtree(temp_path)
+            raise
+
+    def file_ident(self, tables, geos):
+        """ The name of a download, which is also the name of the zip file and
+        of the files in it.
+        """
+        return "%s_%s" % (
+            tables[0].id.upper(),
+            # The gdal KML driver doesn't like certain chars in its layer names.
+            # It will replace them for you, but then subsequent calls hang.
+            self.BAD_LAYER_CHARS.sub('_', geos[0].name))
+
+    def header(self, tables):
+        """ The names of the columns of a download.
+        """
+        header = ['geo_level', 'geo_code', 'geoid', 'name']
+        for table in tables:
+            header.extend(table.columns.iterkeys())
+        return header
+
+    def rows(self, tables, geos, data):
+        """ Yield a row of values for each of +geos+, in the order of +header+.
+        """
+        for geo in geos:
+            row = [geo.geo_level, geo.geo_code, geo.geoid, geo.name]
 
             for table in tables:
+                table_estimates = data[geo.geoid][table.id.upper()]['estimate']
+                row.extend(table_estimates.get(column_id) for column_id in table.columns.iterkeys())
+
+            yield row
+
+    def write_csv(self, out_filepath, file_ident, tables, geos, data):
+        writers.write_csv(out_filepath, self.header(tables), self.rows(tables, geos, data))
+
+    def write_xlsx(self, out_filepath, file_ident, tables, geos, data):
+        # excel limits worksheet names to 31 chars
+        writers.write_xlsx(out_filepath, self.header(tables), self.rows(tables, geos, data), file_ident[0:31])
+
+    def write_geojson(self, out_filepath, file_ident, tables, geos, data):
+        geometries = (self.get_geojson_geometry(geo) for geo in geos)
+        writers.write_geojson(out_filepath, self.header(tables), self.rows(tables, geos, data), geometries)
+
+    def write_ogr(self, out_filepath, file_ident, tables, geos, data, fmt):
+        from osgeo import ogr, osr
+        self.ogr = ogr
+        self.osr = osr
+        ogr.UseExceptions()
+
+        format = self.DOWNLOAD_FORMATS[fmt]
+
+        out_driver = ogr.GetDriverByName(format['driver'])
+        out_srs = osr.SpatialReference()
+        out_srs.ImportFromEPSG(4326)
+        out_data = out_driver.CreateDataSource(out_filepath)
+
+        # See http://gis.stackexchange.com/questions/53920/ogr-createlayer-returns-typeerror
+        # excel limits worksheet names to 31 chars
+        out_layer = out_data.CreateLayer(file_ident.encode('utf-8')[0:31], srs=out_srs, geom_type=ogr.wkbMultiPolygon)
+        out_layer.CreateField(ogr.FieldDefn('geo_level', ogr.OFTString))
+        out_layer.CreateField(ogr.FieldDefn('geo_code', ogr.OFTString))
+        out_layer.CreateField(ogr.FieldDefn('geoid', ogr.OFTString))
+        out_layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+
+        for table in tables:
+            for column_id, column_info in table.columns.iteritems():
+                out_layer.CreateField(ogr.FieldDefn(str(column_id), ogr.OFTReal))
+
+        for geo in geos:
+            geoid = geo.geoid
+
+            out_feat = ogr.Feature(out_layer.GetLayerDefn())
+
+            if format['geometry']:
+                geom = self.get_geometry(geo)
+                if geom:
+                    out_feat.SetGeometry(geom)
+
+            out_feat.SetField2('geo_level', geo.geo_level)
+            out_feat.SetField2('geo_code', geo.geo_code)
+            out_feat.SetField2('geoid', geoid)
+            out_feat.SetField2('name', geo.name.encode('utf-8'))
+
+            for table in tables:
+                table_estimates = data[geoid][table.id.upper()]['estimate']
+
                 for column_id, column_info in table.columns.iteritems():
-                    out_layer.CreateField(ogr.FieldDefn(str(column_id), ogr.OFTReal))
+                    if column_id in table_estimates:
+                        est = table_estimates[column_id]
+                        # None values get changed to zero, which isn't accurate
+                        if est is None:
+                            continue
+
+                        # GDAL generates invalid excel spreadsheets for
+                        # zero values in real columns
+                        if fmt == 'xlsx' and est == 0:
+                            continue
+                        out_feat.SetField(str(column_id), est)
+
+            out_layer.CreateFeature(out_feat)
 
-            for geo in geos:
-                geoid = geo.geoid
+        # this closes the object and ensure
+        # the data is flushed to the file
+        out_data = None
 
-                out_feat = ogr.Feature(out_layer.GetLayerDefn())
+    def get_geometry(self, geo):
+        wkb = self.geometries.get(geo.geoid)
+        if wkb:
+            return self.ogr.CreateGeometryFromWkb(wkb)
+
+    def get_geojson_geometry(self, geo):
+        """ The geometry of +geo+ as a GeoJSON-like dict, or None if it doesn't have one.
+        """
+        wkb = self.geometries.get(geo.geoid)
+        if wkb:
+            # there are only geometries if shapely is installed
+            from shapely import wkb as shapely_wkb
+            return shapely_wkb.loads(wkb).__geo_interface__
+
+
+class DownloadBundle(object):
+    """ The files of a download, which are zipped as they're iterated over, so
+    that they can be streamed to the client without holding the zip file in
+    memory or on disk.
+
+    The temporary directory holding the files is removed once they've been
+    zipped, or when the bundle is closed, such as when the client disconnects.
+    """
+    def __init__(self, temp_path, inner_path, file_ident):
+        self.temp_path = temp_path
+        self.inner_path = inner_path
+        self.file_ident = file_ident
+
+    def files(self):
+        for root, dirs, files in os.walk(self.inner_path):
+            for f in sorted(files):
+                yield os.path.join(root, f), os.path.join(self.file_ident, f)
+
+    def __iter__(self):
+        log.info("Zipping download in %s" % self.inner_path)
+        try:
+            for chunk in iter_zip(self.files()):
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        if os.path.exists(self.temp_path):
+            shutil.rmtree(self.temp_path, ignore_errors=True)
 
-                if format['geometry']:
-                    geom = self.get_geometry(geo)
-                    if geom:
-                        out_feat.SetGeometry(geom)
 
-                out_feat.SetField2('geo_level', geo.geo_level)
-                out_feat.SetField2('geo_code', geo.geo_code)
-                out_feat.SetField2('geoid', geoid)
-                out_feat.SetField2('name', geo.name.encode('utf-8'))
+class DownloadCache(object):
+    """ Finished download bundles, stored on disk so that popular downloads
+    don't have to be generated again.
 
-                for table in tables:
-                    table_estimates = data[geoid][table.id.upper()]['estimate']
+    Bundles are stored under a hash of the tables, the geographies and their
+    versions, and the format, in a directory for the current data version.
+    Bumping the data version means bundles are generated again, and the
+    ``pregenerate_downloads`` management command removes the old ones.
+    """
+    def __init__(self, root):
+        self.root = root
 
-                    for column_id, column_info in table.columns.iteritems():
-                        if column_id in table_estimates:
-                            est = table_estimates[column_id]
-                            # None values get changed to zero, which isn't accurate
-                            if est is None:
-                                continue
+    def version_dir(self):
+        from wazimap.cache import get_data_version
+        # data versions without a name start with a dot, which would hide the directory
+        return re.sub(r'[^\w.-]', '_', get_data_version().version).strip('.')
 
-                            # GDAL generates invalid excel spreadsheets for
-                            # zero values in real columns
-                            if fmt == 'xlsx' and est == 0:
-                                continue
-                            out_feat.SetField(str(column_id), est)
+    def key(self, tables, geos, fmt, simplify=None):
+        """ The content address of the bundle for +tables+ and +geos+ in +fmt+,
+        with geometries simplified with the +simplify+ tolerance.
+        """
+        parts = [
+            ','.join(sorted(t.id.upper() for t in tables)),
+            ','.join(sorted('%s@%s' % (g.geoid, g.version) for g in geos)),
+            fmt,
+        ]
+        if simplify:
+            parts.append(simplify)
+        return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
 
-                out_layer.CreateFeature(out_feat)
+    def rel_path(self, key):
+        """ The path of a bundle, relative to the cache directory.
+        """
+        return os.path.join(self.version_dir(), key[:2], key + '.zip')
 
-            # this closes the object and ensure
-            # the data is flushed to the file
-            out_data = None
+    def get(self, key):
+        """ The full path of the cached bundle for +key+, or None if it isn't cached.
+        """
+        path = os.path.join(self.root, self.rel_path(key))
+        if os.path.exists(path):
+            return path
+        return None
 
-            # zip it up, they can be huge
-            zfile_filename = file_ident + '.zip'
-            zfile_filepath = os.path.join(temp_path, zfile_filename)
-            log.info("Zipping download into %s" % zfile_filepath)
+    def store(self, key, bundle):
+        """ Wrap +bundle+ so that, as it's iterated over, it's also written to the
+        cache. The bundle is only cached once it has been iterated over in full.
+        """
+        return CachingBundle(bundle, os.path.join(self.root, self.rel_path(key)))
 
-            zfile = zipfile.ZipFile(zfile_filepath, 'w', zipfile.ZIP_DEFLATED)
-            for root, dirs, files in os.walk(inner_path):
-                for f in files:
-                    zfile.write(os.path.join(root, f), os.path.join(file_ident, f))
-            zfile.close()
+    def response(self, key, fname):
+        """ A response that serves the cached bundle for +key+ as +fname+.
 
-            log.info("Zipped. Reading and streaming.")
+        If the ``download_sendfile_header`` setting is ``X-Sendfile``, the web server
+        is asked to send the file from its full path. If it's ``X-Accel-Redirect``,
+        the web server is sent to ``download_sendfile_url`` followed by the path of
+        the file relative to the cache directory.
+        """
+        header = settings.WAZIMAP.get('download_sendfile_header')
+        rel_path = self.rel_path(key)
 
-            with open(zfile_filepath) as f:
-                content = f.read()
-                return content, zfile_filename, 'application/zip'
+        if header == 'X-Accel-Redirect':
+            response = HttpResponse(content_type='application/zip')
+            response[header] = settings.WAZIMAP.get('download_sendfile_url', '/') + rel_path
+        elif header:
+            response = HttpResponse(content_type='application/zip')
+            response[header] = os.path.join(os.path.abspath(self.root), rel_path)
+        else:
+            response = FileResponse(open(os.path.join(self.root, rel_path), 'rb'), content_type='application/zip')
 
+        response['Content-Disposition'] = 'attachment; filename="%s"' % fname
+        return response
+
+    def prune(self):
+        """ Remove bundles for data versions other than the current one. Returns
+        the number of directories removed.
+        """
+        current = self.version_dir()
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name != current and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+class CachingBundle(object):
+    """ A download bundle that is written to +path+ as it's iterated over.
+
+    The bundle is written to a temporary file that is only moved into place once
+    the whole bundle has been written, so a client disconnecting part way
+    through never leaves a partial bundle in the cache.
+    """
+    def __init__(self, bundle, path):
+        self.bundle = bundle
+        self.path = path
+        self.tmp_path = None
+
+    def __iter__(self):
+        dirname = os.path.dirname(self.path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            # another request may have beaten us to it
+            if e.errno != errno.EEXIST:
+                raise e
+
+        fd, self.tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in self.bundle:
+                    f.write(chunk)
+                    yield chunk
+
+            os.chmod(self.tmp_path, 0644)
+            os.rename(self.tmp_path, self.path)
+            self.tmp_path = None
         finally:
-            shutil.rmtree(temp_path)
+            self.close()
 
-    def get_geometry(self, geo):
-        details = geo_data.get_geometry(geo)
-        shape = details['shape']
+    def close(self):
+        self.bundle.close()
+        if self.tmp_path and os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+        self.tmp_path = None
+
+
+def get_download_cache():
+    """ The +DownloadCache+ for the ``download_cache_dir`` setting, or None if it isn't set.
+    """
+    root = settings.WAZIMAP.get('download_cache_dir')
+    if root:
+        return DownloadCache(root)
+    return None
+
+
+def queue_download_job(key, params):
+    """ Queue a job to generate the download with cache key +key+ for the
+    request parameters +params+, unless one is already queued or running.
+    Returns the job.
+    """
+    from wazimap.models import DownloadJob
+
+    job = DownloadJob.objects.filter(key=key, status__in=[DownloadJob.QUEUED, DownloadJob.RUNNING]).first()
+    if job is None:
+        job = DownloadJob.objects.create(
+            key=key,
+            table_ids=params.get('table_ids', ''),
+            geo_ids=params.get('geo_ids', ''),
+            geo_version=params.get('geo_version'),
+            format=params.get('format', 'csv'),
+            simplify=params.get('simplify') or None)
+        log.info("Queued download job %s" % job.id)
+    return job
+
+
+def claim_download_jobs(n):
+    """ Mark up to +n+ of the oldest queued jobs as running and return their ids.
+    Jobs claimed by other workers at the same time are skipped.
+    """
+    from wazimap.models import DownloadJob
+
+    with transaction.atomic():
+        ids = list(DownloadJob.objects
+                   .select_for_update(skip_locked=True)
+                   .filter(status=DownloadJob.QUEUED)
+                   .order_by('created_at')
+                   .values_list('id', flat=True)[:n])
+        DownloadJob.objects.filter(id__in=ids).update(status=DownloadJob.RUNNING, started_at=timezone.now())
+    return ids
+
+
+def requeue_stale_download_jobs(secs):
+    """ Queue jobs that have been running for more than +secs+ seconds again,
+    such as after a worker was killed. Returns the number of jobs queued.
+    """
+    from wazimap.models import DownloadJob
+
+    cutoff = timezone.now() - timedelta(seconds=secs)
+    return DownloadJob.objects\
+        .filter(status=DownloadJob.RUNNING, started_at__lt=cutoff)\
+        .update(status=DownloadJob.QUEUED, started_at=None)
+
+
+def run_download_job(job_id):
+    """ Generate the download for a running job, storing it in the download
+    cache, and mark the job as done or failed. Returns the job's status.
+    """
+    from django.core.urlresolvers import reverse
+    from django.test import RequestFactory
+    from wazimap.models import DownloadJob
+    from wazimap.views import DataAPIView
+
+    job = DownloadJob.objects.get(id=job_id)
+    log.info("Running download job %s: %s" % (job.id, job))
+
+    try:
+        request = RequestFactory().get(reverse('api_download_data'), job.params())
+        response = DataAPIView.as_view(queue_downloads=False)(request, action='download')
+
+        if response.status_code != 200:
+            raise ValueError("Download failed with status code %s: %s" % (response.status_code, response.content))
+
+        # the bundle is cached as it's streamed
+        if response.streaming:
+            for chunk in response.streaming_content:
+                pass
+        response.close()
+
+        job.status = DownloadJob.DONE
+    except Exception as e:
+        job.status = DownloadJob.FAILED
+        job.error = force_text(e)
+        log.error(u"Download job %s failed: %s" % (job.id, job.error), exc_info=True)
 
-        if shape:
-            return self.ogr.CreateGeometryFromWkb(shape.wkb)
+    job.finished_at = timezone.now()
+    job.save()
+    return job.status
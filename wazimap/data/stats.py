@@ -0,0 +1,123 @@
+""" Dict types for profile stats.
+
+A profile is made up of thousands of small stats, each of which has values for
+the place and for each of its comparative geographies. +get_stat_data+ and the
+other data helpers build them as +Stat+ objects with +LevelValues+ for the
+values at each level.
+
+Both are plain dict subclasses, so they work anywhere a dict does (including
+``isinstance(x, dict)`` checks and the C JSON encoder), but their keys are
+always listed in a fixed order: the common stat fields first, and levels in
+``WAZIMAP['comparative_levels']`` order, with ``this`` first. This keeps the
+JSON for a profile the same no matter which process built it.
+
+Values for a level are converted to +LevelValues+ when they're set on a
++Stat+, so change them through the stat rather than through the dict that
+was passed in.
+"""
+from collections import Mapping
+
+from django.conf import settings
+
+
+def level_order():
+    """ Geography levels in the order in which +LevelValues+ lists them.
+    """
+    return ['this'] + settings.WAZIMAP['comparative_levels']
+
+
+class OrderedKeysDict(dict):
+    """ A dict whose keys are listed in the order given by +ordered_keys+.
+
+    The C JSON encoder asks a dict subclass for its ``keys()`` and then reads
+    each value directly from the dict, so only the listing methods need to
+    change; lookups are plain dict lookups.
+    """
+    __slots__ = ()
+
+    def ordered_keys(self, order):
+        """ The keys of this dict, with those in +order+ first and in that order,
+        followed by any others sorted.
+        """
+        keys = [k for k in order if k in self]
+        if len(keys) < len(self):
+            keys.extend(sorted(k for k in dict.iterkeys(self) if k not in order))
+        return keys
+
+    def __init__(self, *args, **kwargs):
+        super(OrderedKeysDict, self).__init__()
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    def update(self, *args, **kwargs):
+        # route through __setitem__ so that subclasses can convert values
+        if args:
+            other = args[0]
+            if isinstance(other, Mapping):
+                other = other.iteritems()
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        # the default may be converted when it's set, so return what was stored
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(k, dict.__getitem__(self, k)) for k in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def values(self):
+        return [dict.__getitem__(self, k) for k in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __reduce__(self):
+        return (self.__class__, (self.items(),))
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__, dict.__repr__(self))
+
+
+class LevelValues(OrderedKeysDict):
+    """ A mapping from geography level, such as ``this`` or ``province``, to a value.
+    """
+    __slots__ = ()
+
+    def keys(self):
+        return self.ordered_keys(level_order())
+
+
+class Stat(OrderedKeysDict):
+    """ A single stat, such as the number of people that speak a particular language.
+
+    Values for each level, such as ``values`` and ``numerators``, are stored
+    as +LevelValues+.
+    """
+    FIELDS = ('name', 'values', 'numerators', 'error', 'numerator_errors', 'index', 'error_ratio', 'metadata')
+    LEVEL_FIELDS = frozenset(['values', 'numerators', 'error', 'numerator_errors', 'index', 'error_ratio'])
+
+    __slots__ = ()
+
+    def keys(self):
+        return self.ordered_keys(self.FIELDS)
+
+    def __setitem__(self, key, value):
+        if key in self.LEVEL_FIELDS and isinstance(value, Mapping) and not isinstance(value, LevelValues):
+            value = LevelValues(value)
+        dict.__setitem__(self, key, value)
@@ -6,7 +6,10 @@ from sqlalchemy import Column, ForeignKey, Integer, String, Table, func, or_, an
 import sqlalchemy.types
 
 from wazimap.data.base import Base
-from wazimap.data.utils import get_session, capitalize, percent as p, add_metadata
+from wazimap.data.stats import Stat
+from wazimap.data.utils import get_session, capitalize, percent as p, add_metadata, native_number
+from wazimap.dependencies import record as record_dependency
+from wazimap.encoders import RawJSON, dumps
 
 
 '''
@@ -112,6 +115,7 @@ class SimpleTable(object):
         self.dataset_name = dataset
         self.total_column = total_column
         self.stat_type = stat_type
+        self._encoded = {}
         self.setup_columns()
 
         if self.total_column and self.total_column not in self.columns:
@@ -134,18 +138,30 @@ class SimpleTable(object):
                 'indent': 0 if col == self.total_column else indent
             }
 
-    def raw_data_for_geos(self, geos):
+    def raw_data_for_geos(self, geos, columns=None):
+        """
+        Pull raw data for a list of geo models.
+
+        Returns a dict mapping the geo ids to table data. If +columns+ is given,
+        only those columns are fetched.
+        """
+        if columns is None:
+            columns = self.columns.keys()
+
         # initial values
         data = {('%s-%s' % (geo.geo_level, geo.geo_code)): {
                 'estimate': {},
                 'error': {}}
                 for geo in geos}
+        record_dependency(self, geos)
 
         session = get_session()
         try:
             geo_values = None
             rows = session\
-                .query(self.model)\
+                .query(self.model.geo_level,
+                       self.model.geo_code,
+                       *[getattr(self.model, col) for col in columns])\
                 .filter(or_(and_(
                     self.model.geo_level == g.geo_level,
                     self.model.geo_code == g.geo_code,
@@ -156,8 +172,8 @@ class SimpleTable(object):
             for row in rows:
                 geo_values = data['%s-%s' % (row.geo_level, row.geo_code)]
 
-                for col in self.columns.iterkeys():
-                    geo_values['estimate'][col] = getattr(row, col)
+                for col in columns:
+                    geo_values['estimate'][col] = native_number(getattr(row, col))
                     geo_values['error'][col] = 0
 
         finally:
@@ -185,6 +201,7 @@ class SimpleTable(object):
 
         :return: (data-dictionary, total)
         """
+        record_dependency(self, [geo])
 
         session = get_session()
         try:
@@ -231,9 +248,9 @@ class SimpleTable(object):
             # what's our denominator?
             if total is None:
                 # sum of all columns
-                total = sum(getattr(row, f) or 0 for f in fields)
+                total = sum(native_number(getattr(row, f)) or 0 for f in fields)
             elif isinstance(total, basestring):
-                total = getattr(row, total)
+                total = native_number(getattr(row, total))
 
             # Now build a data dictionary based on the columns in +row+.
             # Multiple columns may be recoded into one, so we have to
@@ -243,14 +260,16 @@ class SimpleTable(object):
             key_order = key_order or fields  # default key order is just the list of fields
 
             for field in key_order:
-                val = getattr(row, field) or 0
+                val = native_number(getattr(row, field)) or 0
 
                 # recode the key for this field, default is to keep it the same
                 key = recode.get(field, field)
 
                 # set the recoded field name, noting that the key may already
                 # exist if another column recoded to it
-                field_info = results.setdefault(key, {'name': recode.get(field, self.columns[field]['name'])})
+                field_info = results.get(key)
+                if field_info is None:
+                    field_info = results[key] = Stat(name=recode.get(field, self.columns[field]['name']))
 
                 if percent:
                     # sum up existing values, if any
@@ -277,6 +296,14 @@ class SimpleTable(object):
             'stat_type': self.stat_type,
         }
 
+    def as_json(self, columns=True):
+        """ The same details as +as_dict+, as pre-encoded JSON that can be included in responses.
+        """
+        key = 'json' if columns else 'json_no_columns'
+        if key not in self._encoded:
+            self._encoded[key] = RawJSON(dumps(self.as_dict(columns)))
+        return self._encoded[key]
+
     def _build_model(self, db_table):
         # does it already exist?
         model = get_model_for_db_table(db_table)
@@ -484,16 +511,19 @@ class FieldTable(SimpleTable):
         else:
             return '-'.join(field_values)
 
-    def raw_data_for_geos(self, geos):
+    def raw_data_for_geos(self, geos, columns=None):
         """
         Pull raw data for a list of geo models.
 
-        Returns a dict mapping the geo ids to table data.
+        Returns a dict mapping the geo ids to table data. If +columns+ is given,
+        only those columns are returned. The values of the other columns are
+        still needed to calculate totals, so all rows are fetched.
         """
         data = {('%s-%s' % (geo.geo_level, geo.geo_code)): {
                 'estimate': {},
                 'error': {}}
                 for geo in geos}
+        record_dependency(self, geos)
 
         session = get_session()
         try:
@@ -531,7 +561,7 @@ class FieldTable(SimpleTable):
                         if all(row.total is None for row in rows):
                             value = None
                         else:
-                            value = sum(row.total or 0 for row in rows)
+                            value = sum(native_number(row.total) or 0 for row in rows)
 
                         if self.denominator_key and self.denominator_key == key:
                             # this row must be used as the denominator total,
@@ -559,6 +589,11 @@ class FieldTable(SimpleTable):
                     geo_values['estimate'][self.total_column] = total
                     geo_values['error'][self.total_column] = 0
 
+            if columns is not None:
+                for geo_values in data.itervalues():
+                    for key in ('estimate', 'error'):
+                        geo_values[key] = {col: geo_values[key][col] for col in columns if col in geo_values[key]}
+
         finally:
             session.close()
 
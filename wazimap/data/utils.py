@@ -1,5 +1,6 @@
 from __future__ import division
-from collections import OrderedDict
+from collections import OrderedDict, Mapping
+from decimal import Decimal
 
 from sqlalchemy import create_engine, MetaData, func
 from sqlalchemy.orm import sessionmaker, class_mapper
@@ -8,6 +9,9 @@ from django.conf import settings
 from django.db.backends.base.creation import TEST_DATABASE_PREFIX
 from django.db import connection
 
+from wazimap.data.stats import Stat
+from wazimap.dependencies import record as record_dependency
+
 
 if settings.TESTING:
     # Hack to ensure the sqlalchemy database name matches the Django one
@@ -88,6 +92,18 @@ def capitalize(s):
     return ''.join([s[0].upper(), s[1:]])
 
 
+def native_number(value):
+    """ Convert a Decimal from the database into an int or a float, so that
+    it can be combined with other numbers and encoded as JSON cheaply.
+    Other values are returned unchanged.
+    """
+    if isinstance(value, Decimal):
+        if value.is_finite() and value == value.to_integral_value():
+            return int(value)
+        return float(value)
+    return value
+
+
 def percent(num, denom, places=2):
     if denom == 0:
         return 0
@@ -124,7 +140,7 @@ MERGE_KEYS = set(['values', 'numerators', 'error'])
 
 def collapse_categories(data, categories, key_order=None):
     if key_order:
-        collapsed = OrderedDict((key, {'name': key}) for key in key_order)
+        collapsed = OrderedDict((key, Stat(name=key)) for key in key_order)
     else:
         collapsed = {}
 
@@ -141,7 +157,8 @@ def collapse_categories(data, categories, key_order=None):
         if new_category_name is None:
             continue
 
-        collapsed.setdefault(new_category_name, {'name': new_category_name})
+        if new_category_name not in collapsed:
+            collapsed[new_category_name] = Stat(name=new_category_name)
         new_fields = collapsed[new_category_name]
 
         # level 2: iterate over measurement objects in category
@@ -218,7 +235,7 @@ def merge_dicts(this, other, other_key):
         if key in MERGE_KEYS:
             if key in other:
                 values[other_key] = other[key]['this']
-        elif isinstance(values, dict):
+        elif isinstance(values, Mapping):
             merge_dicts(values, other[key], other_key)
 
 
@@ -233,13 +250,13 @@ def group_remainder(data, num_items=4, make_percentage=True,
     '''
     num_key = 'numerators' if make_percentage else 'values'
     total_all = dict((k, 0.0) for k in data.values()[0][num_key].keys())
-    total_other = total_all.copy()
-    other_dict = {
+    other_dict = Stat({
         "name": remainder_name,
         "error": {"this": 0.0},
         "numerator_errors": {"this": 0.0},
-        num_key: total_other,
-    }
+        num_key: total_all,
+    })
+    total_other = other_dict[num_key]
     cutoff = num_items - 2
 
     for i, (key, values) in enumerate(data.items()):
@@ -417,6 +434,7 @@ def get_stat_data(fields, geo, session, order_by=None,
         if not data_table:
             ValueError("Couldn't find a table that covers these fields: %s" % table_fields)
 
+    record_dependency(data_table, [geo])
     objects = get_objects_by_geo(data_table.model, geo, session, fields=fields, order_by=order_by,
                                  only=only, exclude=exclude, data_table=data_table)
 
@@ -469,14 +487,17 @@ def get_stat_data(fields, geo, session, order_by=None,
             else:
                 key = capitalize(key)
 
+            # the last field holds stats, the others hold categories
+            node = Stat if i == n_fields - 1 else OrderedDict
+
             # enforce key ordering the first time we see this field
             if (not data or data.keys() == ['metadata']) and field in key_order:
                 for fld in key_order[field]:
-                    data[fld] = OrderedDict()
+                    data[fld] = node()
 
             # ensure it's there
             if key not in data:
-                data[key] = OrderedDict()
+                data[key] = node()
 
             data = data[key]
 
@@ -493,11 +514,12 @@ def get_stat_data(fields, geo, session, order_by=None,
 
     # run the stats for the objects
     for obj in objects:
-        if not obj.total and exclude_zero:
+        value = native_number(obj.total)
+        if not value and exclude_zero:
             continue
 
         if denominator_key and getattr(obj, data_table.fields[-1]) == denominator_key:
-            grand_total = obj.total
+            grand_total = value
             # don't include the denominator key in the output
             continue
 
@@ -506,9 +528,9 @@ def get_stat_data(fields, geo, session, order_by=None,
         if not data:
             continue
 
-        if obj.total is not None:
-            data['numerators']['this'] += obj.total
-            running_total += obj.total
+        if value is not None:
+            data['numerators']['this'] += value
+            running_total += value
         else:
             # TODO: sanity check this is the right thing to do for multiple fields with
             # nested nulls -- does aggregating over nulls treat them as zero, or should we
@@ -516,7 +538,7 @@ def get_stat_data(fields, geo, session, order_by=None,
             data['numerators']['this'] = None
 
         if percent_grouping:
-            if obj.total is not None:
+            if value is not None:
                 group_key = tuple()
                 for field in percent_grouping:
                     key = getattr(obj, field)
@@ -526,7 +548,7 @@ def get_stat_data(fields, geo, session, order_by=None,
                     group_key = group_key + (key,)
 
                 data['_group_key'] = group_key
-                group_totals[group_key] = group_totals.get(group_key, 0) + obj.total
+                group_totals[group_key] = group_totals.get(group_key, 0) + value
 
     if grand_total == -1:
         grand_total = running_total if total is None else total
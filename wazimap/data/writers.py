@@ -0,0 +1,145 @@
+""" Writers for data downloads that don't need GDAL.
+
+Each writer takes a list of column names and an iterable of rows, and writes
+them to a file one row at a time, so that large downloads don't need to be
+held in memory.
+"""
+import json
+import math
+import os
+import re
+import zipfile
+from collections import OrderedDict
+from itertools import chain, izip
+from xml.sax.saxutils import escape, quoteattr
+
+import unicodecsv
+
+
+def write_csv(path, header, rows):
+    """ Write +header+ and +rows+ to a CSV file at +path+. None values are left blank.
+    """
+    with open(path, 'wb') as f:
+        writer = unicodecsv.writer(f, encoding='utf-8')
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(['' if v is None else v for v in row])
+
+
+def write_geojson(path, header, rows, geometries):
+    """ Write a GeoJSON feature collection to +path+, with a feature for each of
+    +rows+, with properties named by +header+. +geometries+ is an iterable of a
+    GeoJSON-like geometry dict, or None, for each row.
+    """
+    with open(path, 'wb') as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        sep = '\n'
+        for row, geometry in izip(rows, geometries):
+            feature = OrderedDict([
+                ('type', 'Feature'),
+                ('properties', OrderedDict(izip(header, row))),
+                ('geometry', geometry),
+            ])
+            f.write(sep + json.dumps(feature))
+            sep = ',\n'
+        f.write('\n]}\n')
+
+
+# characters that Excel doesn't allow in sheet names
+BAD_SHEET_CHARS = re.compile(r'[\[\]:*?/\\]')
+# characters that aren't allowed in XML
+BAD_XML_CHARS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+XLSX_FILES = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'),
+    'xl/_rels/workbook.xml.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'),
+}
+
+XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name=%s sheetId="1" r:id="rId1"/></sheets>'
+    '</workbook>')
+
+
+def column_letter(i):
+    """ The Excel column letter for the zero-based column +i+, such as A, Z or AA.
+    """
+    letters = ''
+    i += 1
+    while i:
+        i, rem = divmod(i - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+
+def xlsx_cell(ref, value):
+    # Excel can't store NaN or infinity as numbers
+    if value is None or (isinstance(value, float) and (math.isnan(value) or math.isinf(value))):
+        return ''
+    if isinstance(value, float):
+        return '<c r="%s"><v>%r</v></c>' % (ref, value)
+    if isinstance(value, (int, long)) and not isinstance(value, bool):
+        return '<c r="%s"><v>%d</v></c>' % (ref, value)
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf-8')
+    value = escape(BAD_XML_CHARS.sub(u'', value)).encode('utf-8')
+    return '<c r="%s" t="inlineStr"><is><t>%s</t></is></c>' % (ref, value)
+
+
+def write_xlsx(path, header, rows, sheet_name='Sheet1'):
+    """ Write +header+ and +rows+ to a single-sheet Excel workbook at +path+.
+
+    The sheet is written to a temporary file next to +path+ first, so that
+    the rows don't have to be held in memory.
+    """
+    sheet_name = BAD_SHEET_CHARS.sub('_', sheet_name)[:31] or 'Sheet1'
+    if not isinstance(sheet_name, unicode):
+        sheet_name = sheet_name.decode('utf-8')
+
+    sheet_path = path + '.sheet.xml'
+    letters = [column_letter(i) for i in xrange(len(header))]
+
+    try:
+        with open(sheet_path, 'wb') as f:
+            f.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+
+            for r, row in enumerate(chain([header], rows), 1):
+                cells = ''.join(xlsx_cell('%s%d' % (letter, r), value) for letter, value in zip(letters, row))
+                f.write('<row r="%d">%s</row>\n' % (r, cells))
+
+            f.write('</sheetData></worksheet>')
+
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zfile:
+            for name, content in sorted(XLSX_FILES.iteritems()):
+                zfile.writestr(name, content)
+            zfile.writestr('xl/workbook.xml', XLSX_WORKBOOK % quoteattr(sheet_name).encode('utf-8'))
+            zfile.write(sheet_path, 'xl/worksheets/sheet1.xml')
+    finally:
+        if os.path.exists(sheet_path):
+            os.remove(sheet_path)
+
@@ -0,0 +1,98 @@
+""" Writing zip archives as a stream of bytes, such as a streaming response,
+without holding the archive in memory or seeking back into it.
+
+The size and CRC of each file are only known once it has been compressed,
+so they're written in a data descriptor after the file's data, rather than
+in the header before it. Archives are not ZIP64, so each file and the whole
+archive must be smaller than 4GB.
+"""
+import os
+import stat
+import struct
+import time
+import zlib
+
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHLLLHH')
+DATA_DESCRIPTOR = struct.Struct('<4sLLL')
+CENTRAL_HEADER = struct.Struct('<4sHHHHHHLLLHHHHHLL')
+END_RECORD = struct.Struct('<4sHHHHLLH')
+
+VERSION = 20
+# made on Unix, so that unzip uses the permissions in the external attributes
+VERSION_MADE_BY = 3 << 8 | VERSION
+# bit 3: sizes and CRC are in the data descriptor
+FLAGS = 0x08
+# bit 11: the name is UTF-8
+UTF8_FLAG = 0x800
+DEFLATED = 8
+# a regular file, readable by everyone
+EXTERNAL_ATTR = (stat.S_IFREG | 0o644) << 16
+
+
+def dos_date_time(timestamp):
+    t = time.localtime(timestamp)
+    date = (max(t.tm_year, 1980) - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return date, dos_time
+
+
+def iter_zip(files, chunk_size=64 * 1024):
+    """ Zip +files+, an iterable of (path, name in archive) tuples, yielding the
+    archive in pieces. Files are read +chunk_size+ bytes at a time.
+    """
+    entries = []
+    offset = 0
+
+    for path, arcname in files:
+        if not isinstance(arcname, unicode):
+            arcname = arcname.decode('utf-8')
+        flags = FLAGS
+        try:
+            arcname = arcname.encode('ascii')
+        except UnicodeEncodeError:
+            arcname = arcname.encode('utf-8')
+            flags |= UTF8_FLAG
+        date, dos_time = dos_date_time(os.path.getmtime(path))
+
+        header = LOCAL_HEADER.pack('PK\x03\x04', VERSION, flags, DEFLATED, dos_time, date, 0, 0, 0, len(arcname), 0)
+        yield header + arcname
+        header_offset = offset
+        offset += len(header) + len(arcname)
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                data = compressor.compress(data)
+                if data:
+                    compressed_size += len(data)
+                    yield data
+
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xffffffff
+
+        descriptor = DATA_DESCRIPTOR.pack('PK\x07\x08', crc, compressed_size, size)
+        yield data + descriptor
+        offset += compressed_size + len(descriptor)
+
+        entries.append((arcname, flags, dos_time, date, crc, compressed_size, size, header_offset))
+
+    directory = []
+    for arcname, flags, dos_time, date, crc, compressed_size, size, header_offset in entries:
+        directory.append(CENTRAL_HEADER.pack(
+            'PK\x01\x02', VERSION_MADE_BY, VERSION, flags, DEFLATED, dos_time, date, crc, compressed_size, size,
+            len(arcname), 0, 0, 0, 0, EXTERNAL_ATTR, header_offset))
+        directory.append(arcname)
+    directory = ''.join(directory)
+
+    yield directory + END_RECORD.pack('PK\x05\x06', 0, 0, len(entries), len(entries), len(directory), offset, 0)
@@ -0,0 +1,226 @@
+""" Track the tables and geographies that cached responses are built from,
+so that they can be invalidated precisely when data changes.
+
+While a response is built inside +recording()+, the data helpers record the
+(table id, geo id, geo version) tuples they touch. Each dependency has a
+version counter in the Django cache, and +cache_set()+ stores a response
+under a key that includes the versions of all its dependencies.
++invalidate()+ bumps the counters for the changed data, so that
++cache_get()+ no longer finds the responses that depend on it, and they
+expire from the cache in time.
+
+Counters are only ever incremented, so invalidating doesn't race with
+responses being cached. Run ``bump_data_version`` to invalidate everything.
+"""
+import hashlib
+import logging
+import random
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from itertools import product
+
+from django.core.cache import cache
+
+from wazimap import cdn
+from wazimap.cache import get_data_version, mark_invalidated
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# stands in for "any table" or "any geography" in index keys
+ANY = '*'
+
+
+class Dependencies(object):
+    """ The (table id, geo id, geo version) tuples that a response depends on.
+    The table id is None for geography details that don't come from a table.
+    """
+    def __init__(self):
+        self.items = set()
+
+    def add(self, table_id, geos):
+        table_id = table_id.upper() if table_id else None
+        for geo in geos:
+            self.items.add((table_id, geo.geoid, geo.version))
+
+    def version_keys(self):
+        """ The keys of the version counters that a response with these dependencies depends on.
+        """
+        keys = set()
+        for table_id, geoid, version in self.items:
+            keys.add(version_key(ANY, geoid))
+            if table_id:
+                keys.add(version_key(table_id, ANY))
+                keys.add(version_key(table_id, geoid))
+        return keys
+
+    def __len__(self):
+        return len(self.items)
+
+
+@contextmanager
+def recording():
+    """ Record the dependencies of everything built inside this context.
+    Recordings can be nested, in which case the outer recording also
+    gets the dependencies recorded by the inner one.
+    """
+    stack = _recorders()
+    deps = Dependencies()
+    stack.append(deps)
+    try:
+        yield deps
+    finally:
+        stack.pop()
+        if stack:
+            stack[-1].items.update(deps.items)
+
+
+def record(table, geos):
+    """ Record that +table+ (a table object, table id or None) was used for +geos+.
+    Does nothing if nothing is being recorded.
+    """
+    stack = _recorders()
+    if stack:
+        stack[-1].add(getattr(table, 'id', table), geos)
+
+
+def record_items(items):
+    """ Record dependency tuples +items+, such as those of a cached value that
+    is used in a response. Does nothing if nothing is being recorded.
+    """
+    stack = _recorders()
+    if stack:
+        stack[-1].items.update(items)
+
+
+def current():
+    """ The dependencies being recorded in this thread, or None if nothing is being recorded.
+    """
+    stack = _recorders()
+    return stack[-1] if stack else None
+
+
+def propagate(func):
+    """ Wrap +func+ so that when it's called in another thread, it records
+    dependencies into the recording that's active in this thread.
+    """
+    stack = _recorders()
+    if not stack:
+        return func
+    deps = stack[-1]
+
+    @wraps(func)
+    def wrapped(*args, **kwargs):
+        stack = _recorders()
+        stack.append(deps)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+
+    return wrapped
+
+
+def _recorders():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def version_key(table_id, geoid):
+    return 'wazimap.deps.%s.%s' % (get_data_version().version, hashlib.md5('%s|%s' % (table_id, geoid)).hexdigest())
+
+
+def get_versions(keys):
+    """ The current value of each of the version counters in +keys+.
+
+    Counters that don't exist yet, or that have been evicted from the cache,
+    start at a random value, so that responses cached before a counter was
+    evicted don't become valid again.
+    """
+    versions = cache.get_many(keys)
+    missing = dict((k, random.getrandbits(48)) for k in keys if k not in versions)
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return versions
+
+
+def versioned_key(cache_key, versions):
+    """ The key that a response is stored under, for these versions of its dependencies.
+    """
+    return '%s.%s' % (cache_key, hashlib.md5(repr(sorted(versions.iteritems()))).hexdigest())
+
+
+def cache_get(cache_key):
+    """ Get a value stored with +cache_set+, or None if it isn't cached or any
+    of its dependencies have been invalidated since it was stored.
+
+    The value's dependencies are added to the dependencies being recorded,
+    so that a response that includes it is invalidated along with it.
+    """
+    items = cache.get(cache_key)
+    if items is None:
+        return None
+
+    deps = Dependencies()
+    deps.items = items
+    value = cache.get(versioned_key(cache_key, get_versions(deps.version_keys())))
+
+    if value is not None:
+        record_items(items)
+    return value
+
+
+def cache_set(cache_key, value, deps, timeout):
+    """ Cache +value+ under +cache_key+, for the current versions of +deps+,
+    a +Dependencies+ object.
+    """
+    versions = get_versions(deps.version_keys())
+    cache.set_many({
+        cache_key: deps.items,
+        versioned_key(cache_key, versions): value,
+    }, timeout)
+
+
+def invalidate(tables=None, geos=None, purge_cdn=True):
+    """ Invalidate cached responses that depend on data for +tables+ and +geos+.
+
+    If both are given, only responses that use one of the tables for one of the
+    geographies are invalidated. If only one is given, all responses that use
+    those tables, or data for those geographies, are invalidated.
+
+    Unless +purge_cdn+ is False, content that depends on the tables or the
+    geographies is also purged from the CDN, with ``wazimap.cdn.purge``.
+
+    :param list tables: table ids or table objects
+    :param list geos: geo ids, such as ``province-WC``, or geo objects
+
+    :return: the number of dependency versions that were changed
+    """
+    table_ids = [getattr(t, 'id', t).upper() for t in tables or []] or [ANY]
+    geoids = [getattr(g, 'geoid', g) for g in geos or []] or [ANY]
+    if table_ids == [ANY] and geoids == [ANY]:
+        return 0
+
+    count = 0
+    for table_id, geoid in product(table_ids, geoids):
+        try:
+            cache.incr(version_key(table_id, geoid))
+            count += 1
+        except ValueError:
+            # nothing has been cached with this dependency since the counter was evicted
+            pass
+
+    log.info("Invalidated %d dependencies" % count)
+    # change the ETags of data views, so that clients don't keep their stale copies
+    mark_invalidated()
+
+    # only once our own cache is invalidated, so that the CDN doesn't fetch stale responses
+    if purge_cdn:
+        cdn.purge(geos=geos, tables=tables)
+
+    return count
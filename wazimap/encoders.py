@@ -0,0 +1,122 @@
+""" JSON encoding for Wazimap's API responses and pages.
+
+Responses are encoded with the class set in the ``json_encoder`` setting,
+which defaults to +JSONEncoder+. That uses the C-accelerated encoder from
+the standard library when it's available, encodes Decimals as numbers and
+includes pre-encoded +RawJSON+ fragments as they are.
+"""
+import json
+import re
+import uuid
+from decimal import Decimal
+from types import GeneratorType
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils.module_loading import import_string
+
+from wazimap.data.utils import native_number
+
+
+class RawJSON(object):
+    """ JSON that has already been encoded, such as details of a geography or
+    a table that are included in many responses. Encoders that support it
+    include +encoded+ in their output without encoding it again.
+    """
+    __slots__ = ['encoded']
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+    def __repr__(self):
+        return 'RawJSON(%r)' % self.encoded
+
+
+class JSONEncoder(DjangoJSONEncoder):
+    """ Like DjangoJSONEncoder, but encodes Decimals as numbers, encodes
+    mappings such as profile stats as objects, and supports +RawJSON+ fragments.
+
+    Fragments are first encoded as placeholder strings which are then replaced
+    with the fragment, so that the C encoder can still be used for the rest.
+    """
+    def __init__(self, *args, **kwargs):
+        super(JSONEncoder, self).__init__(*args, **kwargs)
+        self.fragments = []
+        self.token = uuid.uuid4().hex
+        self.placeholder_re = re.compile(r'"%s-(\d+)"' % self.token)
+
+    def default(self, o):
+        if isinstance(o, RawJSON):
+            self.fragments.append(o.encoded)
+            return '%s-%d' % (self.token, len(self.fragments) - 1)
+
+        if isinstance(o, Decimal):
+            return native_number(o)
+
+        return super(JSONEncoder, self).default(o)
+
+    def iterencode(self, o, _one_shot=False):
+        for chunk in super(JSONEncoder, self).iterencode(o, _one_shot):
+            if self.fragments:
+                chunk = self.placeholder_re.sub(lambda m: self.fragments[int(m.group(1))], chunk)
+            yield chunk
+
+
+_encoder_class = None
+
+
+def get_encoder_class():
+    """ The JSON encoder class from the ``json_encoder`` setting.
+    """
+    global _encoder_class
+    if _encoder_class is None:
+        _encoder_class = import_string(settings.WAZIMAP.get('json_encoder', 'wazimap.encoders.JSONEncoder'))
+    return _encoder_class
+
+
+def dumps(obj, **kwargs):
+    """ Encode +obj+ as JSON with the configured encoder.
+    """
+    return json.dumps(obj, cls=get_encoder_class(), **kwargs)
+
+
+def render_json_to_response(data):
+    """ Render +data+ as a JSON response.
+    """
+    return HttpResponse(dumps(data), content_type='application/javascript')
+
+
+def iterdumps_object(pairs, buffer_size=64 * 1024):
+    """ Encode the (key, value) pairs from the iterable +pairs+ as a JSON object,
+    yielding the JSON in pieces of about +buffer_size+ bytes. Values that are
+    generators of pairs are encoded as objects in the same way, so that large
+    responses never have to be held in memory in full.
+    """
+    buf = []
+    size = 0
+
+    for piece in _iterdumps_object(pairs):
+        buf.append(piece)
+        size += len(piece)
+        if size >= buffer_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+
+    if buf:
+        yield ''.join(buf)
+
+
+def _iterdumps_object(pairs):
+    yield '{'
+    sep = ''
+    for key, value in pairs:
+        yield sep + dumps(key) + ': '
+        if isinstance(value, GeneratorType):
+            for piece in _iterdumps_object(value):
+                yield piece
+        else:
+            yield dumps(value)
+        sep = ', '
+    yield '}'
@@ -0,0 +1,329 @@
+import errno
+import gzip
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from multiprocessing import Pool
+from urlparse import urlparse
+
+from django.conf import settings
+from django.http import FileResponse
+from django.utils.cache import patch_vary_headers, patch_response_headers
+
+from wazimap.cache import get_data_version
+from wazimap.cdn import add_surrogate_keys
+
+
+log = logging.getLogger(__name__)
+
+# content that changes on every render and must be ignored when
+# checking if an exported file has changed
+VOLATILE_CONTENT = re.compile(r'<!-- Page generated: [^>]* -->')
+
+
+def profile_page_path(geo_id, slug):
+    """ Path of an exported profile page, relative to the export directory.
+    """
+    if slug:
+        return 'profiles/%s-%s/index.html' % (geo_id, slug)
+    return 'profiles/%s/index.html' % geo_id
+
+
+def profile_json_path(geo_id):
+    """ Path of an exported profile JSON file, relative to the export directory.
+    """
+    return 'profiles/%s.json' % geo_id
+
+
+def embed_json_path(geo_id):
+    """ Path of the exported embed data for a geography, relative to the export directory.
+    """
+    return 'embed_data/' + profile_json_path(geo_id)
+
+
+def exported_response(request, rel_path, content_type):
+    """ Return a response that serves the exported file at +rel_path+, or None
+    if static exports aren't configured, the file doesn't exist or it was
+    exported for an older data version.
+
+    Exports are only ever built with default parameters, so requests
+    with a query string are never served from the export.
+    """
+    root = settings.WAZIMAP.get('static_export_dir')
+    if not root or request.GET or not is_current_export(rel_path):
+        return None
+
+    path = os.path.join(root, rel_path)
+    accepts_gzip = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+
+    try:
+        if accepts_gzip and os.path.exists(path + '.gz'):
+            response = FileResponse(open(path + '.gz', 'rb'), content_type=content_type)
+            response['Content-Encoding'] = 'gzip'
+        else:
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise e
+
+    patch_vary_headers(response, ['Accept-Encoding'])
+    patch_response_headers(response, settings.WAZIMAP['cache_secs'])
+    return add_surrogate_keys(response, exported_surrogate_keys(rel_path))
+
+
+def exported_metadata(rel_path):
+    """ The data version and the surrogate keys of the response that the
+    exported file at +rel_path+ was rendered from, as a (version, keys)
+    tuple. The version is None if they weren't stored.
+
+    They're stored in a ``.meta`` file next to the exported file, with the
+    version on the first line and the keys on the second.
+    """
+    root = settings.WAZIMAP.get('static_export_dir')
+    content = read_exported_file(os.path.join(root, rel_path + '.meta')) if root else None
+    if not content:
+        return None, []
+
+    lines = content.split('\n')
+    return lines[0], (lines[1] if len(lines) > 1 else '').split()
+
+
+def exported_surrogate_keys(rel_path):
+    """ The surrogate keys of the response that the exported file at +rel_path+
+    was rendered from, or an empty list if they weren't stored.
+    """
+    return exported_metadata(rel_path)[1]
+
+
+def is_current_export(rel_path):
+    """ Whether the exported file at +rel_path+ was rendered for the current data version.
+    """
+    return exported_metadata(rel_path)[0] == get_data_version().version
+
+
+def read_exported(rel_path):
+    """ Return the content of the exported file at +rel_path+, or None
+    if static exports aren't configured, the file doesn't exist or it was
+    exported for an older data version.
+    """
+    root = settings.WAZIMAP.get('static_export_dir')
+    if not root or not is_current_export(rel_path):
+        return None
+    return read_exported_file(os.path.join(root, rel_path))
+
+
+def read_exported_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise e
+
+
+class ProfileExporter(object):
+    """ Renders profile pages, profile JSON and embed data to a directory tree
+    that can be served by a plain web server or CDN, without Python.
+
+    Files are only re-written when their content changes, and each file
+    gets a precompressed ``.gz`` sibling. The data version that each file
+    was rendered for is stored in a ``.meta`` sibling, so that Wazimap
+    doesn't serve files from before the data version was bumped.
+    """
+    def __init__(self, root, compress=True):
+        self.root = root
+        self.compress = compress
+
+        from django.test import RequestFactory
+        self.request_factory = RequestFactory(HTTP_HOST=urlparse(settings.WAZIMAP['url']).netloc or 'localhost')
+
+    def geographies(self, levels=None):
+        """ The (geo_level, geo_code) pairs of geographies to export. Only the
+        version of each geography that is served by default is exported.
+        """
+        from wazimap.geo import geo_data
+
+        query = geo_data.geo_model.objects.all()
+        if levels:
+            query = query.filter(geo_level__in=levels)
+        if geo_data.default_version is not None:
+            query = query.filter(version=geo_data.default_version)
+
+        return sorted(set(query.values_list('geo_level', 'geo_code')))
+
+    def export(self, levels=None, processes=4):
+        """ Export all geographies, returning a tuple of (files written, files unchanged).
+        """
+        from django.db import connections
+        from wazimap.data.utils import _engine
+
+        self.export_embed_iframe()
+        geos = self.geographies(levels)
+
+        # connections mustn't be shared with the worker processes
+        connections.close_all()
+        _engine.dispose()
+
+        written = unchanged = 0
+        pool = Pool(processes, initializer=_init_worker, initargs=(self.root, self.compress))
+        try:
+            for w, u in pool.imap_unordered(_export_geo, geos):
+                written += w
+                unchanged += u
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        return written, unchanged
+
+    def export_embed_iframe(self):
+        from django.views.generic import TemplateView
+
+        view = TemplateView.as_view(template_name="embed/iframe.html")
+        response = self.render(view, '/embed/iframe.html')
+        return self.write('embed/iframe.html', response.content)
+
+    def export_geo(self, geo_level, geo_code):
+        """ Export the profile page and JSON for a single geography. Returns a
+        list of booleans indicating whether each file was written.
+        """
+        from wazimap.geo import geo_data
+        from wazimap.views import GeographyDetailView, GeographyJsonView
+
+        geo_id = '%s-%s' % (geo_level, geo_code)
+        geo = geo_data.get_geography(geo_code, geo_level)
+        results = []
+
+        page_url = '/profiles/%s-%s/' % (geo_id, geo.slug) if geo.slug else '/profiles/%s/' % geo_id
+        # exported pages can't load sections from the server
+        view = GeographyDetailView.as_view(serve_exported=False, progressive=False)
+        response = self.render(view, page_url, geography_id=geo_id, slug=geo.slug or None)
+        if response is not None:
+            results.append(self.write(profile_page_path(geo_id, geo.slug), response.content))
+            self.write_metadata(profile_page_path(geo_id, geo.slug), response)
+
+        view = GeographyJsonView.as_view(serve_exported=False)
+        response = self.render(view, '/profiles/%s.json' % geo_id, geography_id=geo_id, slug=None)
+        if response is not None:
+            for rel_path in [profile_json_path(geo_id), embed_json_path(geo_id)]:
+                results.append(self.write(rel_path, response.content))
+                self.write_metadata(rel_path, response)
+
+        return results
+
+    def render(self, view, url, **kwargs):
+        """ Render +view+ for +url+ and return the rendered response, or None
+        if the view didn't return a 200 response.
+        """
+        response = view(self.request_factory.get(url), **kwargs)
+        if hasattr(response, 'render'):
+            response.render()
+
+        if response.status_code != 200:
+            log.warn("Skipping export of %s, status code was %s" % (url, response.status_code))
+            return None
+
+        return response
+
+    def write(self, rel_path, content):
+        """ Write +content+ to +rel_path+ if it differs from what is already there.
+        Returns True if the file was written.
+        """
+        path = os.path.join(self.root, rel_path)
+        digest = content_digest(content)
+
+        if file_digest(path) == digest and (not self.compress or os.path.exists(path + '.gz')):
+            return False
+
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError as e:
+                # another worker may have beaten us to it
+                if e.errno != errno.EEXIST:
+                    raise e
+
+        atomic_write(path, content)
+        if self.compress:
+            atomic_write(path + '.gz', content, compress=True)
+
+        return True
+
+    def write_metadata(self, rel_path, response):
+        """ Store the data version and the surrogate keys of +response+ next to the
+        exported file at +rel_path+, see +exported_metadata+. Wazimap only serves
+        the file for this data version, and sends the keys with it.
+
+        An unchanged file isn't re-written when the data version changes, so
+        this must be called after each export of a file, even if it wasn't written.
+        """
+        header = settings.WAZIMAP.get('surrogate_key_header', 'Surrogate-Key')
+        keys = response[header] if header and response.has_header(header) else ''
+
+        path = os.path.join(self.root, rel_path + '.meta')
+        content = '%s\n%s' % (get_data_version().version, keys)
+        if read_exported_file(path) != content:
+            atomic_write(path, content)
+
+
+def content_digest(content):
+    """ SHA1 digest of +content+, ignoring parts that change on every render.
+    """
+    return hashlib.sha1(VOLATILE_CONTENT.sub('', content)).hexdigest()
+
+
+def file_digest(path):
+    """ Content digest of the file at +path+, or None if it doesn't exist.
+    """
+    content = read_exported_file(path)
+    if content is None:
+        return None
+    return content_digest(content)
+
+
+def atomic_write(path, content, compress=False):
+    """ Write +content+ to a temporary file and move it into place, so that
+    readers never see a partially written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if compress:
+                # a fixed mtime ensures identical content produces identical files
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gz:
+                    gz.write(content)
+            else:
+                f.write(content)
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.unlink(tmp_path)
+        raise
+
+
+# per-process exporter used by the worker pool
+_worker_exporter = None
+
+
+def _init_worker(root, compress):
+    global _worker_exporter
+    _worker_exporter = ProfileExporter(root, compress)
+
+
+def _export_geo(geo):
+    try:
+        results = _worker_exporter.export_geo(*geo)
+    except Exception as e:
+        log.error("Error exporting %s-%s: %s" % (geo[0], geo[1], e), exc_info=e)
+        return 0, 0
+
+    written = sum(1 for r in results if r)
+    return written, len(results) - written
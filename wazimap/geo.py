@@ -9,6 +9,7 @@ from django.db.models import Q
 from django.contrib.staticfiles.storage import staticfiles_storage
 
 from wazimap.data.utils import LocationNotFound
+from wazimap.dependencies import record as record_dependency
 from wazimap.models import Geography
 
 log = logging.getLogger(__name__)
@@ -230,6 +231,7 @@ class GeoData(object):
         geo = query.first()
         if not geo:
             raise LocationNotFound("Invalid level, code and version: %s-%s '%s'" % (geo_level, geo_code, version))
+        record_dependency(None, [geo])
         return geo
 
     def get_geometry(self, geo):
@@ -239,6 +241,43 @@ class GeoData(object):
         """
         return self.geometry.get(geo.version, {}).get(geo.geo_level, {}).get(geo.geo_code)
 
+    def get_geometry_wkb(self, geo, simplify=None):
+        """ The geometry of a geography as WKB, ready to be exported, or None
+        if it doesn't have one.
+
+        If +simplify+ is the name of a tolerance in the ``download_simplify_tolerances``
+        setting, the geometry is simplified with that tolerance. The WKB is cached,
+        so each geometry is only converted and simplified once.
+        """
+        return self.get_geometry_wkbs([geo], simplify)[geo.geoid]
+
+    def get_geometry_wkbs(self, geos, simplify=None):
+        """ The geometries of +geos+ as WKB, like +get_geometry_wkb+, as a dict
+        from geoid to WKB. The cache is checked and filled in a single request each.
+        """
+        from wazimap.cache import geometry_cache
+
+        keys = dict(('geo.wkb.%s.%s.%s' % (geo.geoid, geo.version, simplify or 'full'), geo) for geo in geos)
+        cached = geometry_cache.get_many(keys.keys())
+
+        built = dict((key, self._geometry_wkb(geo, simplify)) for key, geo in keys.iteritems() if key not in cached)
+        if built:
+            geometry_cache.set_many(built)
+        cached.update(built)
+
+        return dict((geo.geoid, cached[key]) for key, geo in keys.iteritems())
+
+    def _geometry_wkb(self, geo, simplify):
+        details = self.get_geometry(geo)
+        shape = details and details['shape']
+        if not shape:
+            return None
+
+        if simplify:
+            tolerance = settings.WAZIMAP['download_simplify_tolerances'][simplify]
+            shape = shape.simplify(tolerance, preserve_topology=True)
+        return shape.wkb
+
     def get_locations(self, search_term, levels=None, version=None):
         """
         Try to find locations based on a search term, possibly limited
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from wazimap.cache import bump_data_version
+
+
+class Command(BaseCommand):
+    help = ("Changes the data version, which invalidates cached profile and data API responses. "
+            "Run this after loading new data. This doesn't purge the CDN, use purge_cdn for that.")
+
+    def handle(self, *args, **options):
+        data_version = bump_data_version()
+        self.stdout.write("Data version is now %s" % data_version.version)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from wazimap.cache import published_counters
+
+
+class Command(BaseCommand):
+    help = ("Prints Wazimap's cache and request counters, such as cache hits and misses, "
+            "totalled across all processes that have published their counts.")
+
+    def handle(self, *args, **options):
+        # make sure all counters are registered
+        import wazimap.middleware  # noqa
+
+        for name, counters in sorted(published_counters.iteritems()):
+            totals = counters.published()
+            for stat in counters.stats:
+                self.stdout.write("%s %s: %d" % (name, stat, totals[stat]))
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.export import ProfileExporter
+
+
+class Command(BaseCommand):
+    help = ("Renders every profile page, profile JSON and embed data to a directory, "
+            "along with precompressed .gz versions, so they can be served without Python.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'export_dir', nargs='?', default=None,
+            help="Directory to export to. Default: WAZIMAP['static_export_dir']")
+        parser.add_argument(
+            '--levels', default=None,
+            help="Comma-separated list of geo levels to export. Default: all levels")
+        parser.add_argument(
+            '--processes', type=int, default=4,
+            help="Number of geographies to render in parallel. Default: 4")
+        parser.add_argument(
+            '--no-gzip', action='store_false', dest='compress', default=True,
+            help="Don't write precompressed .gz files")
+
+    def handle(self, *args, **options):
+        export_dir = options['export_dir'] or settings.WAZIMAP.get('static_export_dir')
+        if not export_dir:
+            raise CommandError("Specify an export directory or set WAZIMAP['static_export_dir'] in settings.py")
+
+        levels = None
+        if options['levels']:
+            levels = [lev.strip() for lev in options['levels'].split(',') if lev.strip()]
+
+        exporter = ProfileExporter(export_dir, compress=options['compress'])
+        written, unchanged = exporter.export(levels=levels, processes=options['processes'])
+
+        self.stdout.write("Exported to %s: %d files written, %d unchanged" % (export_dir, written, unchanged))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.dependencies import invalidate
+from wazimap.management.commands.purge_cdn import split_list
+
+
+class Command(BaseCommand):
+    help = ("Invalidates cached profile and data API responses that depend on particular tables "
+            "or geographies, and purges them from the CDN. Run this after reloading data for just those "
+            "tables or geographies.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--geos', help="Comma-separated list of geo ids, such as province-WC")
+        parser.add_argument('--tables', help="Comma-separated list of table ids")
+
+    def handle(self, *args, **options):
+        geos = split_list(options['geos'])
+        tables = split_list(options['tables'])
+
+        if not (geos or tables):
+            raise CommandError("Specify at least one of --geos or --tables")
+
+        count = invalidate(tables=tables, geos=geos)
+        self.stdout.write("Invalidated cached responses for %d dependencies" % count)
@@ -0,0 +1,123 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import RequestFactory
+
+from wazimap.data.download import DownloadManager, get_download_cache
+from wazimap.data.tables import DATA_TABLES, get_datatable
+from wazimap.geo import geo_data
+
+
+class Command(BaseCommand):
+    help = ("Generates download bundles for every table for the root geography and for each "
+            "level below it, and stores them in WAZIMAP['download_cache_dir']. Also caches "
+            "their geometries at each of WAZIMAP['download_simplify_tolerances'].")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--tables', default=None,
+            help="Comma-separated list of table ids to generate downloads for. Default: all tables")
+        parser.add_argument(
+            '--levels', default=None,
+            help="Comma-separated list of geo levels to generate downloads for. Default: all levels")
+        parser.add_argument(
+            '--formats', default='csv,xlsx',
+            help="Comma-separated list of download formats. Default: csv,xlsx")
+        parser.add_argument(
+            '--simplify', default=None,
+            help="Comma-separated list of download_simplify_tolerances to generate downloads with geometries "
+                 "for, as well as full precision. Default: none")
+        parser.add_argument(
+            '--prune', action='store_true', default=False,
+            help="Remove downloads that were generated for older data versions")
+
+    def handle(self, *args, **options):
+        from wazimap.views import DataAPIView
+
+        cache = get_download_cache()
+        if not cache:
+            raise CommandError("Set WAZIMAP['download_cache_dir'] in settings.py")
+
+        if options['prune']:
+            self.stdout.write("Removed %d old data versions" % cache.prune())
+
+        formats = self.split(options['formats'])
+        for fmt in formats:
+            if fmt not in DownloadManager.DOWNLOAD_FORMATS:
+                raise CommandError("Unsupported format: %s" % fmt)
+
+        tolerances = settings.WAZIMAP.get('download_simplify_tolerances') or {}
+        simplify = self.split(options['simplify'])
+        for name in simplify:
+            if name not in tolerances:
+                raise CommandError("Unknown simplification: %s" % name)
+
+        try:
+            tables = [get_datatable(t) for t in self.split(options['tables']) or sorted(DATA_TABLES.iterkeys())]
+        except KeyError as e:
+            raise CommandError("Unknown table: %s" % e.message)
+        levels = self.split(options['levels'])
+
+        root = geo_data.root_geography()
+        geo_ids = [root.geoid] + [
+            '%s|%s' % (level, root.geoid)
+            for level, info in sorted(geo_data.geo_levels.iteritems())
+            if geo_data.root_level in info.get('ancestors', [])]
+        if levels:
+            geo_ids = [g for g in geo_ids if g.split('|')[0].split('-')[0] in levels]
+
+        factory = RequestFactory()
+        view = DataAPIView.as_view(queue_downloads=False)
+        api = DataAPIView()
+        generated = cached = 0
+
+        for geo_id in geo_ids:
+            data_geos, _ = api.get_geos([geo_id], None)
+            if not data_geos:
+                continue
+
+            # simplify and cache the geometries at every tolerance up front, so that
+            # downloads don't have to do it when they're first asked for
+            self.stdout.write("Caching geometries for %s" % geo_id)
+            for variant in [None] + sorted(tolerances):
+                geo_data.get_geometry_wkbs(data_geos, variant)
+
+            for table in tables:
+                for fmt in formats:
+                    variants = [None]
+                    if DownloadManager.DOWNLOAD_FORMATS[fmt]['geometry']:
+                        variants.extend(simplify)
+
+                    for variant in variants:
+                        if cache.get(cache.key([table], data_geos, fmt, variant)):
+                            cached += 1
+                            continue
+
+                        self.stdout.write("Generating %s for %s as %s%s" % (
+                            table.id, geo_id, fmt, ' simplified %s' % variant if variant else ''))
+                        params = {
+                            'table_ids': table.id,
+                            'geo_ids': geo_id,
+                            'format': fmt,
+                        }
+                        if variant:
+                            params['simplify'] = variant
+
+                        response = view(factory.get('/api/1.0/data/download/latest', params), action='download')
+                        if response.status_code != 200:
+                            self.stderr.write("Failed with status code %s" % response.status_code)
+                            continue
+
+                        # the bundle is cached as it's streamed
+                        if response.streaming:
+                            for chunk in response.streaming_content:
+                                pass
+                        response.close()
+                        generated += 1
+
+        self.stdout.write("Generated %d downloads, %d already generated, in %s" % (
+            generated, cached, settings.WAZIMAP['download_cache_dir']))
+
+    def split(self, value):
+        if not value:
+            return []
+        return [x.strip() for x in value.split(',') if x.strip()]
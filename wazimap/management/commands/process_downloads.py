@@ -0,0 +1,66 @@
+import time
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from wazimap.data.download import (get_download_cache, claim_download_jobs, requeue_stale_download_jobs,
+                                   run_download_job)
+from wazimap.data.utils import _engine
+
+
+class Command(BaseCommand):
+    help = ("Generates downloads that have been queued because they're too large to generate "
+            "while the client waits. See WAZIMAP['download_async_geos'].")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes', type=int, default=2,
+            help="Number of downloads to generate in parallel. Default: 2")
+        parser.add_argument(
+            '--interval', type=float, default=5,
+            help="Seconds to wait before checking for new jobs when the queue is empty. Default: 5")
+        parser.add_argument(
+            '--stale-secs', type=int, default=3600,
+            help="Queue jobs that have been running for longer than this again. Default: 3600")
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help="Exit once the queue is empty, rather than waiting for new jobs")
+
+    def handle(self, *args, **options):
+        if not get_download_cache():
+            raise CommandError("Set WAZIMAP['download_cache_dir'] in settings.py")
+
+        processes = options['processes']
+        self.stdout.write("Processing downloads into %s with %d processes" % (
+            settings.WAZIMAP['download_cache_dir'], processes))
+
+        # connections mustn't be shared with the worker processes
+        connections.close_all()
+        _engine.dispose()
+
+        pool = Pool(processes)
+        try:
+            while True:
+                requeued = requeue_stale_download_jobs(options['stale_secs'])
+                if requeued:
+                    self.stdout.write("Queued %d stale jobs again" % requeued)
+
+                ids = claim_download_jobs(processes)
+                if not ids:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+
+                for job_id, status in zip(ids, pool.map(run_download_job, ids)):
+                    self.stdout.write("Download job %s %s" % (job_id, status))
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
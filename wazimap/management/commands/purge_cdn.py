@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from wazimap.cdn import purge
+
+
+def split_list(value):
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
+
+
+class Command(BaseCommand):
+    help = ("Purges CDN content that depends on particular geographies, tables or datasets. "
+            "Run this after loading new data.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--geos', help="Comma-separated list of geo ids, such as province-WC")
+        parser.add_argument('--tables', help="Comma-separated list of table ids")
+        parser.add_argument('--datasets', help="Comma-separated list of dataset names")
+
+    def handle(self, *args, **options):
+        geos = split_list(options['geos'])
+        tables = split_list(options['tables'])
+        datasets = split_list(options['datasets'])
+
+        if not (geos or tables or datasets):
+            raise CommandError("Specify at least one of --geos, --tables or --datasets")
+
+        keys = purge(geos=geos, tables=tables, datasets=datasets)
+        self.stdout.write("Purged %d surrogate keys: %s" % (len(keys), ' '.join(keys)))
@@ -1,5 +1,10 @@
 from django.conf import settings
+from django.core.urlresolvers import resolve, Resolver404
+from django.http import QueryDict
 from django.http.response import HttpResponsePermanentRedirect
+from django.utils.http import urlquote
+
+from wazimap.cache import PublishedCounters
 
 
 class RedirectMiddleware(object):
@@ -10,3 +15,75 @@ class RedirectMiddleware(object):
         if settings.STRIP_WWW and host.startswith("www."):
             redirect_url = '%s://%s%s' % (request.scheme, host[4:], request.get_full_path())
             return HttpResponsePermanentRedirect(redirect_url)
+
+
+def canonical_list(value, upper=False):
+    """ Sort a comma-separated list, removing blanks and duplicates.
+    """
+    items = (x.strip() for x in value.split(','))
+    if upper:
+        items = (x.upper() for x in items)
+    return ','.join(sorted(set(x for x in items if x)))
+
+
+class CanonicalQueryMiddleware(object):
+    """ Rewrites the query string of data and profile requests into a canonical
+    form, so that equivalent requests share cache entries and ETags.
+
+    Parameters are sorted, lists of table ids, geo ids, columns, profile sections
+    and profile keys are sorted and de-duplicated, table ids are uppercased, and a
+    ``geo_version`` that is blank or is the version the view would use anyway
+    is removed.
+
+    The request is rewritten in place rather than redirected, which avoids an
+    extra round trip. This must come before any middleware that reads the
+    query string.
+    """
+    # url names of views whose requests are canonicalized
+    url_names = ['api_show_data', 'api_children_data', 'geography_detail', 'geography_json', 'geography_section',
+                 'geography_compare_json']
+
+    counters = PublishedCounters('requests.canonical', ['requests', 'collapsed'])
+
+    def process_request(self, request):
+        if request.method not in ('GET', 'HEAD') or not request.META.get('QUERY_STRING'):
+            return
+
+        try:
+            url_name = resolve(request.path_info).url_name
+        except Resolver404:
+            return
+
+        if url_name not in self.url_names:
+            return
+
+        query = self.canonical_query(request.GET, url_name)
+        self.counters.incr('requests')
+
+        if query != request.META['QUERY_STRING']:
+            self.counters.incr('collapsed')
+            request.META['QUERY_STRING'] = query
+            request.GET = QueryDict(query)
+
+    def canonical_query(self, params, url_name):
+        pairs = []
+
+        for key, values in sorted(params.lists()):
+            if key in ('table_ids', 'table_id'):
+                values = [canonical_list(v, upper=True) for v in values]
+            elif key in ('geo_ids', 'columns', 'sections', 'keys'):
+                values = [canonical_list(v) for v in values]
+            elif key == 'geo_version':
+                values = [v for v in values if v and v != self.default_geo_version(url_name)]
+
+            pairs.extend((key, v) for v in values)
+
+        return '&'.join('%s=%s' % (urlquote(k, safe=''), urlquote(v, safe=',|')) for k, v in pairs)
+
+    def default_geo_version(self, url_name):
+        """ The geo version the view uses if the request doesn't specify one,
+        or None if it depends on the geography.
+        """
+        if url_name == 'geography_json' and settings.WAZIMAP.get('legacy_embed_geo_version'):
+            return settings.WAZIMAP['legacy_embed_geo_version']
+        return settings.WAZIMAP.get('default_geo_version')
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import uuid
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wazimap', '0008_auto_20170424_1209'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DownloadJob',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('key', models.CharField(db_index=True, max_length=40)),
+                ('table_ids', models.TextField()),
+                ('geo_ids', models.TextField()),
+                ('geo_version', models.CharField(max_length=100, null=True)),
+                ('format', models.CharField(max_length=20)),
+                ('simplify', models.CharField(max_length=20, null=True)),
+                ('status', models.CharField(choices=[(b'queued', b'queued'), (b'running', b'running'), (b'done', b'done'), (b'failed', b'failed')], db_index=True, default=b'queued', max_length=10)),
+                ('error', models.TextField(null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
@@ -1,5 +1,6 @@
 from collections import OrderedDict
 import itertools
+import uuid
 
 from django.db import models
 from django.utils.text import slugify
@@ -8,6 +9,19 @@ from django.utils.text import slugify
 # Geographies
 class GeoMixin(object):
     def as_dict(self):
+        from wazimap.cache import object_cache
+        # cached values are shared, so always return a copy
+        return dict(object_cache.get_or_set('geo.%s.%s' % (self.geoid, self.version), self._as_dict))
+
+    def as_json(self):
+        """ The same details as +as_dict+, as pre-encoded JSON that can be included in responses.
+        """
+        from wazimap.cache import object_cache
+        from wazimap.encoders import RawJSON, dumps
+        return RawJSON(object_cache.get_or_set('geo.json.%s.%s' % (self.geoid, self.version),
+                                               lambda: dumps(self.as_dict())))
+
+    def _as_dict(self):
         return {
             'full_geoid': self.geoid,
             'full_name': self.full_name,  # profile views use this as a name
@@ -22,9 +36,14 @@ class GeoMixin(object):
         }
 
     def as_dict_deep(self):
+        from wazimap.cache import object_cache
+        parents = object_cache.get_or_set(
+            'geo.parents.%s.%s' % (self.geoid, self.version),
+            lambda: [(p.geo_level, p.as_dict()) for p in self.ancestors()])
+
         return {
             'this': self.as_dict(),
-            'parents': OrderedDict((p.geo_level, p.as_dict()) for p in self.ancestors()),
+            'parents': OrderedDict((level, dict(d)) for level, d in parents),
         }
 
     def children(self):
@@ -145,3 +164,52 @@ class GeographyBase(models.Model, GeoMixin):
 
 class Geography(GeographyBase):
     pass
+
+
+class DownloadJob(models.Model):
+    """ A data download that is generated in the background by the
+    ``process_downloads`` management command, because it's too large to
+    generate while the client waits.
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(s, s) for s in (QUEUED, RUNNING, DONE, FAILED)]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    #: The address of the bundle in the download cache, which identifies
+    #: jobs for the same download.
+    key = models.CharField(max_length=40, db_index=True)
+
+    #: The parameters of the download request.
+    table_ids = models.TextField()
+    geo_ids = models.TextField()
+    geo_version = models.CharField(max_length=100, null=True)
+    format = models.CharField(max_length=20)
+    simplify = models.CharField(max_length=20, null=True)
+
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED, db_index=True)
+    #: Why the job failed, if it did.
+    error = models.TextField(null=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    def params(self):
+        """ The query parameters of the download request.
+        """
+        params = OrderedDict([
+            ('table_ids', self.table_ids),
+            ('geo_ids', self.geo_ids),
+            ('format', self.format),
+        ])
+        if self.geo_version is not None:
+            params['geo_version'] = self.geo_version
+        if self.simplify:
+            params['simplify'] = self.simplify
+        return params
+
+    def __unicode__(self):
+        return '%s %s for %s (%s)' % (self.format, self.table_ids, self.geo_ids, self.status)
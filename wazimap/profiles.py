@@ -1,62 +1,613 @@
-from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, Mapping
+from copy import deepcopy
 from itertools import repeat
+from json.encoder import encode_basestring_ascii
+
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils.module_loading import import_string
 
-from census.profile import find_dicts_with_key
 from census.utils import get_ratio
 
+from wazimap.data.stats import LevelValues, Stat
+from wazimap.data.utils import get_session, merge_dicts
+from wazimap.cache import object_cache
+from wazimap.dependencies import Dependencies, get_versions, propagate, record_items, recording, versioned_key
+from wazimap.encoders import RawJSON, get_encoder_class
 from wazimap.geo import geo_data
 
+# gevent is an optional dependency, only needed for GeventSectionExecutor
+try:
+    import gevent
+    import gevent.monkey
+    import gevent.pool
+    HAS_GEVENT = True
+except ImportError:
+    HAS_GEVENT = False
 
-def enhance_api_data(api_data):
-    dict_list = find_dicts_with_key(api_data, 'values')
-
-    for d in dict_list:
-        raw = {}
-        enhanced = {}
-        geo_value = d['values']['this']
-        num_comparatives = 2
-
-        # create our containers for transformation
-        for obj in ['values', 'error', 'numerators', 'numerator_errors']:
-            if obj not in d:
-                raw[obj] = dict(zip(geo_data.comparative_levels, repeat(0)))
+
+log = logging.getLogger(__name__)
+
+
+# Profile sections, by profile name. Each is an OrderedDict from section name
+# to a function that builds that section.
+PROFILE_SECTIONS = {}
+
+
+def register_section(name, func=None, profile='default'):
+    """ Register +func+ as the function that builds the +name+ section of a profile.
+    Sections are shown in the order they're registered. This can also be used
+    as a decorator::
+
+        @register_section('demographics')
+        def get_demographics_profile(geo, session):
+            ...
+
+    The function is called with a geography and an SQLAlchemy session, and must
+    return a dict of data for that geography. It's also called for each
+    comparative geography, and the results are merged.
+    """
+    if func is None:
+        return lambda f: register_section(name, f, profile)
+
+    PROFILE_SECTIONS.setdefault(profile, OrderedDict())[name] = func
+    return func
+
+
+def get_sections(profile_name='default'):
+    """ An OrderedDict of the sections registered for a profile.
+    """
+    return PROFILE_SECTIONS.get(profile_name, OrderedDict())
+
+
+def build_section(name, geo, profile_name='default', session=None):
+    """ Build the data for a profile section, for +geo+ and its comparative geographies.
+    """
+    return build_section_for_geos(name, [geo], profile_name, session)[0]
+
+
+def build_section_for_geos(name, geos, profile_name='default', session=None):
+    """ Build the data for a profile section for each of +geos+, and their
+    comparative geographies. The section is only built once for each
+    geography, so geographies that share comparatives share the work.
+
+    :return: a list of section data, one for each of +geos+
+    """
+    func = get_sections(profile_name)[name]
+
+    own_session = session is None
+    if own_session:
+        session = get_session()
+
+    try:
+        built = {}
+        comparatives = {}
+
+        def build(geo):
+            key = (geo.geoid, geo.version)
+            if key not in built:
+                built[key] = func(geo, session)
+            return built[key]
+
+        def build_comparative(geo):
+            key = (geo.geoid, geo.version)
+            if key in built:
+                return built[key]
+            if key not in comparatives:
+                comparatives[key] = build_comparative_section(func, name, profile_name, geo, session)
+            return comparatives[key]
+
+        results = []
+        for geo in geos:
+            data = build(geo)
+            if any(data is d for d in results):
+                # the same geo was asked for twice
+                data = deepcopy(data)
+
+            # merging only reads the 'this' values of the comparatives, so they can be shared
+            for comp_geo in geo_data.get_comparative_geos(geo):
+                merge_dicts(data, build_comparative(comp_geo), comp_geo.geo_level)
+            results.append(data)
+
+        return results
+    finally:
+        if own_session:
+            session.close()
+
+
+def build_comparative_section(func, name, profile_name, geo, session):
+    """ Build the data for section +name+ for +geo+, which is used as a
+    comparative geography. Every child of +geo+ needs the same data, so
+    it's kept in +object_cache+, which is tied to the data version.
+
+    Entries are also keyed on the versions of the data the section was
+    built from, as with +wazimap.dependencies.cache_get+, so they're not
+    used once that data has been invalidated. The returned data is shared
+    and must not be changed.
+    """
+    key = 'profile.comparative.%s.%s.%s.%s' % (profile_name, name, geo.geoid, geo.version)
+
+    items = object_cache.get(key)
+    if items is not None:
+        deps = Dependencies()
+        deps.items = items
+        data = object_cache.get(versioned_key(key, get_versions(deps.version_keys())))
+        if data is not None:
+            record_items(items)
+            return data
+
+    with recording() as deps:
+        data = func(geo, session)
+
+    object_cache.set(key, deps.items)
+    object_cache.set(versioned_key(key, get_versions(deps.version_keys())), data)
+    return data
+
+
+def build_profile(geo, profile_name='default', request=None, sections=None, timings=None):
+    """ Build profile data from registered sections. A profile builder
+    that registers its sections can simply return the result of this.
+
+    Sections are built by the executor configured with the ``profile_section_executor``
+    setting, and are always returned in the order they were registered.
+
+    :param list sections: names of the sections to build, or None for all of them
+    :param dict timings: if given, the time taken to build each section, in seconds,
+                         is added to this dict
+    """
+    return build_profiles([geo], profile_name, request, sections, timings)[0]
+
+
+def build_profiles(geos, profile_name='default', request=None, sections=None, timings=None):
+    """ Build profile data from registered sections for each of +geos+, like +build_profile+.
+    Each section is built once for each geography and comparative geography.
+
+    :return: a list of profile data, one for each of +geos+
+    """
+    registered = get_sections(profile_name)
+    if sections is None:
+        sections = registered.keys()
+    else:
+        sections = [name for name in registered if name in sections]
+
+    data, section_timings = get_section_executor().build_for_geos(geos, profile_name, sections)
+
+    log.debug("Built profile sections for %s: %s" % (
+        ', '.join(geo.geoid for geo in geos),
+        ', '.join('%s %.3fs' % (name, secs) for name, secs in section_timings.iteritems())))
+    if timings is not None:
+        timings.update(section_timings)
+
+    return data
+
+
+class SectionExecutor(object):
+    """ Builds profile sections one after the other, in the calling thread, sharing
+    a single session. This is the default.
+
+    Subclasses that build sections differently override +build_for_geos+.
+
+    The executor is also used to do other independent pieces of work, such as
+    fetching data for several tables, with +map+.
+    """
+    def build(self, geo, profile_name, sections):
+        """ Build +sections+ for +geo+, returning a tuple of OrderedDicts of
+        section data and of the time taken to build each section, in seconds.
+        """
+        data, timings = self.build_for_geos([geo], profile_name, sections)
+        return data[0], timings
+
+    def build_for_geos(self, geos, profile_name, sections):
+        """ Build +sections+ for each of +geos+, returning a tuple of a list of
+        OrderedDicts of section data, one for each geo, and an OrderedDict of the
+        time taken to build each section, in seconds.
+        """
+        session = get_session()
+        try:
+            results = [self.build_timed(name, geos, profile_name, session) for name in sections]
+        finally:
+            session.close()
+
+        return self.collect(geos, sections, results)
+
+    def build_timed(self, name, geos, profile_name, session):
+        start = time.time()
+        data = build_section_for_geos(name, geos, profile_name, session)
+        return data, time.time() - start
+
+    def build_isolated(self, name, geos, profile_name):
+        """ Build a section with its own SQLAlchemy session and Django database
+        connection, both of which are closed afterwards.
+        """
+        session = get_session()
+        try:
+            return self.build_timed(name, geos, profile_name, session)
+        finally:
+            session.close()
+            # Django's connections are per-thread
+            connections.close_all()
+
+    def map(self, func, items):
+        """ Call +func+ with each of +items+ and return a list of the results.
+        +func+ must not use the executor itself.
+        """
+        return [func(item) for item in items]
+
+    def collect(self, geos, sections, results):
+        data = [OrderedDict() for geo in geos]
+        timings = OrderedDict()
+        for name, (sections_data, secs) in zip(sections, results):
+            for profile, section in zip(data, sections_data):
+                profile[name] = section
+            timings[name] = secs
+        return data, timings
+
+
+class ThreadPoolSectionExecutor(SectionExecutor):
+    """ Builds profile sections concurrently in a bounded pool of threads, each
+    with its own session. The pool is shared by all requests in a process and
+    has ``profile_section_workers`` threads.
+
+    Each thread uses a database connection, so make sure the SQLAlchemy
+    connection pool and your database allow for them.
+    """
+    def __init__(self, workers=None):
+        self.workers = workers or settings.WAZIMAP.get('profile_section_workers', 4)
+        self.lock = threading.Lock()
+        self.pid = None
+        self._pool = None
+
+    @property
+    def pool(self):
+        # threads don't survive forking, so each process needs its own pool
+        pid = os.getpid()
+        if self.pid != pid:
+            with self.lock:
+                if self.pid != pid:
+                    self._pool = ThreadPoolExecutor(self.workers)
+                    self.pid = pid
+        return self._pool
+
+    def build_for_geos(self, geos, profile_name, sections):
+        if len(sections) < 2:
+            return super(ThreadPoolSectionExecutor, self).build_for_geos(geos, profile_name, sections)
+
+        build = propagate(self.build_isolated)
+        futures = [self.pool.submit(build, name, geos, profile_name) for name in sections]
+        return self.collect(geos, sections, [f.result() for f in futures])
+
+    def map(self, func, items):
+        if len(items) < 2:
+            return super(ThreadPoolSectionExecutor, self).map(func, items)
+        return list(self.pool.map(propagate(func), items))
+
+
+class GeventSectionExecutor(SectionExecutor):
+    """ Builds profile sections concurrently in greenlets, with at most
+    ``profile_section_workers`` sections per request at a time. Use this when
+    running under gunicorn's gevent worker.
+
+    This needs gevent's monkey patching, so that each greenlet gets its own
+    Django connection, and a psycopg2 wait callback such as psycogreen's,
+    so that database queries don't block other greenlets.
+    """
+    def __init__(self, workers=None):
+        if not HAS_GEVENT:
+            raise ImproperlyConfigured("GeventSectionExecutor needs gevent to be installed")
+        self.workers = workers or settings.WAZIMAP.get('profile_section_workers', 4)
+
+    def build_for_geos(self, geos, profile_name, sections):
+        if len(sections) < 2:
+            return super(GeventSectionExecutor, self).build_for_geos(geos, profile_name, sections)
+
+        if not gevent.monkey.is_module_patched('threading'):
+            raise ImproperlyConfigured("GeventSectionExecutor needs gevent to monkey patch threading")
+
+        pool = gevent.pool.Pool(self.workers)
+        build = propagate(self.build_isolated)
+        greenlets = [pool.spawn(build, name, geos, profile_name) for name in sections]
+        gevent.joinall(greenlets, raise_error=True)
+        return self.collect(geos, sections, [g.value for g in greenlets])
+
+    def map(self, func, items):
+        if len(items) < 2:
+            return super(GeventSectionExecutor, self).map(func, items)
+        return gevent.pool.Pool(self.workers).map(propagate(func), items)
+
+
+_section_executor = None
+
+
+def get_section_executor():
+    global _section_executor
+
+    if _section_executor is None:
+        path = settings.WAZIMAP.get('profile_section_executor') or 'wazimap.profiles.SectionExecutor'
+        _section_executor = import_string(path)()
+    return _section_executor
+
+
+def align_profiles(profiles):
+    """ Combine the enhanced +profiles+ of several geographies into a single
+    structure with the same shape as a profile, for comparing them.
+
+    In each stat, the values for each level are replaced by a list with a value
+    for each profile, or None if a profile doesn't have it. For example,
+    ``{'values': {'this': [10, 20], 'country': [50, 50]}, 'name': 'Female'}``.
+    Other values are also replaced by a list with one for each profile,
+    except for metadata, which is taken from the first profile that has it.
+    """
+    def first(items):
+        return next((i for i in items if i is not None), None)
+
+    def union(items):
+        keys = OrderedDict()
+        for item in items:
+            for key in item:
+                keys[key] = None
+        return keys.keys()
+
+    def align_stat(stats):
+        stats = [s if isinstance(s, Mapping) and 'values' in s else {} for s in stats]
+        result = OrderedDict()
+        for key in union(stats):
+            if key in Stat.LEVEL_FIELDS:
+                levels = [s.get(key) or {} for s in stats]
+                result[key] = OrderedDict((level, [v.get(level) for v in levels]) for level in union(levels))
             else:
-                raw[obj] = d[obj]
-            enhanced[obj] = OrderedDict()
-        enhanced['index'] = OrderedDict()
-        enhanced['error_ratio'] = OrderedDict()
-        comparative_sumlevs = []
-
-        # enhance
-        for sumlevel in geo_data.comparative_levels:
-            # add the index value for comparatives
-            if sumlevel in raw['values']:
-                enhanced['values'][sumlevel] = raw['values'][sumlevel]
-                enhanced['index'][sumlevel] = get_ratio(geo_value, raw['values'][sumlevel])
-
-                # add to our list of comparatives for the template to use
-                if sumlevel != 'this':
-                    comparative_sumlevs.append(sumlevel)
-
-            # add the moe ratios
-            if (sumlevel in raw['values']) and (sumlevel in raw['error']):
-                enhanced['error'][sumlevel] = raw['error'][sumlevel]
-                enhanced['error_ratio'][sumlevel] = get_ratio(raw['error'][sumlevel], raw['values'][sumlevel], 3)
-
-            # add the numerators and numerator_errors
-            if sumlevel in raw['numerators']:
-                enhanced['numerators'][sumlevel] = raw['numerators'][sumlevel]
-
-            if (sumlevel in raw['numerators']) and (sumlevel in raw['numerator_errors']):
-                enhanced['numerator_errors'][sumlevel] = raw['numerator_errors'][sumlevel]
-
-            if len(enhanced['values']) >= (num_comparatives + 1):
-                break
+                result[key] = first(s.get(key) for s in stats)
+        return result
+
+    def align(items):
+        present = [i for i in items if i is not None]
+
+        if any(isinstance(i, Mapping) and 'values' in i for i in present):
+            return align_stat(items)
+
+        if present and all(isinstance(i, Mapping) for i in present):
+            result = OrderedDict()
+            for key in union(present):
+                values = [i.get(key) if i is not None else None for i in items]
+                result[key] = first(values) if key == 'metadata' else align(values)
+            return result
+
+        return items
+
+    return align(profiles)
+
+
+def select_keys(data, keys):
+    """ Select parts of nested profile data, using dotted key paths such as
+    ``demographics.language_distribution``. The result is nested in the
+    same way as +data+. Raises KeyError if a key doesn't exist.
+    """
+    selected = OrderedDict()
+
+    for key in keys:
+        parts = key.split('.')
+        src, dest = data, selected
+
+        for i, part in enumerate(parts):
+            if not isinstance(src, Mapping) or part not in src:
+                raise KeyError(key)
+            src = src[part]
+
+            if i == len(parts) - 1:
+                dest[part] = src
+            else:
+                dest = dest.setdefault(part, OrderedDict())
+
+    return selected
+
+
+# the parts of a stat that are enhanced with comparative values, in the order they're added
+ENHANCED_KEYS = ['values', 'index', 'error', 'error_ratio', 'numerators', 'numerator_errors']
+
+# the number of comparative geographies to include
+NUM_COMPARATIVES = 2
+
+
+def enhance_stat(d):
+    """ Calculate the comparative values for a stat dict +d+, which has a
+    ``values`` key. Returns a tuple of a dict from each of ENHANCED_KEYS to a
+    list of (level, value) pairs, and the list of comparative levels.
+    """
+    raw = {}
+    enhanced = {}
+    geo_value = d['values']['this']
+
+    for obj in ['values', 'error', 'numerators', 'numerator_errors']:
+        if obj not in d:
+            raw[obj] = dict(zip(geo_data.comparative_levels, repeat(0)))
+        else:
+            raw[obj] = d[obj]
+    for obj in ENHANCED_KEYS:
+        enhanced[obj] = []
+    comparative_sumlevs = []
+
+    for sumlevel in geo_data.comparative_levels:
+        # add the index value for comparatives
+        if sumlevel in raw['values']:
+            enhanced['values'].append((sumlevel, raw['values'][sumlevel]))
+            enhanced['index'].append((sumlevel, get_ratio(geo_value, raw['values'][sumlevel])))
+
+            # add to our list of comparatives for the template to use
+            if sumlevel != 'this':
+                comparative_sumlevs.append(sumlevel)
+
+        # add the moe ratios
+        if (sumlevel in raw['values']) and (sumlevel in raw['error']):
+            enhanced['error'].append((sumlevel, raw['error'][sumlevel]))
+            enhanced['error_ratio'].append((sumlevel, get_ratio(raw['error'][sumlevel], raw['values'][sumlevel], 3)))
+
+        # add the numerators and numerator_errors
+        if sumlevel in raw['numerators']:
+            enhanced['numerators'].append((sumlevel, raw['numerators'][sumlevel]))
+
+        if (sumlevel in raw['numerators']) and (sumlevel in raw['numerator_errors']):
+            enhanced['numerator_errors'].append((sumlevel, raw['numerator_errors'][sumlevel]))
+
+        if len(enhanced['values']) >= (NUM_COMPARATIVES + 1):
+            break
+
+    return enhanced, comparative_sumlevs
+
+
+def find_stats(data):
+    """ Find the stats in +data+, which are mappings with a ``values`` key.
+    Stats in lists aren't included.
+    """
+    stack = [data]
+    stats = []
+    while stack:
+        d = stack.pop()
+        if 'values' in d:
+            stats.append(d)
+        for value in d.itervalues():
+            if isinstance(value, Mapping):
+                stack.append(value)
+
+    return stats
+
+
+def enhance_api_data(api_data):
+    for d in find_stats(api_data):
+        enhanced, comparative_sumlevs = enhance_stat(d)
 
         # replace data with enhanced version
-        for obj in ['values', 'index', 'error', 'error_ratio', 'numerators', 'numerator_errors']:
-            d[obj] = enhanced[obj]
+        for obj in ENHANCED_KEYS:
+            d[obj] = LevelValues(enhanced[obj])
 
         api_data['geography']['comparatives'] = comparative_sumlevs
 
     return api_data
+
+
+def profile_json(api_data):
+    """ Enhance +api_data+ like +enhance_api_data+ and serialize it to JSON, in
+    a single pass and without changing +api_data+.
+
+    This is much faster than enhancing the data and then serializing it, so
+    use it when only the JSON is needed. The geography is written last, since
+    its comparatives are only known once the stats have been enhanced.
+    """
+    writer = ProfileJSONWriter()
+    writer.write_profile(api_data)
+    return ''.join(writer.parts)
+
+
+class ProfileJSONWriter(object):
+    """ Writes enhanced profile data as JSON, in the same format as
+    the configured JSON encoder, into +parts+.
+    """
+    def __init__(self):
+        self.parts = []
+        self.comparatives = None
+        self.encoder = get_encoder_class()()
+
+    def write_profile(self, api_data):
+        out = self.parts.append
+        out('{')
+
+        first = True
+        for key, value in api_data.iteritems():
+            if key == 'geography':
+                continue
+            if not first:
+                out(', ')
+            first = False
+            self.write_key(key)
+            self.write(value)
+
+        if 'geography' in api_data:
+            if not first:
+                out(', ')
+            self.write_key('geography')
+
+            geography = api_data['geography']
+            if self.comparatives is not None:
+                geography = OrderedDict(geography)
+                geography['comparatives'] = self.comparatives
+            self.write(geography)
+
+        out('}')
+
+    def write(self, value, enhance=True):
+        """ Write +value+ as JSON. Stats in lists aren't enhanced, just like +enhance_api_data+.
+        """
+        out = self.parts.append
+
+        if isinstance(value, basestring):
+            out(encode_basestring_ascii(value))
+        elif value is None:
+            out('null')
+        elif value is True:
+            out('true')
+        elif value is False:
+            out('false')
+        elif isinstance(value, (int, long)):
+            out(str(value))
+        elif isinstance(value, float):
+            # the encoder takes care of NaN and infinity
+            out(repr(value) if value - value == 0 else self.encoder.encode(value))
+        elif isinstance(value, Mapping):
+            if enhance and 'values' in value:
+                self.write_stat(value)
+            else:
+                self.write_dict(value.iteritems(), enhance)
+        elif isinstance(value, RawJSON):
+            out(value.encoded)
+        elif isinstance(value, (list, tuple)):
+            out('[')
+            for i, item in enumerate(value):
+                if i:
+                    out(', ')
+                self.write(item, False)
+            out(']')
+        else:
+            self.write(self.encoder.default(value), enhance)
+
+    def write_dict(self, items, enhance=True):
+        out = self.parts.append
+        out('{')
+        for i, (key, value) in enumerate(items):
+            if i:
+                out(', ')
+            self.write_key(key)
+            self.write(value, enhance)
+        out('}')
+
+    def write_key(self, key):
+        if not isinstance(key, basestring):
+            key = self.encoder.encode(key).strip('"')
+        self.parts.append(encode_basestring_ascii(key))
+        self.parts.append(': ')
+
+    def write_stat(self, d):
+        enhanced, comparatives = enhance_stat(d)
+
+        # enhanced keys replace existing keys in place, and new ones are added at the end
+        items = [(k, enhanced[k] if k in enhanced else v) for k, v in d.iteritems()]
+        items.extend((k, enhanced[k]) for k in ENHANCED_KEYS if k not in d)
+
+        out = self.parts.append
+        out('{')
+        for i, (key, value) in enumerate(items):
+            if i:
+                out(', ')
+            self.write_key(key)
+            if key in enhanced:
+                self.write_dict(enhanced[key])
+            else:
+                self.write(value)
+        out('}')
+
+        # enhance_api_data uses the comparatives of the first stat in post-order
+        if self.comparatives is None:
+            self.comparatives = comparatives
@@ -93,6 +93,7 @@ MIDDLEWARE_CLASSES = (
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'wazimap.middleware.RedirectMiddleware',
+    'wazimap.middleware.CanonicalQueryMiddleware',
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
@@ -114,8 +115,12 @@ if DEBUG:
 else:
     CACHES = {
         'default': {
-            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'BACKEND': 'wazimap.cache_backends.ShardedFileCache',
             'LOCATION': '/var/tmp/wazimap_cache',
+            'OPTIONS': {
+                # 1GB
+                'MAX_SIZE': 1024 * 1024 * 1024,
+            },
         }
     }
 
@@ -189,6 +194,10 @@ WAZIMAP = {
     # How many seconds should Wazimap embed pages be cached for?
     'embed_cache_secs': 24 * 60 * 60,
 
+    # How many seconds should profile sections rendered with {% cachesection %} be
+    # cached for? Set to 0 to disable.
+    'section_cache_secs': 60 * 60,
+
     # the dotted-path of the class to use for geo data helper routines
     'geodata': 'wazimap.geo.GeoData',
 
@@ -257,4 +266,74 @@ WAZIMAP = {
     # geographies, you probably want to set this to your earliest version, so
     # that embeds continue to show the original data.
     'legacy_embed_geo_version': None,
+
+    # Directory that profile pages and JSON are exported to by the `export_profiles`
+    # management command. If set, profile pages are served from this directory
+    # when an exported version exists. If None, exports aren't used.
+    'static_export_dir': None,
+
+    # Directory that finished data downloads are cached in. Downloads are generated
+    # again when the data version changes. The `pregenerate_downloads` management
+    # command fills it with common downloads. If None, downloads aren't cached.
+    'download_cache_dir': None,
+
+    # Downloads for more than this many geographies are queued and generated in
+    # the background by the `process_downloads` management command, rather than
+    # while the client waits. This needs `download_cache_dir`. If None, downloads
+    # are never queued.
+    'download_async_geos': None,
+
+    # Tolerances, in degrees, that geometries in downloads can be simplified with,
+    # by name. Use `?simplify=<name>` in the download URL to choose one. Downloads
+    # use full precision by default, or with `?simplify=full`.
+    'download_simplify_tolerances': {
+        'low': 0.01,
+        'medium': 0.001,
+    },
+
+    # If set to 'X-Sendfile' or 'X-Accel-Redirect', cached downloads are sent by
+    # the web server rather than by Django. For X-Accel-Redirect, set
+    # `download_sendfile_url` to the internal URL that serves `download_cache_dir`.
+    'download_sendfile_header': None,
+    'download_sendfile_url': '/downloads/',
+
+    # An identifier for the data that this site serves, such as a release name.
+    # This is included in cache keys and ETags, so changing it invalidates cached
+    # responses. Run `python manage.py bump_data_version` after loading new data.
+    'data_version': None,
+
+    # If set, profile pages only render this many profile sections and load
+    # the rest asynchronously. This only applies to profiles that register their
+    # sections with `wazimap.profiles.register_section`. If None, profile pages
+    # render the whole profile.
+    'progressive_profile_sections': None,
+
+    # The dotted-path of the class used to build profile sections, and the
+    # maximum number of sections it builds at once. See `wazimap.profiles`.
+    'profile_section_executor': 'wazimap.profiles.SectionExecutor',
+    'profile_section_workers': 4,
+
+    # The dotted-path of the json.JSONEncoder subclass used to encode API responses
+    # and profile data. See `wazimap.encoders`.
+    'json_encoder': 'wazimap.encoders.JSONEncoder',
+
+    # The maximum number of small, frequently used objects, such as geography
+    # details and comparative profile sections, that each process keeps in
+    # memory in front of the Django cache.
+    # Set to 0 to disable the in-process cache.
+    'local_cache_entries': 1000,
+
+    # Response header used to send surrogate keys to a CDN, so that it can
+    # purge cached content when the underlying data changes. Set to None to disable.
+    'surrogate_key_header': 'Surrogate-Key',
+
+    # How many seconds should a CDN cache pages for? If set, this is sent in
+    # the Surrogate-Control header. Since content is purged when data changes,
+    # this can be much longer than cache_secs.
+    'cdn_cache_secs': None,
+
+    # The dotted-path of the class used to purge content from a CDN, and
+    # a dict of options passed to it.
+    'cdn_purge_backend': 'wazimap.cdn.NullPurgeBackend',
+    'cdn_purge_options': {},
 }
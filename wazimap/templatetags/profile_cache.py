@@ -0,0 +1,69 @@
+import hashlib
+
+from django import template
+from django.conf import settings
+from django.utils import translation
+from django.utils.encoding import force_bytes
+
+from wazimap.cache import get_data_version
+from wazimap.dependencies import Dependencies, current as current_dependencies, cache_get, cache_set
+
+register = template.Library()
+
+
+def section_cache_key(geography, profile_name, section, vary_on=()):
+    """ The cache key for the rendered HTML of a profile section, which depends
+    on the geography, profile, section, language and data version, and on
+    anything else in +vary_on+.
+    """
+    parts = [get_data_version().version, geography['full_geoid'], geography['version'], profile_name, section,
+             translation.get_language() or '']
+    parts.extend(force_bytes(v) for v in vary_on)
+    return 'wazimap.section.%s' % hashlib.sha1('|'.join(force_bytes(p) for p in parts)).hexdigest()
+
+
+class SectionCacheNode(template.Node):
+    def __init__(self, nodelist, section, vary_on):
+        self.nodelist = nodelist
+        self.section = section
+        self.vary_on = vary_on
+
+    def render(self, context):
+        timeout = settings.WAZIMAP.get('section_cache_secs', settings.WAZIMAP['cache_secs'])
+        geography = (context.get('geography') or {}).get('this')
+        if not timeout or not geography:
+            return self.nodelist.render(context)
+
+        key = section_cache_key(geography, context.get('profile_name', 'default'), self.section.resolve(context),
+                                [v.resolve(context) for v in self.vary_on])
+        html = cache_get(key)
+
+        if html is None:
+            html = self.nodelist.render(context)
+            # the section is invalidated with the data the page was built from
+            cache_set(key, html, current_dependencies() or Dependencies(), timeout)
+
+        return html
+
+
+@register.tag('cachesection')
+def do_cachesection(parser, token):
+    """ Cache the HTML for a profile section, for the geography and profile
+    in the template context and the current data version. Additional
+    arguments are also included in the cache key, as with ``{% cache %}``.
+
+    Usage::
+
+        {% load profile_cache %}
+        {% cachesection "demographics" %}
+            ... the section's content ...
+        {% endcachesection %}
+    """
+    nodelist = parser.parse(('endcachesection',))
+    parser.delete_first_token()
+
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError("'%s' tag requires at least one argument: the section name" % bits[0])
+
+    return SectionCacheNode(nodelist, parser.compile_filter(bits[1]), [parser.compile_filter(b) for b in bits[2:]])
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from datetime import timedelta
+
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from wazimap.data.download import (DownloadCache, queue_download_job, claim_download_jobs,
+                                   requeue_stale_download_jobs, run_download_job)
+from wazimap.models import DownloadJob
+from wazimap.views import DataAPIView
+
+
+Table = namedtuple('Table', ['id'])
+Geo = namedtuple('Geo', ['geoid', 'version'])
+
+
+class FakeBundle(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        self.closed = True
+
+
+class DownloadCacheTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = DownloadCache(self.root)
+        self.geos = [Geo('province-WC', '2011'), Geo('province-GT', '2011')]
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_key(self):
+        key = self.cache.key([Table('gender')], self.geos, 'csv')
+        self.assertEqual(key, self.cache.key([Table('GENDER')], list(reversed(self.geos)), 'csv'))
+        self.assertNotEqual(key, self.cache.key([Table('GENDER')], self.geos, 'xlsx'))
+        self.assertNotEqual(key, self.cache.key([Table('GENDER')], [Geo('province-WC', '2016'), self.geos[1]], 'csv'))
+
+    def test_store(self):
+        key = self.cache.key([Table('GENDER')], self.geos, 'csv')
+        self.assertIsNone(self.cache.get(key))
+
+        bundle = FakeBundle(['PK', 'data'])
+        self.assertEqual('PKdata', ''.join(self.cache.store(key, bundle)))
+        self.assertTrue(bundle.closed)
+
+        with open(self.cache.get(key)) as f:
+            self.assertEqual('PKdata', f.read())
+
+        response = self.cache.response(key, 'GENDER_Western_Cape.zip')
+        self.assertEqual('PKdata', ''.join(response.streaming_content))
+        self.assertEqual('attachment; filename="GENDER_Western_Cape.zip"', response['Content-Disposition'])
+        response.close()
+
+    def test_incomplete_store(self):
+        # such as when the client disconnects
+        key = self.cache.key([Table('GENDER')], self.geos, 'csv')
+        bundle = FakeBundle(['PK', 'data'])
+        stored = self.cache.store(key, bundle)
+        next(iter(stored))
+        stored.close()
+
+        self.assertTrue(bundle.closed)
+        self.assertIsNone(self.cache.get(key))
+        self.assertEqual([], os.listdir(os.path.dirname(os.path.join(self.root, self.cache.rel_path(key)))))
+
+    def test_sendfile(self):
+        key = self.cache.key([Table('GENDER')], self.geos, 'csv')
+        ''.join(self.cache.store(key, FakeBundle(['PK'])))
+
+        with override_settings(WAZIMAP=dict(download_sendfile_header='X-Accel-Redirect', download_sendfile_url='/internal/')):
+            response = self.cache.response(key, 'x.zip')
+            self.assertEqual('/internal/' + self.cache.rel_path(key), response['X-Accel-Redirect'])
+            self.assertEqual('', response.content)
+
+        with override_settings(WAZIMAP=dict(download_sendfile_header='X-Sendfile')):
+            response = self.cache.response(key, 'x.zip')
+            self.assertEqual(self.cache.get(key), response['X-Sendfile'])
+
+    def test_prune(self):
+        key = self.cache.key([Table('GENDER')], self.geos, 'csv')
+        ''.join(self.cache.store(key, FakeBundle(['PK'])))
+        os.mkdir(os.path.join(self.root, 'old-version'))
+
+        self.assertEqual(1, self.cache.prune())
+        self.assertEqual([self.cache.version_dir()], os.listdir(self.root))
+
+
+class DownloadJobTestCase(TestCase):
+    params = {'table_ids': 'GENDER', 'geo_ids': 'ward|country-ZA', 'format': 'shp'}
+
+    def test_queue_and_claim(self):
+        job = queue_download_job('abc', self.params)
+        self.assertEqual(DownloadJob.QUEUED, job.status)
+        self.assertIsNone(job.geo_version)
+        # the same download isn't queued twice
+        self.assertEqual(job.id, queue_download_job('abc', self.params).id)
+
+        other = queue_download_job('def', dict(self.params, format='kml'))
+        self.assertEqual([job.id, other.id], claim_download_jobs(5))
+        self.assertEqual([], claim_download_jobs(5))
+        self.assertEqual(DownloadJob.RUNNING, DownloadJob.objects.get(id=job.id).status)
+
+        # running jobs aren't queued again until they're stale
+        self.assertEqual(0, requeue_stale_download_jobs(60))
+        DownloadJob.objects.filter(id=job.id).update(started_at=timezone.now() - timedelta(seconds=120))
+        self.assertEqual(1, requeue_stale_download_jobs(60))
+        self.assertEqual([job.id], claim_download_jobs(5))
+
+    def test_failed(self):
+        job = queue_download_job('abc', self.params)
+
+        def get(self, request, *args, **kwargs):
+            raise ValueError(u'Geometry missing for Gqeberha \u00e9')
+
+        original = DataAPIView.get
+        DataAPIView.get = get
+        try:
+            self.assertEqual(DownloadJob.FAILED, run_download_job(job.id))
+        finally:
+            DataAPIView.get = original
+        self.assertEqual(u'Geometry missing for Gqeberha \u00e9', DownloadJob.objects.get(id=job.id).error)
+
+    def test_status(self):
+        job = queue_download_job('abc', self.params)
+        url = reverse('api_download_status', kwargs={'job_id': job.id})
+
+        response = self.client.get(url)
+        self.assertEqual(202, response.status_code)
+        self.assertEqual(url, response['Location'])
+        self.assertIn('"status": "queued"', response.content)
+
+        job.status = DownloadJob.DONE
+        job.save()
+        response = self.client.get(url)
+        self.assertEqual(302, response.status_code)
+        self.assertIn('/api/1.0/data/download/latest?table_ids=GENDER&geo_ids=ward%7Ccountry-ZA&format=shp',
+                      response['Location'])
+
+        job.status = DownloadJob.FAILED
+        job.error = 'No GDAL'
+        job.save()
+        self.assertEqual(500, self.client.get(url).status_code)
+
+        url = reverse('api_download_status', kwargs={'job_id': '0' * 32})
+        self.assertEqual(404, self.client.get(url).status_code)
@@ -0,0 +1,83 @@
+import json
+import pickle
+from copy import deepcopy
+
+from django.conf import settings
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+
+from wazimap.data.stats import LevelValues, Stat
+from wazimap.data.utils import collapse_categories, group_remainder, merge_dicts
+from wazimap.encoders import dumps
+
+from census.profile import find_dicts_with_key
+
+
+class StatTestCase(TestCase):
+    def test_level_values(self):
+        values = LevelValues({'this': 1})
+        values['province'] = 2
+        self.assertEqual({'this': 1, 'province': 2}, values)
+        self.assertEqual(['this', 'province'], values.keys())
+        self.assertNotIn('country', values)
+        self.assertIsInstance(values, dict)
+
+        del values['this']
+        self.assertEqual({'province': 2}, values)
+        with self.assertRaises(KeyError):
+            values['this']
+
+    def test_stat(self):
+        stat = Stat(name='Male', values={'this': 10}, extra='x')
+        self.assertIsInstance(stat['values'], LevelValues)
+        self.assertEqual(['name', 'values', 'extra'], stat.keys())
+        self.assertEqual({'this': 10}, stat['values'])
+        self.assertEqual([{'this': 10}], [v for k, v in stat.items() if k == 'values'])
+
+        stat.setdefault('numerators', {})['this'] = 5
+        self.assertEqual({'this': 5}, stat['numerators'])
+
+        self.assertEqual(stat, pickle.loads(pickle.dumps(stat, pickle.HIGHEST_PROTOCOL)))
+        self.assertEqual(stat, deepcopy(stat))
+        self.assertEqual({
+            'name': 'Male',
+            'values': {'this': 10},
+            'numerators': {'this': 5},
+            'extra': 'x',
+        }, json.loads(dumps(stat)))
+
+        self.assertEqual('Male 10', Template('{{ stat.name }} {{ stat.values.this }}').render(Context({'stat': stat})))
+
+    @override_settings(WAZIMAP=dict(settings.WAZIMAP, comparative_levels=['province', 'country']))
+    def test_level_order(self):
+        # levels are listed in comparative_levels order, however they were added
+        values = LevelValues(country=1)
+        values['province'] = 2
+        values['this'] = 3
+        self.assertEqual(['this', 'province', 'country'], values.keys())
+        self.assertEqual('{"this": 3, "province": 2, "country": 1}', json.dumps(values))
+
+    def test_find_dicts_with_key(self):
+        stat = Stat(name='Male', values={'this': 10})
+        data = {'gender': {'Male': stat, 'metadata': {'universe': 'Population'}}}
+        self.assertEqual([stat], find_dicts_with_key(data, 'name'))
+        self.assertEqual([stat['values']], find_dicts_with_key(data, 'this'))
+
+    def test_helpers(self):
+        data = {
+            'Male': Stat(name='Male', numerators={'this': 10}, values={'this': 25.0}),
+            'Female': Stat(name='Female', numerators={'this': 30}, values={'this': 75.0}),
+        }
+        merge_dicts(data, {
+            'Male': {'name': 'Male', 'numerators': {'this': 20}, 'values': {'this': 50.0}},
+            'Female': {'name': 'Female', 'numerators': {'this': 20}, 'values': {'this': 50.0}},
+        }, 'province')
+        self.assertEqual({'this': 10, 'province': 20}, data['Male']['numerators'])
+
+        collapsed = collapse_categories(data, {'Male': 'People', 'Female': 'People'})
+        self.assertEqual({'this': 40, 'province': 40}, collapsed['People']['numerators'])
+
+        group_remainder(data, 1)
+        self.assertEqual(['Other'], data.keys())
+        self.assertEqual({'this': 40, 'province': 40}, data['Other']['numerators'])
+        self.assertEqual({'this': 100, 'province': 100}, data['Other']['values'])
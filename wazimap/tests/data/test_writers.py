@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from collections import OrderedDict
+
+from django.test import TestCase
+
+from wazimap.data.writers import column_letter, write_csv, write_geojson, write_xlsx
+
+
+class WritersTestCase(TestCase):
+    header = ['geoid', 'name', 'total']
+    rows = [['province-WC', u'Western Cape', 22], ['province-GT', u'Gauteng & <more>', None]]
+
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path)
+
+    def test_csv(self):
+        path = os.path.join(self.temp_path, 'out.csv')
+        write_csv(path, self.header, iter(self.rows))
+        with open(path) as f:
+            self.assertEqual('geoid,name,total\r\nprovince-WC,Western Cape,22\r\nprovince-GT,Gauteng & <more>,\r\n', f.read())
+
+    def test_geojson(self):
+        path = os.path.join(self.temp_path, 'out.geojson')
+        geometries = [{'type': 'Point', 'coordinates': [18.4, -33.9]}, None]
+        write_geojson(path, self.header, iter(self.rows), iter(geometries))
+
+        with open(path) as f:
+            data = json.load(f)
+        self.assertEqual('FeatureCollection', data['type'])
+        self.assertEqual(2, len(data['features']))
+        self.assertEqual({'geoid': 'province-WC', 'name': 'Western Cape', 'total': 22}, data['features'][0]['properties'])
+        with open(path) as f:
+            properties = json.load(f, object_pairs_hook=OrderedDict)['features'][0]['properties']
+        self.assertEqual(self.header, properties.keys())
+        self.assertEqual('Point', data['features'][0]['geometry']['type'])
+        self.assertIsNone(data['features'][1]['geometry'])
+
+    def test_xlsx(self):
+        path = os.path.join(self.temp_path, 'out.xlsx')
+        write_xlsx(path, self.header, iter(self.rows), u'GENDER_Cape/Town')
+
+        self.assertEqual(['out.xlsx'], os.listdir(self.temp_path))
+        zfile = zipfile.ZipFile(path)
+        self.assertIn('[Content_Types].xml', zfile.namelist())
+        self.assertIn('name="GENDER_Cape_Town"', zfile.read('xl/workbook.xml'))
+
+        sheet = zfile.read('xl/worksheets/sheet1.xml')
+        self.assertIn('<c r="C2"><v>22</v></c>', sheet)
+        self.assertIn('<c r="B3" t="inlineStr"><is><t>Gauteng &amp; &lt;more&gt;</t></is></c>', sheet)
+        self.assertNotIn('C3', sheet)
+
+    def test_xlsx_non_finite(self):
+        path = os.path.join(self.temp_path, 'out.xlsx')
+        rows = [['province-WC', u'Western Cape', float('nan')], ['province-GT', u'Gauteng', float('inf')],
+                ['country-ZA', u'South Africa', 1.5]]
+        write_xlsx(path, self.header, iter(rows))
+
+        sheet = zipfile.ZipFile(path).read('xl/worksheets/sheet1.xml')
+        self.assertNotIn('nan', sheet)
+        self.assertNotIn('inf', sheet)
+        self.assertNotIn('C2', sheet)
+        self.assertNotIn('C3', sheet)
+        self.assertIn('<c r="C4"><v>1.5</v></c>', sheet)
+
+    def test_column_letter(self):
+        self.assertEqual(['A', 'Z', 'AA', 'AZ', 'BA'], [column_letter(i) for i in [0, 25, 26, 51, 52]])
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import zipfile
+from StringIO import StringIO
+
+from django.test import TestCase
+
+from wazimap.data.download import DownloadBundle
+from wazimap.data.zipstream import iter_zip
+
+
+class ZipStreamTestCase(TestCase):
+    def setUp(self):
+        self.temp_path = tempfile.mkdtemp()
+        self.inner_path = os.path.join(self.temp_path, 'GENDER_South_Africa')
+        os.mkdir(self.inner_path)
+
+        self.contents = {
+            'a.csv': 'geoid,total\n' + 'country-ZA,100\n' * 10000,
+            'b.prj': os.urandom(100000),
+            'empty.txt': '',
+        }
+        for name, content in self.contents.iteritems():
+            with open(os.path.join(self.inner_path, name), 'wb') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+    def test_iter_zip(self):
+        files = [(os.path.join(self.inner_path, n), u'dir/%s' % n) for n in sorted(self.contents)]
+        chunks = list(iter_zip(files, chunk_size=1024))
+        self.assertGreater(len(chunks), 3)
+
+        zfile = zipfile.ZipFile(StringIO(''.join(chunks)))
+        self.assertIsNone(zfile.testzip())
+        self.assertEqual(['dir/a.csv', 'dir/b.prj', 'dir/empty.txt'], zfile.namelist())
+        for name, content in self.contents.iteritems():
+            self.assertEqual(content, zfile.read('dir/' + name))
+
+    def test_iter_zip_attributes(self):
+        path = os.path.join(self.inner_path, 'a.csv')
+        zfile = zipfile.ZipFile(StringIO(''.join(iter_zip([(path, u'caf\xe9.csv'), (path, 'cafe.csv')]))))
+        utf8, ascii = zfile.infolist()
+
+        self.assertEqual(u'caf\xe9.csv', utf8.filename)
+        self.assertTrue(utf8.flag_bits & 0x800)
+        self.assertFalse(ascii.flag_bits & 0x800)
+        # made on Unix, with rw-r--r-- permissions
+        self.assertEqual(3, utf8.create_system)
+        self.assertEqual(0o644, (utf8.external_attr >> 16) & 0o777)
+        self.assertEqual(zfile.read(utf8), zfile.read(ascii))
+
+    def test_bundle_removes_files(self):
+        bundle = DownloadBundle(self.temp_path, self.inner_path, 'GENDER_South_Africa')
+        zfile = zipfile.ZipFile(StringIO(''.join(bundle)))
+        self.assertEqual(3, len(zfile.namelist()))
+        self.assertFalse(os.path.exists(self.temp_path))
+
+    def test_closed_bundle_removes_files(self):
+        # such as when the client disconnects part way through
+        bundle = DownloadBundle(self.temp_path, self.inner_path, 'GENDER_South_Africa')
+        next(iter(bundle))
+        bundle.close()
+        self.assertFalse(os.path.exists(self.temp_path))
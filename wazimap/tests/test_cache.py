@@ -0,0 +1,144 @@
+from django.test import TestCase, RequestFactory, override_settings
+from django.core.cache import caches
+from django.http import HttpResponse, StreamingHttpResponse
+
+from wazimap.cache import (accepted_encodings, cache_response, gzip_decompress, condition_on_data_version,
+                           bump_data_version, data_etag, TwoTierCache)
+from wazimap.cdn import add_surrogate_keys
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheResponseTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.calls = 0
+
+    def view(self, request):
+        self.calls += 1
+        return HttpResponse('{"data": "%s"}' % ('x' * 1000), content_type='application/javascript')
+
+    def test_accepted_encodings(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate;q=0.5, br;q=0')
+        self.assertEqual(set(['gzip', 'deflate']), accepted_encodings(request))
+
+    def test_cache_response(self):
+        view = cache_response(60)(self.view)
+
+        response = view(self.factory.get('/data.json', HTTP_ACCEPT_ENCODING='gzip'))
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual('application/javascript', response['Content-Type'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual('{"data": "%s"}' % ('x' * 1000), gzip_decompress(response.content))
+
+        # served from the cache, uncompressed
+        response = view(self.factory.get('/data.json'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual('{"data": "%s"}' % ('x' * 1000), response.content)
+        self.assertEqual(1, self.calls)
+
+        view(self.factory.get('/data.json?other=1'))
+        self.assertEqual(2, self.calls)
+
+    def test_streaming_response(self):
+        def view(request):
+            self.calls += 1
+            response = StreamingHttpResponse(iter(['{"data": ', '1}']), content_type='application/javascript')
+            return add_surrogate_keys(response, ['table-A'])
+
+        view = cache_response(60)(view)
+        response = view(self.factory.get('/data.json'))
+        self.assertTrue(response.streaming)
+        self.assertIn('max-age=60', response['Cache-Control'])
+        self.assertEqual('table-A', response['Surrogate-Key'])
+
+        view(self.factory.get('/data.json'))
+        self.assertEqual(2, self.calls)
+
+    def test_conditional_get(self):
+        view = condition_on_data_version(cache_response(60)(self.view))
+
+        response = view(self.factory.get('/data.json?table_ids=A'))
+        self.assertEqual(200, response.status_code)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # same etag, without calling the view
+        response = view(self.factory.get('/data.json?table_ids=A', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(1, self.calls)
+
+        # different tables
+        response = view(self.factory.get('/data.json?table_ids=B', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, self.calls)
+
+        # new data
+        bump_data_version()
+        response = view(self.factory.get('/data.json?table_ids=A', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+        self.assertEqual(3, self.calls)
+
+    def test_data_etag_non_ascii(self):
+        etag = data_etag(self.factory.get(u'/profiles/caf\xe9.json', {'keys': u'caf\xe9'}))
+        self.assertNotEqual(etag, data_etag(self.factory.get(u'/profiles/caf\xe9.json', {'keys': u'cafe'})))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TwoTierCacheTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.cache = TwoTierCache('test', max_entries=2)
+
+    def test_tiers(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual({'local': 0.5, 'shared': 0.0}, self.cache.hit_rates())
+
+        # served from the shared cache once dropped locally
+        self.cache.clear_local()
+        self.assertEqual(1, self.cache.get('a'))
+        self.assertEqual(1, self.cache.counters.counts['shared.hits'])
+
+    def test_many(self):
+        self.cache.set('a', 1)
+        self.cache.clear_local()
+        self.cache.set_many({'b': 2, 'c': None})
+
+        self.assertEqual({'a': 1, 'b': 2, 'c': None}, self.cache.get_many(['a', 'b', 'c', 'd']))
+        counts = self.cache.counters.counts
+        self.assertEqual(2, counts['local.hits'])
+        self.assertEqual(1, counts['shared.hits'])
+        self.assertEqual(1, counts['shared.misses'])
+
+    def test_lru(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(['a', 'c'], list(self.cache.local.keys()))
+
+    def test_data_version(self):
+        self.cache.set('a', 1)
+        bump_data_version()
+        self.cache.checked_at = 0
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(1, self.cache.get_or_set('a', lambda: 1))
+
+    def test_publish_counters(self):
+        self.cache.get('a')
+        self.cache.counters.publish()
+        self.cache.get('a')
+        self.cache.counters.publish()
+
+        totals = self.cache.counters.published()
+        self.assertEqual(2, totals['local.misses'])
+        self.assertEqual(0, totals['shared.hits'])
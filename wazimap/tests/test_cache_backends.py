@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.test import TestCase
+
+from wazimap.cache_backends import ShardedFileCache
+
+
+class ShardedFileCacheTestCase(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ShardedFileCache(self.dir, {'OPTIONS': {'MAX_SIZE': 10000, 'CULL_RATIO': 0.5}})
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_set_delete(self):
+        self.cache.set('a', {'x': 1})
+        self.assertEqual({'x': 1}, self.cache.get('a'))
+        self.assertIn('/', self.cache._key_to_file('a')[len(self.dir) + 1:])
+
+        size = self.cache.size
+        self.assertTrue(size > 0)
+
+        # overwriting doesn't double count
+        self.cache.set('a', {'x': 2})
+        self.assertEqual(size, self.cache.size)
+
+        self.cache.delete('a')
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(0, self.cache.size)
+
+    def test_evict_lru(self):
+        # don't let the background evictor kick in while we're adding entries
+        self.cache._max_size = 100000
+        for i in range(10):
+            # random data, so it doesn't compress
+            self.cache.set(str(i), os.urandom(2000))
+            time.sleep(0.01)
+
+        # touch the oldest entry
+        self.cache.get('0')
+        self.cache._max_size = 10000
+        self.cache.evict()
+
+        self.assertTrue(self.cache.size <= 5000)
+        self.assertIsNotNone(self.cache.get('0'))
+        self.assertIsNotNone(self.cache.get('9'))
+        self.assertIsNone(self.cache.get('1'))
+
+        # another evictor, such as in another process, doesn't evict any more
+        size = self.cache.size
+        other = ShardedFileCache(self.dir, {'OPTIONS': {'MAX_SIZE': 10000, 'CULL_RATIO': 0.5}})
+        other.evict()
+        self.assertEqual(size, self.cache.size)
+
+    def test_shared_index(self):
+        # Django creates a cache object for each thread
+        other = ShardedFileCache(self.dir, {})
+        self.assertIs(self.cache._index, other._index)
+        other.set('a', 1)
+        self.assertEqual(other.size, self.cache.size)
+
+    def test_clear(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(0, self.cache.size)
@@ -0,0 +1,42 @@
+from django.test import TestCase
+from django.http import HttpResponse
+
+from wazimap.cdn import surrogate_keys, add_surrogate_keys, purge
+from wazimap.geo import geo_data
+from wazimap.views import DataAPIView
+
+
+class CDNTestCase(TestCase):
+    def test_surrogate_keys(self):
+        geo_data.geo_model.objects.create(geo_level='country', geo_code='ZA', version='')
+        wc = geo_data.geo_model.objects.create(geo_level='province', geo_code='WC', version='',
+                                               parent_level='country', parent_code='ZA')
+
+        keys = surrogate_keys([wc, 'province-GT'], ['gender'], ['Census 2011'])
+        self.assertEqual(['geo-province-WC', 'geo-country-ZA', 'geo-province-GT', 'table-GENDER', 'dataset-census-2011'], keys)
+
+        response = add_surrogate_keys(HttpResponse(), keys)
+        add_surrogate_keys(response, ['geo-province-WC', 'table-OTHER'])
+        self.assertEqual(' '.join(keys + ['table-OTHER']), response['Surrogate-Key'])
+
+    def test_purge(self):
+        self.assertEqual(['geo-province-WC', 'table-GENDER', 'level-province'],
+                         purge(geos=['province-WC'], tables=['gender']))
+
+    def test_data_api_keys(self):
+        create = geo_data.geo_model.objects.create
+        za = create(geo_level='country', geo_code='ZA', version='')
+        wards = [create(geo_level='ward', geo_code=str(i), version='', parent_level='country', parent_code='ZA')
+                 for i in range(3)]
+
+        view = DataAPIView()
+        view.info_geos = [za]
+        view.data_geos = wards
+        view.tables = []
+        self.assertEqual(['geo-country-ZA', 'geo-ward-0', 'geo-ward-1', 'geo-ward-2'], view.surrogate_keys())
+
+        # over the limit, purging any one of the wards still reaches the response
+        view.max_surrogate_geos = 2
+        keys = view.surrogate_keys()
+        self.assertEqual(['geo-country-ZA', 'level-ward'], keys)
+        self.assertTrue(set(purge(geos=['ward-1'])) & set(keys))
@@ -0,0 +1,134 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+
+from wazimap.cache import cache_response, condition_on_data_version
+from wazimap.cdn import PurgeBackend
+from wazimap.dependencies import (recording, record, invalidate, cache_get, cache_set, version_key, Dependencies,
+                                  ANY)
+
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+class RecordingPurgeBackend(PurgeBackend):
+    purged = []
+
+    def purge_keys(self, keys):
+        self.purged.extend(keys)
+
+
+class Geo(object):
+    def __init__(self, geoid, version='2011'):
+        self.geoid = geoid
+        self.version = version
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DependenciesTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.factory = RequestFactory()
+        self.calls = 0
+
+    def view(self, request):
+        self.calls += 1
+        geo = Geo(request.GET['geo'])
+        record(request.GET['table'], [geo])
+        record(None, [geo])
+        return HttpResponse('data')
+
+    def get(self, url):
+        cache_response(60)(self.view)(self.factory.get(url))
+
+    def test_recording(self):
+        with recording() as outer:
+            record('a', [Geo('province-WC')])
+            with recording() as inner:
+                record('b', [Geo('country-ZA')])
+            record(None, [Geo('country-ZA')])
+
+        self.assertEqual(set([('B', 'country-ZA', '2011')]), inner.items)
+        self.assertEqual(set([
+            ('A', 'province-WC', '2011'),
+            ('B', 'country-ZA', '2011'),
+            (None, 'country-ZA', '2011'),
+        ]), outer.items)
+
+        # not recording
+        record('c', [Geo('country-ZA')])
+
+    def test_invalidate(self):
+        self.get('/?table=A&geo=province-WC')
+        self.get('/?table=A&geo=province-GT')
+        self.get('/?table=B&geo=province-WC')
+        self.assertEqual(3, self.calls)
+
+        self.assertEqual(1, invalidate(tables=['a'], geos=['province-WC']))
+        self.get('/?table=A&geo=province-WC')
+        self.get('/?table=A&geo=province-GT')
+        self.get('/?table=B&geo=province-WC')
+        self.assertEqual(4, self.calls)
+
+        self.assertEqual(1, invalidate(geos=['province-WC']))
+        self.get('/?table=A&geo=province-WC')
+        self.get('/?table=A&geo=province-GT')
+        self.get('/?table=B&geo=province-WC')
+        self.assertEqual(6, self.calls)
+
+        self.assertEqual(1, invalidate(tables=['A']))
+        self.get('/?table=A&geo=province-WC')
+        self.get('/?table=A&geo=province-GT')
+        self.get('/?table=B&geo=province-WC')
+        self.assertEqual(8, self.calls)
+
+    def test_invalidate_purges_cdn(self):
+        RecordingPurgeBackend.purged = []
+        wazimap = dict(settings.WAZIMAP, cdn_purge_backend='wazimap.tests.test_dependencies.RecordingPurgeBackend')
+
+        with override_settings(WAZIMAP=wazimap):
+            invalidate(tables=['a'], geos=['province-WC'])
+            self.assertEqual(['geo-province-WC', 'table-A', 'level-province'], RecordingPurgeBackend.purged)
+
+            invalidate(tables=['b'], purge_cdn=False)
+            self.assertEqual(['geo-province-WC', 'table-A', 'level-province'], RecordingPurgeBackend.purged)
+
+    def test_conditional_get_after_invalidate(self):
+        self.content = 'old'
+
+        def view(request):
+            record('A', [Geo('province-WC')])
+            return HttpResponse(self.content)
+        view = condition_on_data_version(cache_response(60)(view))
+
+        response = view(self.factory.get('/?table=A'))
+        etag = response['ETag']
+        self.assertEqual(304, view(self.factory.get('/?table=A', HTTP_IF_NONE_MATCH=etag)).status_code)
+
+        self.content = 'new'
+        invalidate(tables=['A'])
+        response = view(self.factory.get('/?table=A', HTTP_IF_NONE_MATCH=etag))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('new', response.content)
+
+    def test_evicted_versions(self):
+        self.get('/?table=A&geo=province-WC')
+        invalidate(tables=['A'])
+        # the counters are lost, but the old response isn't used
+        caches['default'].delete(version_key('A', ANY))
+        self.get('/?table=A&geo=province-WC')
+        self.assertEqual(2, self.calls)
+
+    def test_cached_dependencies_are_recorded(self):
+        deps = Dependencies()
+        deps.add('A', [Geo('province-WC')])
+        cache_set('key', 'value', deps, 60)
+
+        with recording() as outer:
+            self.assertEqual('value', cache_get('key'))
+        self.assertEqual(deps.items, outer.items)
@@ -0,0 +1,45 @@
+import json
+from decimal import Decimal
+
+from django.test import TestCase
+
+from wazimap.data.utils import native_number
+from wazimap.encoders import RawJSON, dumps, iterdumps_object
+
+
+class EncodersTestCase(TestCase):
+    def test_native_number(self):
+        self.assertEqual(10, native_number(Decimal('10.00')))
+        self.assertIsInstance(native_number(Decimal('10.00')), int)
+        self.assertEqual(10.5, native_number(Decimal('10.5')))
+        self.assertEqual(float('inf'), native_number(Decimal('Infinity')))
+        self.assertEqual('x', native_number('x'))
+
+    def test_dumps(self):
+        data = {
+            'total': Decimal('1.5'),
+            'geo': RawJSON('{"name": "Western Cape"}'),
+            'tables': [RawJSON('[1, 2]'), 'x'],
+        }
+        self.assertEqual({
+            'total': 1.5,
+            'geo': {'name': 'Western Cape'},
+            'tables': [[1, 2], 'x'],
+        }, json.loads(dumps(data)))
+
+        # the python encoder gives the same result as the C encoder
+        self.assertEqual(json.loads(dumps(data)), json.loads(dumps(data, indent=2)))
+
+    def test_iterdumps_object(self):
+        def data():
+            for i in xrange(3):
+                yield 'geo-%d' % i, {'total': Decimal(i)}
+
+        pairs = [('release', {'name': 'Census'}), ('data', data()), ('geo', RawJSON('{"a": 1}'))]
+        pieces = list(iterdumps_object(iter(pairs), buffer_size=10))
+        self.assertGreater(len(pieces), 1)
+        self.assertEqual({
+            'release': {'name': 'Census'},
+            'data': {'geo-0': {'total': 0}, 'geo-1': {'total': 1}, 'geo-2': {'total': 2}},
+            'geo': {'a': 1},
+        }, json.loads(''.join(pieces)))
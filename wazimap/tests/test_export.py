@@ -0,0 +1,94 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase, RequestFactory, override_settings
+from django.conf import settings
+from django.http import HttpResponse
+
+from wazimap.cache import bump_data_version
+from wazimap.export import ProfileExporter, exported_response
+from wazimap.tests.test_dependencies import LOCMEM_CACHES
+from wazimap.views import GeographyJsonView
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ExportTestCase(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.exporter = ProfileExporter(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_write_skips_unchanged(self):
+        self.assertTrue(self.exporter.write('profiles/country-ZA.json', '{"a": 1}'))
+        self.assertFalse(self.exporter.write('profiles/country-ZA.json', '{"a": 1}'))
+        self.assertTrue(self.exporter.write('profiles/country-ZA.json', '{"a": 2}'))
+
+        with gzip.open(os.path.join(self.root, 'profiles/country-ZA.json.gz')) as f:
+            self.assertEqual('{"a": 2}', f.read())
+
+    def test_exported_response(self):
+        self.exporter.write('profiles/country-ZA.json', '{"a": 1}')
+        self.exporter.write_metadata('profiles/country-ZA.json', HttpResponse())
+        factory = RequestFactory()
+        wazimap = dict(settings.WAZIMAP, static_export_dir=self.root)
+
+        with override_settings(WAZIMAP=wazimap):
+            response = exported_response(factory.get('/profiles/country-ZA.json', HTTP_ACCEPT_ENCODING='gzip'),
+                                         'profiles/country-ZA.json', 'application/javascript')
+            self.assertEqual('gzip', response['Content-Encoding'])
+
+            response = exported_response(factory.get('/profiles/country-ZA.json'),
+                                         'profiles/country-ZA.json', 'application/javascript')
+            self.assertEqual('{"a": 1}', ''.join(response.streaming_content))
+
+            # query strings are never served from the export
+            self.assertIsNone(exported_response(factory.get('/profiles/country-ZA.json?geo_version=2011'),
+                                                'profiles/country-ZA.json', 'application/javascript'))
+            self.assertIsNone(exported_response(factory.get('/profiles/country-WC.json'),
+                                                'profiles/country-WC.json', 'application/javascript'))
+
+            # exports for an older data version are rendered live
+            bump_data_version()
+            self.assertIsNone(exported_response(factory.get('/profiles/country-ZA.json'),
+                                                'profiles/country-ZA.json', 'application/javascript'))
+
+            # until they're exported again, even if they haven't changed
+            self.assertFalse(self.exporter.write('profiles/country-ZA.json', '{"a": 1}'))
+            self.exporter.write_metadata('profiles/country-ZA.json', HttpResponse())
+            self.assertIsNotNone(exported_response(factory.get('/profiles/country-ZA.json'),
+                                                   'profiles/country-ZA.json', 'application/javascript'))
+
+    def test_exported_keys(self):
+        # embedded charts only ask for some keys
+        self.exporter.write('profiles/country-XX.json', json.dumps({
+            'demographics': {'total': {'values': {'this': 10}}, 'other': {'values': {'this': 1}}},
+            'geography': {'this': {'geo_code': 'XX'}},
+        }))
+        response = HttpResponse()
+        response['Surrogate-Key'] = 'geo-country-XX table-TOTAL'
+        self.exporter.write_metadata('profiles/country-XX.json', response)
+
+        factory = RequestFactory()
+        view = GeographyJsonView.as_view()
+        wazimap = dict(settings.WAZIMAP, static_export_dir=self.root)
+
+        with override_settings(WAZIMAP=wazimap):
+            # the geography isn't in the database, so this can only come from the export
+            response = view(factory.get('/profiles/country-XX.json', {'keys': 'demographics.total'}),
+                            geography_id='country-XX')
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({
+                'demographics': {'total': {'values': {'this': 10}}},
+                'geography': {'this': {'geo_code': 'XX'}},
+            }, json.loads(response.content))
+            # with the keys of the exported response
+            self.assertEqual('geo-country-XX table-TOTAL', response['Surrogate-Key'])
+
+            response = view(factory.get('/profiles/country-XX.json', {'keys': 'demographics.missing'}),
+                            geography_id='country-XX')
+            self.assertEqual(400, response.status_code)
@@ -1,7 +1,8 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.conf import settings
 
 from wazimap.geo import geo_data, GeoData
+from wazimap.tests.test_dependencies import LOCMEM_CACHES
 
 
 class GeoTestCase(TestCase):
@@ -26,3 +27,34 @@ class GeoTestCase(TestCase):
 
         with self.assertRaises(ValueError):
             GeoData()
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_geometry_wkb(self):
+        class Shape(object):
+            def __init__(self, wkb):
+                self.wkb = wkb
+                self.simplified = 0
+
+            def simplify(self, tolerance, preserve_topology):
+                self.simplified += 1
+                return Shape('%s simplified %s' % (self.wkb, tolerance))
+
+        shape = Shape('wkb')
+        geo = geo_data.geo_model.objects.create(geo_level='country', geo_code='XW', name='Wkbland', version='2011')
+        geometry = geo_data.geometry
+        geo_data.geometry = {'2011': {'country': {'XW': {'properties': {}, 'shape': shape}}}}
+
+        try:
+            self.assertEqual('wkb', geo_data.get_geometry_wkb(geo))
+            self.assertEqual('wkb simplified 0.01', geo_data.get_geometry_wkb(geo, 'low'))
+            self.assertEqual('wkb simplified 0.01', geo_data.get_geometry_wkb(geo, 'low'))
+            # simplified geometries are cached
+            self.assertEqual(1, shape.simplified)
+
+            self.assertEqual({'country-XW': 'wkb simplified 0.001'}, geo_data.get_geometry_wkbs([geo], 'medium'))
+            self.assertEqual(2, shape.simplified)
+        finally:
+            geo_data.geometry = geometry
+
+        other = geo_data.geo_model.objects.create(geo_level='country', geo_code='XX', name='Nowhere', version='2011')
+        self.assertIsNone(geo_data.get_geometry_wkb(other))
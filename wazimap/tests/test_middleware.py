@@ -0,0 +1,49 @@
+from django.test import TestCase, RequestFactory, override_settings
+
+from wazimap.middleware import CanonicalQueryMiddleware
+
+
+class CanonicalQueryMiddlewareTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.middleware = CanonicalQueryMiddleware()
+
+    def canonical(self, url):
+        request = self.factory.get(url)
+        self.middleware.process_request(request)
+        return request
+
+    def test_data_api(self):
+        collapsed = self.middleware.counters.counts['collapsed']
+
+        request = self.canonical('/api/1.0/data/show/latest?table_ids=b,A,a&geo_ids=province-WC,country-ZA&geo_version=')
+        self.assertEqual('geo_ids=country-ZA,province-WC&table_ids=A,B', request.META['QUERY_STRING'])
+        self.assertEqual('A,B', request.GET['table_ids'])
+        self.assertNotIn('geo_version', request.GET)
+
+        request = self.canonical('/api/1.0/data/show/latest?geo_ids=country-ZA,province-WC&table_ids=A,B')
+        self.assertEqual('geo_ids=country-ZA,province-WC&table_ids=A,B', request.META['QUERY_STRING'])
+        self.assertEqual(collapsed + 1, self.middleware.counters.counts['collapsed'])
+
+    def test_columns(self):
+        request = self.canonical('/api/1.0/data/show/latest?table_ids=A&geo_ids=country-ZA&columns=Male,Female,Male&format=columnar')
+        self.assertEqual('columns=Female,Male&format=columnar&geo_ids=country-ZA&table_ids=A', request.META['QUERY_STRING'])
+
+    def test_split_geo_ids(self):
+        request = self.canonical('/api/1.0/data/show/latest?geo_ids=province|country-ZA')
+        self.assertEqual('geo_ids=province|country-ZA', request.META['QUERY_STRING'])
+
+    @override_settings(WAZIMAP=dict(default_geo_version='2011', legacy_embed_geo_version='2009'))
+    def test_default_geo_version(self):
+        request = self.canonical('/profiles/province-WC-western-cape/?geo_version=2011')
+        self.assertEqual('', request.META['QUERY_STRING'])
+
+        request = self.canonical('/profiles/province-WC.json?geo_version=2011')
+        self.assertEqual('geo_version=2011', request.META['QUERY_STRING'])
+
+        request = self.canonical('/profiles/province-WC.json?geo_version=2009')
+        self.assertEqual('', request.META['QUERY_STRING'])
+
+    def test_other_urls(self):
+        request = self.canonical('/api/1.0/data/download/latest?table_ids=b,a')
+        self.assertEqual('table_ids=b,a', request.META['QUERY_STRING'])
@@ -0,0 +1,241 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+from decimal import Decimal
+
+from django.core.cache import caches
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+
+from wazimap.geo import geo_data
+from wazimap.cache import bump_data_version, object_cache
+from wazimap.data.stats import Stat
+from wazimap.dependencies import recording, record, invalidate
+from wazimap.encoders import dumps
+from wazimap.profiles import (register_section, get_sections, build_profile, build_profiles, select_keys,
+                              enhance_api_data, profile_json, align_profiles, PROFILE_SECTIONS,
+                              ThreadPoolSectionExecutor)
+from wazimap.tests.test_dependencies import LOCMEM_CACHES, Geo
+
+
+class ProfileSectionsTestCase(TestCase):
+    def tearDown(self):
+        PROFILE_SECTIONS.pop('test', None)
+
+    def test_sections(self):
+        @register_section('people', profile='test')
+        def people(geo, session):
+            return {'total': {'values': {'this': 10}}}
+
+        register_section('households', lambda geo, session: {'geo': geo.geo_code}, profile='test')
+
+        self.assertEqual(['people', 'households'], get_sections('test').keys())
+        self.assertEqual({}, get_sections('other'))
+
+        geo = geo_data.geo_model.objects.create(geo_level='country', geo_code='ZA', name='South Africa', version='2011')
+        profile = build_profile(geo, 'test')
+        self.assertEqual(['people', 'households'], profile.keys())
+        self.assertEqual({'geo': 'ZA'}, profile['households'])
+
+        self.assertEqual(['households'], build_profile(geo, 'test', sections=['households']).keys())
+
+    def test_select_keys(self):
+        data = {
+            'demographics': {'sex': {'Male': 1}, 'age': {'young': 2}},
+            'economics': {'income': 3},
+        }
+
+        self.assertEqual({'demographics': {'sex': {'Male': 1}}, 'economics': {'income': 3}},
+                         select_keys(data, ['demographics.sex', 'economics']))
+
+        with self.assertRaises(KeyError):
+            select_keys(data, ['demographics.sex.Male.x'])
+
+    def test_thread_pool_executor(self):
+        threads = set()
+
+        def section(name, delay):
+            def build(geo, session):
+                threads.add(threading.current_thread().ident)
+                record(name, [geo])
+                time.sleep(delay)
+                return {'name': name}
+            return build
+
+        # the slowest section is registered first
+        register_section('a', section('a', 0.1), profile='test')
+        register_section('b', section('b', 0.05), profile='test')
+        register_section('c', section('c', 0.05), profile='test')
+
+        geo = geo_data.geo_model.objects.create(geo_level='country', geo_code='ZA', name='South Africa', version='2011')
+        executor = ThreadPoolSectionExecutor(workers=3)
+
+        with recording() as deps:
+            data, timings = executor.build(geo, 'test', ['a', 'b', 'c'])
+
+        self.assertEqual(['a', 'b', 'c'], data.keys())
+        self.assertEqual({'name': 'b'}, data['b'])
+        self.assertEqual(['a', 'b', 'c'], timings.keys())
+        self.assertTrue(timings['a'] >= 0.1)
+        self.assertEqual(3, len(threads))
+        self.assertNotIn(threading.current_thread().ident, threads)
+        self.assertEqual(set(['A', 'B', 'C']), set(t for t, _, _ in deps.items))
+
+    def test_thread_pool_map(self):
+        threads = set()
+        geo = geo_data.geo_model.objects.create(geo_level='country', geo_code='ZA', name='South Africa', version='2011')
+
+        def fetch(table):
+            threads.add(threading.current_thread().ident)
+            record(table, [geo])
+            time.sleep(0.05)
+            return table.lower()
+
+        executor = ThreadPoolSectionExecutor(workers=3)
+        with recording() as deps:
+            self.assertEqual(['a', 'b', 'c'], executor.map(fetch, ['A', 'B', 'C']))
+
+        self.assertNotIn(threading.current_thread().ident, threads)
+        self.assertEqual(set(['A', 'B', 'C']), set(t for t, _, _ in deps.items))
+
+
+class CompareProfilesTestCase(TestCase):
+    def setUp(self):
+        self.comparative_levels = geo_data.comparative_levels
+        geo_data.comparative_levels = ['this', 'country']
+        # comparative sections are kept in each process
+        object_cache.clear_local()
+
+        self.built = []
+
+        @register_section('people', profile='test')
+        def people(geo, session):
+            self.built.append(geo.geoid)
+            return {'total': Stat(name='People', values={'this': len(geo.geo_code) * 10}), 'metadata': {'year': 2011}}
+
+        create = geo_data.geo_model.objects.create
+        create(geo_level='country', geo_code='ZA', name='South Africa', version='2011')
+        self.wc = create(geo_level='province', geo_code='WC', name='Western Cape', version='2011',
+                         parent_level='country', parent_code='ZA')
+        self.gtn = create(geo_level='province', geo_code='GTN', name='Gauteng', version='2011',
+                          parent_level='country', parent_code='ZA')
+
+    def tearDown(self):
+        geo_data.comparative_levels = self.comparative_levels
+        PROFILE_SECTIONS.pop('test', None)
+
+    def test_build_profiles(self):
+        wc, gtn = build_profiles([self.wc, self.gtn], 'test')
+
+        # the shared comparative is only built once
+        self.assertEqual(['province-WC', 'country-ZA', 'province-GTN'], self.built)
+        self.assertEqual({'this': 20, 'country': 20}, wc['people']['total']['values'])
+        self.assertEqual({'this': 30, 'country': 20}, gtn['people']['total']['values'])
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_cached_comparatives(self):
+        caches['default'].clear()
+
+        @register_section('households', profile='test')
+        def households(geo, session):
+            self.built.append(geo.geoid)
+            record('households', [geo])
+            return {'total': Stat(name='Households', values={'this': 5})}
+
+        build_profile(self.wc, 'test', sections=['households'])
+        with recording() as deps:
+            gtn = build_profile(self.gtn, 'test', sections=['households'])
+
+        # the comparative was built once, and the second profile still depends on it
+        self.assertEqual(['province-WC', 'country-ZA', 'province-GTN'], self.built)
+        self.assertEqual({'this': 5, 'country': 5}, gtn['households']['total']['values'])
+        self.assertIn(('HOUSEHOLDS', 'country-ZA', '2011'), deps.items)
+
+        invalidate(tables=['households'], geos=['country-ZA'], purge_cdn=False)
+        build_profile(self.gtn, 'test', sections=['households'])
+        self.assertEqual(['province-WC', 'country-ZA', 'province-GTN', 'province-GTN', 'country-ZA'], self.built)
+
+    def test_align_profiles(self):
+        profiles = build_profiles([self.wc, self.gtn], 'test')
+        profiles[1]['people']['extra'] = 1
+
+        aligned = align_profiles(profiles)
+        self.assertEqual({
+            'people': {
+                'total': {'name': 'People', 'values': {'this': [20, 30], 'country': [20, 20]}},
+                'metadata': {'year': 2011},
+                'extra': [None, 1],
+            },
+        }, aligned)
+
+
+class ProfileJSONTestCase(TestCase):
+    def setUp(self):
+        self.comparative_levels = geo_data.comparative_levels
+        geo_data.comparative_levels = ['this', 'province', 'country']
+
+    def tearDown(self):
+        geo_data.comparative_levels = self.comparative_levels
+
+    def test_same_as_enhance_api_data(self):
+        self.maxDiff = None
+        data = OrderedDict([
+            ('demographics', OrderedDict([
+                ('total_population', {
+                    'name': 'People',
+                    'values': {'this': Decimal('10.5'), 'province': 20, 'country': 40.0},
+                    'error': {'this': 1, 'province': 2},
+                    'numerators': {'this': 5},
+                }),
+                ('sex_distribution', OrderedDict([
+                    ('Female', {'name': u'Female \u00e9', 'numerators': {'this': 3}, 'values': {'this': 30.1, 'country': 51}}),
+                    ('metadata', {'universe': 'People', 'year': 2011}),
+                ])),
+                ('charts', [{'values': {'this': 1}}, None, True, 1.5]),
+            ])),
+            ('geography', {'this': {'geo_code': 'WC', 'name': 'Western Cape'}, 'parents': {}}),
+        ])
+
+        expected = json.loads(dumps(enhance_api_data(deepcopy(data))))
+        self.assertEqual(expected, json.loads(profile_json(data)))
+        self.assertEqual(['province', 'country'], expected['geography']['comparatives'])
+
+        # the data isn't changed
+        self.assertNotIn('comparatives', data['geography'])
+        self.assertNotIn('index', data['demographics']['total_population'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SectionCacheTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.template = Template('{% load profile_cache %}{% cachesection "people" flag %}{{ value }}{% endcachesection %}')
+
+    def render(self, value, flag=False, geoid='province-WC'):
+        return self.template.render(Context({
+            'geography': {'this': {'full_geoid': geoid, 'version': '2011'}},
+            'value': value,
+            'flag': flag,
+        }))
+
+    def test_cache_section(self):
+        self.assertEqual('1', self.render(1))
+        self.assertEqual('1', self.render(2))
+
+        # other geographies and extra arguments have their own entries
+        self.assertEqual('3', self.render(3, geoid='province-GT'))
+        self.assertEqual('4', self.render(4, flag=True))
+
+        # a new data version invalidates everything
+        bump_data_version()
+        self.assertEqual('5', self.render(5))
+
+    def test_invalidate_section(self):
+        with recording():
+            record('people', [Geo('province-WC')])
+            self.assertEqual('1', self.render(1))
+
+        invalidate(tables=['people'])
+        self.assertEqual('2', self.render(2))
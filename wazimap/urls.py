@@ -8,9 +8,12 @@ from django.views.generic.base import RedirectView, TemplateView
 
 from census.views import HealthcheckView, DataView, ExampleView
 
-from wazimap.views import (HomepageView, GeographyDetailView, GeographyJsonView, PlaceSearchJson,
-                           LocateView, DataAPIView, TableAPIView, AboutView, HelpView, GeographyCompareView,
-                           GeoAPIView, TableDetailView)
+from wazimap.cache import cache_response, condition_on_data_version
+
+from wazimap.views import (HomepageView, GeographyDetailView, GeographyJsonView, GeographySectionView, PlaceSearchJson,
+                           LocateView, DataAPIView, ChildrenAPIView, TableAPIView, AboutView, HelpView,
+                           GeographyCompareView, GeographyCompareJsonView, GeoAPIView, TableDetailView,
+                           DownloadStatusView)
 
 
 admin.autodiscover()
@@ -44,7 +47,7 @@ urlpatterns = [
     # e.g. /profiles/province-GT/
     url(
         regex   = '^profiles/(?P<geography_id>\w+-\w+)(-(?P<slug>[\w-]+))?/$',
-        view    = cache_page(STANDARD_CACHE_TIME)(GeographyDetailView.as_view()),
+        view    = cache_response(STANDARD_CACHE_TIME)(GeographyDetailView.as_view()),
         kwargs  = {},
         name    = 'geography_detail',
     ),
@@ -61,11 +64,19 @@ urlpatterns = [
     # e.g. /profiles/province-GT.json
     url(
         regex   = '^(embed_data/)?profiles/(?P<geography_id>\w+-\w+)(-(?P<slug>[\w-]+))?\.json$',
-        view    = cache_page(STANDARD_CACHE_TIME)(GeographyJsonView.as_view()),
+        view    = condition_on_data_version(cache_response(STANDARD_CACHE_TIME)(GeographyJsonView.as_view())),
         kwargs  = {},
         name    = 'geography_json',
     ),
 
+    # e.g. /profiles/province-GT/sections/demographics.json
+    url(
+        regex   = '^profiles/(?P<geography_id>\w+-\w+)/sections/(?P<section>\w+)\.(?P<format>json|html)$',
+        view    = condition_on_data_version(cache_response(STANDARD_CACHE_TIME)(GeographySectionView.as_view())),
+        kwargs  = {},
+        name    = 'geography_section',
+    ),
+
     # e.g. /compare/province-GT/vs/province-WC/
     url(
         regex   = '^compare/(?P<geo_id1>\w+-\w+)/vs/(?P<geo_id2>\w+-\w+)/$',
@@ -74,14 +85,30 @@ urlpatterns = [
         name    = 'geography_compare',
     ),
 
+    # e.g. /compare/province-GT/vs/province-WC.json
+    url(
+        regex   = '^compare/(?P<geo_id1>\w+-\w+)/vs/(?P<geo_id2>\w+-\w+)\.json$',
+        view    = condition_on_data_version(cache_response(STANDARD_CACHE_TIME)(GeographyCompareJsonView.as_view())),
+        kwargs  = {},
+        name    = 'geography_compare_json',
+    ),
+
     # Custom data api
     url(
         regex   = '^api/1.0/data/show/latest$',
-        view    = cache_page(STANDARD_CACHE_TIME)(DataAPIView.as_view()),
+        view    = condition_on_data_version(cache_response(STANDARD_CACHE_TIME)(DataAPIView.as_view())),
         kwargs  = {'action': 'show'},
         name    = 'api_show_data',
     ),
 
+    # column values for the children of a geography
+    url(
+        regex   = '^api/1.0/data/children/latest$',
+        view    = condition_on_data_version(cache_response(STANDARD_CACHE_TIME)(ChildrenAPIView.as_view())),
+        kwargs  = {},
+        name    = 'api_children_data',
+    ),
+
     # download API
     url(
         regex   = '^api/1.0/data/download/latest$',
@@ -90,6 +117,14 @@ urlpatterns = [
         name    = 'api_download_data',
     ),
 
+    # status of downloads that are generated in the background
+    url(
+        regex   = '^api/1.0/data/download/status/(?P<job_id>[0-9a-f-]+)$',
+        view    = DownloadStatusView.as_view(),
+        kwargs  = {},
+        name    = 'api_download_status',
+    ),
+
     # table search API
     url(
         regex   = '^api/1.0/table$',
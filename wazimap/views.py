@@ -1,21 +1,40 @@
+from collections import OrderedDict
 from itertools import chain
 import json
 
 from django.conf import settings
-from django.core.serializers.json import DjangoJSONEncoder
 from django.utils.safestring import SafeString
 from django.utils.module_loading import import_string
-from django.http import HttpResponse, Http404, HttpResponseBadRequest
+from django.http import HttpResponse, Http404, HttpResponseBadRequest, StreamingHttpResponse
 from django.views.generic import View, TemplateView
-from django.shortcuts import redirect
+from django.shortcuts import redirect, render
+from django.template.loader import select_template
+from django.core.urlresolvers import reverse
+from django.utils.http import urlencode
+from django.utils.cache import patch_response_headers
 
-from census.views import GeographyDetailView as BaseGeographyDetailView, LocateView as BaseLocateView, render_json_to_response
+from census.views import GeographyDetailView as BaseGeographyDetailView, LocateView as BaseLocateView
 
 from wazimap.geo import geo_data
-from wazimap.profiles import enhance_api_data
+from wazimap.models import DownloadJob
+from wazimap.profiles import (enhance_api_data, profile_json, get_sections, build_section, build_profile,
+                              build_profiles, select_keys, align_profiles, get_section_executor)
 from wazimap.data.tables import get_datatable, DATA_TABLES
-from wazimap.data.utils import LocationNotFound
-from wazimap.data.download import DownloadManager
+from wazimap.data.utils import LocationNotFound, percent
+from wazimap.data.download import DownloadManager, get_download_cache, queue_download_job
+from wazimap.export import (exported_response, exported_surrogate_keys, read_exported, profile_page_path,
+                            profile_json_path)
+from wazimap.cdn import surrogate_keys, add_surrogate_keys
+from wazimap.dependencies import recording
+from wazimap.encoders import dumps, iterdumps_object, render_json_to_response
+
+
+class ProfileSelectionError(Exception):
+    pass
+
+
+def split_list(value):
+    return [v.strip() for v in (value or '').split(',') if v.strip()]
 
 
 def render_json_error(message, status_code=400):
@@ -39,9 +58,21 @@ class HomepageView(TemplateView):
 class GeographyDetailView(BaseGeographyDetailView):
     adjust_slugs = True
     default_geo_version = None
+    # serve pages from WAZIMAP['static_export_dir'] if they've been exported
+    serve_exported = True
+    # render only the first few sections and load the rest asynchronously,
+    # if WAZIMAP['progressive_profile_sections'] is set
+    progressive = True
 
     def dispatch(self, *args, **kwargs):
         request = args[0]
+
+        if self.serve_exported:
+            response = self.exported_response(request, **kwargs)
+            if response:
+                # the rest of the keys were stored when the file was exported
+                return add_surrogate_keys(response, surrogate_keys([self.kwargs['geography_id']]))
+
         version = request.GET.get('geo_version', self.default_geo_version)
         self.geo_id = self.kwargs.get('geography_id', None)
 
@@ -59,26 +90,33 @@ class GeographyDetailView(BaseGeographyDetailView):
                 return redirect(url, permanent=True)
 
         # Skip the parent class's logic completely and go back to basics
-        return TemplateView.dispatch(self, *args, **kwargs)
+        with recording() as deps:
+            response = TemplateView.dispatch(self, *args, **kwargs)
+
+        # let the CDN purge the response when any of the tables it uses change
+        table_ids = sorted(set(table_id for table_id, geoid, version in deps.items if table_id))
+        tables = [DATA_TABLES.get(table_id, table_id) for table_id in table_ids]
+        return add_surrogate_keys(response, surrogate_keys([self.geo], tables))
 
     def get_context_data(self, *args, **kwargs):
         page_context = {}
 
-        # load the profile
-        profile_method = settings.WAZIMAP.get('profile_builder', None)
-        self.profile_name = settings.WAZIMAP.get('default_profile', 'default')
-
-        if not profile_method:
-            raise ValueError("You must define WAZIMAP.profile_builder in settings.py")
-        profile_method = import_string(profile_method)
-        profile_data = profile_method(self.geo, self.profile_name, self.request)
-
-        profile_data['geography'] = self.geo.as_dict_deep()
+        profile_data = self.get_profile_data()
+        if self.progressive and self.built_sections is not None:
+            # every section in order, with placeholders for the ones the page loads later
+            page_context['profile_sections'] = sections = []
+            for name in get_sections(self.profile_name):
+                section = self.section_urls(name)
+                section['deferred'] = name not in self.built_sections
+                if not section['deferred']:
+                    section['template'] = get_section_template(self.profile_name, name)
+                sections.append(section)
+            page_context['deferred_sections'] = [s for s in sections if s['deferred']]
 
         profile_data = enhance_api_data(profile_data)
         page_context.update(profile_data)
 
-        profile_data_json = SafeString(json.dumps(profile_data, cls=DjangoJSONEncoder))
+        profile_data_json = SafeString(dumps(profile_data))
 
         page_context.update({
             'profile_data_json': profile_data_json
@@ -86,9 +124,59 @@ class GeographyDetailView(BaseGeographyDetailView):
 
         # is this a head-to-head view?
         page_context['head2head'] = 'h2h' in self.request.GET
+        page_context['profile_name'] = self.profile_name
 
         return page_context
 
+    def get_profile_data(self):
+        """ Build the profile data for this geography, before it's enhanced.
+        """
+        profile_method = self.load_profile_builder()
+        self.built_sections = self.sections_to_build()
+
+        if self.built_sections is None:
+            profile_data = profile_method(self.geo, self.profile_name, self.request)
+        else:
+            profile_data = build_profile(self.geo, self.profile_name, self.request, self.built_sections)
+
+        profile_data['geography'] = self.geo.as_dict_deep()
+        return profile_data
+
+    def load_profile_builder(self):
+        profile_method = settings.WAZIMAP.get('profile_builder', None)
+        self.profile_name = settings.WAZIMAP.get('default_profile', 'default')
+
+        if not profile_method:
+            raise ValueError("You must define WAZIMAP.profile_builder in settings.py")
+        # this also registers the profile's sections
+        return import_string(profile_method)
+
+    def sections_to_build(self):
+        """ Names of the profile sections to build, or None to build the whole
+        profile with the profile builder.
+        """
+        count = settings.WAZIMAP.get('progressive_profile_sections')
+        sections = get_sections(self.profile_name).keys()
+        if not self.progressive or not count or not sections:
+            return None
+        return sections[:count]
+
+    def section_urls(self, name):
+        urls = {'name': name}
+        for fmt in ['json', 'html']:
+            url = reverse('geography_section', kwargs={'geography_id': self.geo_id, 'section': name, 'format': fmt})
+            if 'geo_version' in self.request.GET:
+                url += '?' + urlencode({'geo_version': self.request.GET['geo_version']})
+            urls[fmt + '_url'] = url
+        return urls
+
+    def exported_response(self, request, **kwargs):
+        # without a slug, we'd need to redirect to the canonical url
+        if not kwargs.get('slug'):
+            return None
+        path = profile_page_path(kwargs['geography_id'], kwargs['slug'])
+        return exported_response(request, path, 'text/html; charset=utf-8')
+
     def get_geography(self, geo_id):
         # stub this out to prevent the subclass for calling out to CR
         pass
@@ -100,14 +188,115 @@ class GeographyDetailView(BaseGeographyDetailView):
 class GeographyJsonView(GeographyDetailView):
     """ Return geo profile data as json. """
     adjust_slugs = False
+    progressive = False
     default_geo_version = settings.WAZIMAP.get('legacy_embed_geo_version')
 
     def dispatch(self, *args, **kwargs):
         return super(GeographyJsonView, self).dispatch(*args, **kwargs)
 
+    def exported_response(self, request, **kwargs):
+        path = profile_json_path(kwargs['geography_id'])
+        if not request.GET or set(request.GET.iterkeys()) - set(['sections', 'keys']):
+            return exported_response(request, path, 'application/javascript')
+
+        # select keys from the exported profile, such as for embedded charts
+        content = read_exported(path)
+        if content is None:
+            return None
+
+        self.selected_keys = self.get_selected_keys(request)
+        try:
+            profile_data = self.select_profile_data(json.loads(content, object_pairs_hook=OrderedDict))
+        except ProfileSelectionError as e:
+            return render_json_error(e.message)
+
+        response = HttpResponse(dumps(profile_data), content_type='application/javascript')
+        patch_response_headers(response, settings.WAZIMAP['cache_secs'])
+        return add_surrogate_keys(response, exported_surrogate_keys(path))
+
+    def get_selected_keys(self, request):
+        # only return these sections, or these dotted key paths, such as demographics.sex_ratio
+        return split_list(request.GET.get('sections')) + split_list(request.GET.get('keys'))
+
+    def get(self, request, *args, **kwargs):
+        self.selected_keys = self.get_selected_keys(request)
+
+        try:
+            profile_data = self.select_profile_data(self.get_profile_data())
+        except ProfileSelectionError as e:
+            return render_json_error(e.message)
+
+        return HttpResponse(profile_json(profile_data), content_type='application/javascript')
+
+    def sections_to_build(self):
+        """ Only build the sections needed for the selected keys. Profiles that don't
+        register their sections are built in full and then filtered.
+        """
+        registered = get_sections(self.profile_name)
+        if not self.selected_keys or not registered:
+            return None
+
+        wanted = set(k.split('.', 1)[0] for k in self.selected_keys)
+        unknown = wanted - set(registered)
+        if unknown:
+            raise ProfileSelectionError('Unknown section: %s' % ', '.join(sorted(unknown)))
+
+        return [name for name in registered if name in wanted]
+
+    def select_profile_data(self, profile_data):
+        if not self.selected_keys:
+            return profile_data
+
+        try:
+            selected = select_keys(profile_data, self.selected_keys)
+        except KeyError as e:
+            raise ProfileSelectionError('Unknown key: %s' % e.args[0])
+
+        selected['geography'] = profile_data['geography']
+        return selected
+
+
+def get_section_template(profile_name, section):
+    """ The template for a profile section, which is ``profile/sections/<profile>_<section>.html``
+    or ``profile/sections/<section>.html``.
+    """
+    return select_template([
+        'profile/sections/%s_%s.html' % (profile_name, section),
+        'profile/sections/%s.html' % section,
+    ]).template
+
+
+class GeographySectionView(GeographyDetailView):
+    """ Return a single section of a geo profile, as json or as an HTML fragment
+    rendered with the ``profile/sections/<section>.html`` template.
+    """
+    adjust_slugs = False
+    serve_exported = False
+
     def get(self, request, *args, **kwargs):
-        context = self.get_context_data(**kwargs)
-        return HttpResponse(context['profile_data_json'], content_type='application/javascript')
+        self.load_profile_builder()
+        section = kwargs['section']
+        if section not in get_sections(self.profile_name):
+            raise Http404
+
+        profile_data = {
+            section: build_section(section, self.geo, self.profile_name),
+            'geography': self.geo.as_dict_deep(),
+        }
+
+        if kwargs['format'] == 'html':
+            context = enhance_api_data(profile_data)
+            context.update({
+                'profile_name': self.profile_name,
+                'section_name': section,
+                'head2head': 'h2h' in request.GET,
+                # the page needs the section's data to draw its charts, so it's included with the HTML
+                'section_data_json': SafeString(dumps(context[section]).replace('</', '<\\/')),
+                'section_template': get_section_template(self.profile_name, section),
+            })
+            return render(request, 'profile/_blocks/_section.html', context)
+
+        return HttpResponse(profile_json(profile_data), content_type='application/javascript')
 
 
 class PlaceSearchJson(View):
@@ -168,7 +357,29 @@ class DataAPIView(View):
     An example call:
 
     http://api.censusreporter.org/1.0/data/show/latest?table_ids=B17001&geo_ids=04000US36%2C01000US
+
+    The ``show`` action also accepts these parameters:
+
+    - ``columns``: a comma-separated list of the columns to fetch, rather than all of them
+    - ``format=columnar``: return the data for each table as a list of columns and a row
+      of values for each geography, rather than as a dict for each geography
+    - ``meta=0``: leave out the details of the tables, which don't change
+    - ``format=ndjson``: return newline-delimited JSON, with the release, tables and
+      the geographies the data geographies were split from on the first line, and then
+      a line for each data geography with its details and data
+
+    Responses for more than +stream_geos+ data geographies, and all NDJSON responses,
+    are streamed. Their data is fetched +stream_chunk_geos+ geographies at a time, so
+    that the whole response is never held in memory.
     """
+    # above this many data geos, they're replaced by a surrogate key for their levels
+    max_surrogate_geos = 50
+    # above this many data geos, the response is streamed
+    stream_geos = 500
+    # data geos to fetch data for at a time when streaming
+    stream_chunk_geos = 200
+    # whether large downloads are queued, see download_async_geos
+    queue_downloads = True
 
     def get(self, request, *args, **kwargs):
         try:
@@ -193,32 +404,166 @@ class DataAPIView(View):
         dataset = ', '.join(sorted(list(set(t.dataset_name for t in self.tables))))
         years = ', '.join(sorted(list(set(t.year for t in self.tables))))
 
-        data = self.get_data(self.data_geos, self.tables)
+        try:
+            columns = self.get_columns(request.GET.get('columns'))
+        except KeyError as e:
+            return render_json_error('Unknown column: %s' % e.message, 404)
 
-        return render_json_to_response({
-            'release': {
+        fmt = request.GET.get('format')
+        head = OrderedDict([
+            ('release', {
                 'name': dataset,
                 'years': years,
-            },
-            'tables': dict((t.id.upper(), t.as_dict()) for t in self.tables),
-            'data': data,
-            'geography': dict((g.geoid, g.as_dict()) for g in chain(self.data_geos, self.info_geos)),
-        })
+            }),
+        ])
+        if request.GET.get('meta') != '0':
+            head['tables'] = dict((t.id.upper(), t.as_json()) for t in self.tables)
+
+        if fmt == 'ndjson':
+            response = StreamingHttpResponse(self.iter_ndjson(head, columns), content_type='application/x-ndjson')
+        elif fmt != 'columnar' and len(self.data_geos) > self.stream_geos:
+            response = StreamingHttpResponse(self.iter_json(head, columns), content_type='application/javascript')
+        else:
+            data = self.get_data(self.data_geos, self.tables, columns)
+            if fmt == 'columnar':
+                data = self.columnar_data(data, self.data_geos, self.tables, columns)
 
-    def download(self, request):
-        mgr = DownloadManager()
+            result = dict(head)
+            result['data'] = data
+            result['geography'] = dict((g.geoid, g.as_json()) for g in chain(self.data_geos, self.info_geos))
+            response = render_json_to_response(result)
+
+        return add_surrogate_keys(response, self.surrogate_keys())
 
+    def iter_chunks(self, columns):
+        """ Yield (geo, data) pairs for each data geo, fetching data for
+        +stream_chunk_geos+ geos at a time.
+        """
+        for i in xrange(0, len(self.data_geos), self.stream_chunk_geos):
+            geos = self.data_geos[i:i + self.stream_chunk_geos]
+            data = self.get_data(geos, self.tables, columns)
+            for geo in geos:
+                yield geo, data[geo.geoid]
+
+    def iter_json(self, head, columns):
+        """ The JSON for the show action, in pieces.
+        """
+        def data():
+            for geo, values in self.iter_chunks(columns):
+                yield geo.geoid, values
+
+        def geography():
+            for geo in chain(self.data_geos, self.info_geos):
+                yield geo.geoid, geo.as_json()
+
+        pairs = chain(head.iteritems(), [('data', data()), ('geography', geography())])
+        return iterdumps_object(pairs)
+
+    def iter_ndjson(self, head, columns):
+        """ The NDJSON for the show action, one line at a time.
+        """
+        head['geography'] = dict((g.geoid, g.as_json()) for g in self.info_geos)
+        yield dumps(head) + '\n'
+
+        for geo, values in self.iter_chunks(columns):
+            yield dumps(OrderedDict([
+                ('geoid', geo.geoid),
+                ('geography', geo.as_json()),
+                ('data', values),
+            ])) + '\n'
+
+    def get_columns(self, param):
+        """ Parse the ``columns`` parameter into a dict from table id to the
+        list of columns to fetch for that table, in the table's order.
+        Returns None if all columns must be fetched.
+
+        Raises KeyError for a column that isn't in any of the tables.
+        """
+        if not param:
+            return None
+
+        wanted = set(c.strip() for c in param.split(',') if c.strip())
+        columns = {}
+        for table in self.tables:
+            columns[table.id.upper()] = [c for c in table.columns.iterkeys() if c in wanted]
+
+        found = set(chain(*columns.values()))
+        for col in sorted(wanted - found):
+            raise KeyError(col)
+
+        return columns
+
+    def columnar_data(self, data, geos, tables, columns=None):
+        """ Rearrange +data+ from +get_data+ into a list of columns and a row of
+        values for each geography, for each table. Errors are only included if
+        some of them aren't zero.
+        """
+        geoids = [g.geoid for g in geos]
+        result = {}
+
+        for table in tables:
+            table_id = table.id.upper()
+            cols = columns[table_id] if columns is not None else table.columns.keys()
+            table_data = [data[geoid][table_id] for geoid in geoids]
+
+            result[table_id] = {
+                'geoids': geoids,
+                'columns': cols,
+                'estimate': [[d['estimate'].get(c) for c in cols] for d in table_data],
+            }
+
+            errors = [[d['error'].get(c) for c in cols] for d in table_data]
+            if any(e for row in errors for e in row):
+                result[table_id]['error'] = errors
+
+        return result
+
+    def surrogate_keys(self):
+        if len(self.data_geos) <= self.max_surrogate_geos:
+            return surrogate_keys(self.info_geos + self.data_geos, self.tables, ancestors=False)
+
+        # too many to list, so depend on every geo at their levels
+        levels = sorted(set(g.geo_level for g in self.data_geos))
+        return surrogate_keys(self.info_geos, self.tables, ancestors=False, levels=levels)
+
+    def download(self, request):
         fmt = request.GET.get('format', 'csv')
-        if fmt not in mgr.DOWNLOAD_FORMATS:
-            response = HttpResponse('Unspported format %s. Supported formats: %s' % (fmt, ', '.join(mgr.DOWNLOAD_FORMATS.keys())))
+        if fmt not in DownloadManager.DOWNLOAD_FORMATS:
+            response = HttpResponse('Unspported format %s. Supported formats: %s' % (fmt, ', '.join(DownloadManager.DOWNLOAD_FORMATS.keys())))
             response.status_code = 400
             return response
 
+        # geometries are full precision unless a simplification tolerance is chosen
+        simplify = request.GET.get('simplify') or None
+        tolerances = settings.WAZIMAP.get('download_simplify_tolerances') or {}
+        if simplify == 'full' or not DownloadManager.DOWNLOAD_FORMATS[fmt]['geometry']:
+            simplify = None
+        if simplify and simplify not in tolerances:
+            response = HttpResponse('Unsupported simplification %s. Supported: %s' % (simplify, ', '.join(['full'] + sorted(tolerances))))
+            response.status_code = 400
+            return response
+
+        mgr = DownloadManager(simplify)
+
+        cache = get_download_cache()
+        if cache:
+            key = cache.key(self.tables, self.data_geos, fmt, simplify)
+            if cache.get(key):
+                return cache.response(key, mgr.file_ident(self.tables, self.data_geos) + '.zip')
+
+            async_geos = settings.WAZIMAP.get('download_async_geos')
+            if self.queue_downloads and async_geos is not None and len(self.data_geos) > async_geos:
+                job = queue_download_job(key, request.GET)
+                return download_job_response(job)
+
         data = self.get_data(self.data_geos, self.tables)
 
-        content, fname, mime_type = mgr.generate_download_bundle(self.tables, self.data_geos, self.geo_ids, data, fmt)
+        bundle, fname, mime_type = mgr.stream_download_bundle(self.tables, self.data_geos, self.geo_ids, data, fmt)
+        if cache:
+            bundle = cache.store(key, bundle)
 
-        response = HttpResponse(content, content_type=mime_type)
+        # the bundle is closed, and its files removed, when the response is closed
+        response = StreamingHttpResponse(bundle, content_type=mime_type)
         response['Content-Disposition'] = 'attachment; filename="%s"' % fname
 
         return response
@@ -256,22 +601,135 @@ class DataAPIView(View):
 
         return data_geos, info_geos
 
-    def get_data(self, geos, tables):
+    def get_data(self, geos, tables, columns=None):
+        """ Fetch data for +geos+ from each of +tables+. The tables are fetched
+        concurrently if the profile section executor allows it.
+        """
+        def fetch(table):
+            table_columns = columns[table.id.upper()] if columns is not None else None
+            return table.raw_data_for_geos(geos, table_columns)
+
         data = {}
+        results = get_section_executor().map(fetch, tables)
 
-        for table in tables:
-            for geo_id, table_data in table.raw_data_for_geos(geos).iteritems():
-                data.setdefault(geo_id, {})[table.id.upper()] = table_data
+        for table, table_data in zip(tables, results):
+            for geo_id, geo_values in table_data.iteritems():
+                data.setdefault(geo_id, {})[table.id.upper()] = geo_values
 
         return data
 
 
+def download_job_response(job):
+    """ The response for the status of a queued download +job+. Once the job is
+    done, this redirects to the download, which is then served from the cache.
+    """
+    if job.status == job.DONE:
+        return redirect(reverse('api_download_data') + '?' + urlencode(job.params()))
+
+    if job.status == job.FAILED:
+        return render_json_error(job.error or 'The download failed', 500)
+
+    status_url = reverse('api_download_status', kwargs={'job_id': job.id})
+    response = render_json_to_response(OrderedDict([
+        ('id', str(job.id)),
+        ('status', job.status),
+        ('status_url', status_url),
+    ]))
+    response.status_code = 202
+    response['Location'] = status_url
+    response['Retry-After'] = '5'
+    return response
+
+
+class DownloadStatusView(View):
+    """
+    View that returns the status of a download that is being generated in the
+    background, and redirects to the download once it's ready.
+    """
+    def get(self, request, job_id):
+        try:
+            job = DownloadJob.objects.get(id=job_id)
+        except (DownloadJob.DoesNotExist, ValueError):
+            return render_json_error('Unknown download: %s' % job_id, 404)
+
+        return download_job_response(job)
+
+
+class ChildrenAPIView(View):
+    """
+    View that returns the values of a single table column for all the children of a
+    geography, at a particular level, as parallel lists. This is all that's needed to
+    draw a choropleth map.
+
+    An example call:
+
+    /api/1.0/data/children/latest?table_id=GENDER&column=Female&geo_id=country-ZA&level=province
+    """
+    # above this many children, they're replaced by a surrogate key for their level
+    max_surrogate_geos = DataAPIView.max_surrogate_geos
+
+    def get(self, request, *args, **kwargs):
+        try:
+            table = get_datatable(request.GET.get('table_id', ''))
+        except KeyError as e:
+            return render_json_error('Unknown table: %s' % e.message, 404)
+
+        column = request.GET.get('column')
+        if column not in table.columns:
+            return render_json_error('Unknown column: %s' % column, 404)
+
+        try:
+            level, code = request.GET.get('geo_id', '').split('-', 1)
+            parent = geo_data.get_geography(code, level, request.GET.get('geo_version'))
+        except (ValueError, LocationNotFound):
+            return render_json_error('Invalid geo id: %s' % request.GET.get('geo_id', ''), 404)
+
+        child_level = request.GET.get('level') or parent.child_level
+        if child_level not in geo_data.geo_levels or parent.geo_level not in geo_data.geo_levels[child_level].get('ancestors', []):
+            return render_json_error('Invalid geo level: %s' % child_level, 400)
+
+        children = sorted(parent.split_into(child_level), key=lambda g: g.geo_code)
+        columns = [c for c in (column, table.total_column) if c]
+        data = table.raw_data_for_geos(children, columns) if children else {}
+
+        values = []
+        percentages = []
+        errors = []
+        for geo in children:
+            estimate = data[geo.geoid]['estimate']
+            value = estimate.get(column)
+            values.append(value)
+            errors.append(data[geo.geoid]['error'].get(column, 0))
+
+            total = estimate.get(table.total_column) if table.total_column else None
+            percentages.append(percent(value, total) if value is not None and total is not None else None)
+
+        result = OrderedDict([
+            ('table_id', table.id.upper()),
+            ('column', column),
+            ('parent_geoid', parent.geoid),
+            ('level', child_level),
+            ('geoids', [g.geoid for g in children]),
+            ('values', values),
+        ])
+        if table.total_column and column != table.total_column:
+            result['percentages'] = percentages
+        if any(errors):
+            result['errors'] = errors
+
+        if len(children) <= self.max_surrogate_geos:
+            keys = surrogate_keys([parent] + children, [table], ancestors=False)
+        else:
+            keys = surrogate_keys([parent], [table], ancestors=False, levels=[child_level])
+        return add_surrogate_keys(render_json_to_response(result), keys)
+
+
 class TableAPIView(View):
     """
     View that lists data tables.
     """
     def get(self, request, *args, **kwargs):
-        return render_json_to_response([t.as_dict(columns=False) for t in DATA_TABLES.itervalues()])
+        return render_json_to_response([t.as_json(columns=False) for t in DATA_TABLES.itervalues()])
 
 
 class AboutView(TemplateView):
@@ -303,6 +761,49 @@ class GeographyCompareView(TemplateView):
         return page_context
 
 
+class GeographyCompareJsonView(View):
+    """ Return the profiles of two geographies as json, aligned for a head-to-head comparison.
+
+    If the profile registers its sections, both profiles are built together and
+    comparative geographies they share are only built once.
+    """
+    def get(self, request, geo_id1, geo_id2):
+        version = request.GET.get('geo_version')
+
+        try:
+            geos = []
+            for geo_id in [geo_id1, geo_id2]:
+                level, code = geo_id.split('-', 1)
+                geos.append(geo_data.get_geography(code, level, version))
+        except (ValueError, LocationNotFound) as e:
+            return render_json_error(str(e), 404)
+
+        profiles = self.build_profiles(geos)
+
+        for geo, profile in zip(geos, profiles):
+            profile['geography'] = geo.as_dict_deep()
+            enhance_api_data(profile)
+
+        response = render_json_to_response({
+            'geographies': [profile.pop('geography') for profile in profiles],
+            'profile': align_profiles(profiles),
+        })
+        return add_surrogate_keys(response, surrogate_keys(geos))
+
+    def build_profiles(self, geos):
+        profile_method = settings.WAZIMAP.get('profile_builder', None)
+        profile_name = settings.WAZIMAP.get('default_profile', 'default')
+
+        if not profile_method:
+            raise ValueError("You must define WAZIMAP.profile_builder in settings.py")
+        # this also registers the profile's sections
+        profile_method = import_string(profile_method)
+
+        if get_sections(profile_name):
+            return build_profiles(geos, profile_name, self.request)
+        return [profile_method(geo, profile_name, self.request) for geo in geos]
+
+
 class GeoAPIView(View):
     """
     View that lists things about geos. Currently just parents.
@@ -314,7 +815,7 @@ class GeoAPIView(View):
         except (ValueError, LocationNotFound):
             raise Http404
 
-        parents = [g.as_dict() for g in geo.ancestors()]
+        parents = [g.as_json() for g in geo.ancestors()]
         return render_json_to_response(parents)
 
 